@@ -0,0 +1,166 @@
+# ***** BEGIN GPL LICENSE BLOCK *****
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+
+# ***** END GPL LICENCE BLOCK *****
+
+# the texture copies of the 2.63 exporters, without bpy: the files are
+# collected during the export and copied at its end, each file once, in a
+# few threads, and only if the destination is not already current.
+
+import os
+import shutil
+import hashlib
+import collections
+
+# the ways to deliver a file (see AssetCopier)
+rgModes = ['COPY', 'HARDLINK', 'REFLINK']
+
+# FICLONE of linux (btrfs, xfs): the destination shares the blocks of the source
+FICLONE = 0x40049409
+
+
+def getFileHash(fn):
+	sha1 = hashlib.sha1()
+	with open(fn, 'rb') as fl:
+		for chunk in iter(lambda: fl.read(1 << 20), b""):
+			sha1.update(chunk)
+	return sha1.hexdigest()
+
+def isCurrent(fnSource, fnDest):
+	"""whether fnDest already has the content of fnSource: same file, or the
+	same size and mtime (copy2 keeps the mtime), or the same content"""
+	if not os.path.exists(fnDest):
+		return False
+	if os.path.samefile(fnSource, fnDest):
+		return True
+	statSource, statDest = os.stat(fnSource), os.stat(fnDest)
+	if statSource.st_size != statDest.st_size:
+		return False
+	if int(statSource.st_mtime) == int(statDest.st_mtime):
+		return True
+	if getFileHash(fnSource) == getFileHash(fnDest):
+		# (the next export sees it by the mtime)
+		shutil.copystat(fnSource, fnDest)
+		return True
+	return False
+
+def reflink(fnSource, fnDest):
+	"""copy on write clone, raises OSError where the file system (or os) cannot"""
+	import fcntl
+	with open(fnSource, 'rb') as flSource:
+		with open(fnDest, 'wb') as flDest:
+			fcntl.ioctl(flDest.fileno(), FICLONE, flSource.fileno())
+	shutil.copystat(fnSource, fnDest)
+
+def deliver(fnSource, fnDest, sMode):
+	"""puts fnSource at fnDest (sMode: see rgModes), returns False if it was already there"""
+	if isCurrent(fnSource, fnDest):
+		return False
+	if os.path.exists(fnDest):
+		os.remove(fnDest)
+
+	if sMode == 'HARDLINK':
+		try:
+			os.link(fnSource, fnDest)
+			return True
+		except (OSError, AttributeError):
+			pass # other device, no links on this file system...
+	elif sMode == 'REFLINK':
+		try:
+			reflink(fnSource, fnDest)
+			return True
+		except (OSError, IOError, ImportError):
+			if os.path.exists(fnDest):
+				os.remove(fnDest)
+
+	shutil.copy2(fnSource, fnDest)
+	return True
+
+
+class AssetCopier:
+	"""the files an export references, by resolved destination path. add()
+	collects them, copy() delivers them at the end of the export.
+	converter: resizes/transcodes the files first (see texture_convert.py)"""
+
+	def __init__(self, sMode='COPY', cMaxThreads=8, converter=None):
+		self.sMode = sMode
+		self.cMaxThreads = cMaxThreads
+		self.converter = converter
+		# destination -> source (both resolved)
+		self.mapAssets = collections.OrderedDict()
+		# (source, destination, error) of the files which could not be delivered
+		self.rgFailures = []
+
+	def add(self, fnSource, fnDest):
+		"""the file fnSource is needed at fnDest (once per export, no matter
+		how often it is added). returns the name it is delivered as (the
+		converter may change the extension)"""
+		if self.converter:
+			fnDest = self.converter.getName(fnDest)
+		fnSource = os.path.realpath(fnSource)
+		fnDestReal = os.path.realpath(fnDest)
+		fnPrevious = self.mapAssets.setdefault(fnDestReal, fnSource)
+		if fnPrevious != fnSource:
+			self.rgFailures.append((fnSource, fnDestReal, "'%s' is already copied there (same name)" % fnPrevious))
+		return fnDest
+
+	def copy(self):
+		"""delivers all files, returns the number actually copied (see
+		rgFailures for the ones which failed)"""
+		for rProgress in self.copySteps():
+			pass
+		return self.cCopied
+
+	def copySteps(self):
+		"""copy() as generator: yields the progress (0..1) while the files are
+		converted (see modal_export.py), the number copied is in cCopied"""
+		self.cCopied = 0
+		def deliverAsset(fnDestSource):
+			fnDest, fnSource = fnDestSource
+			if fnSource == fnDest:
+				return False
+			try:
+				return deliver(fnSource, fnDest, self.sMode)
+			except (OSError, IOError) as e:
+				self.rgFailures.append((fnSource, fnDest, str(e)))
+				return False
+
+		rgAssets = list(self.mapAssets.items())
+		if self.converter:
+			# the converted files come from the cache
+			for rProgress in self.converter.convertSteps(sorted(set([fnSource for fnDest, fnSource in rgAssets]))):
+				yield rProgress
+			mapConverted = self.converter.mapConverted
+			mapErrors = dict(self.converter.rgFailures)
+			for fnDest, fnSource in rgAssets:
+				if fnSource not in mapConverted:
+					self.rgFailures.append((fnSource, fnDest, "conversion failed (%s)" % mapErrors.get(fnSource, mapErrors.get(""))))
+			rgAssets = [(fnDest, mapConverted[fnSource]) for fnDest, fnSource in rgAssets if fnSource in mapConverted]
+
+		if len(rgAssets) < 2:
+			self.cCopied = len([f for f in map(deliverAsset, rgAssets) if f])
+			return
+
+		from concurrent.futures import ThreadPoolExecutor
+		with ThreadPoolExecutor(max_workers=min(self.cMaxThreads, len(rgAssets))) as executor:
+			self.cCopied = len([f for f in executor.map(deliverAsset, rgAssets) if f])
+
+	def getReport(self):
+		"""the failures as one message (None: none)"""
+		if not self.rgFailures:
+			return None
+		return "Could not copy %i texture(s): %s" % (len(self.rgFailures),
+			"; ".join(["%s -> %s: %s" % failure for failure in self.rgFailures]))
@@ -0,0 +1,299 @@
+# ***** BEGIN GPL LICENSE BLOCK *****
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+
+# ***** END GPL LICENCE BLOCK *****
+
+# baked animation cache: the exporters (option "Bake cache file") save what
+# they sampled in blender, this script writes the .md2/.wrl again from it
+# with other output options, without blender:
+#
+#   python bake_cache.py robot.bake robot.md2 --scale 500
+#   python bake_cache.py hall.bake hall.wrl --precision 4 --key-precision 2 --duration 2.5
+#
+# file layout (little endian):
+#   header   8s magic, I version, I reserved, Q offset of the index, Q size of the index
+#   arrays   raw arrays, each aligned to 16 bytes (can be used straight from a mmap)
+#   index    JSON: {"meta": {...}, "arrays": {name: [typecode, offset, count]}}
+# the index is written last, so the frames can be streamed into the file.
+
+import sys
+import os
+import json
+import struct
+import mmap
+from array import array
+
+sMagic = b"BAKECACH"
+iVersion = 2
+sHeaderFormat = '<8sIIQQ'
+cAlignment = 16
+
+
+class BakeCacheWriter:
+	"""writes named arrays (one at a time, but each in as many pieces as
+	needed) and a JSON meta dictionary"""
+
+	def __init__(self, filename):
+		self.filename = filename
+		self.file = open(filename, 'wb')
+		self.file.write(b"\0" * struct.calcsize(sHeaderFormat))
+		self.mapArrays = {}
+		self.meta = {}
+		self.sOpenArray = None
+
+	def beginArray(self, sName, sTypecode):
+		if self.sOpenArray:
+			self.endArray()
+		# align the start
+		cPadding = -self.file.tell() % cAlignment
+		self.file.write(b"\0" * cPadding)
+		self.mapArrays[sName] = [sTypecode, self.file.tell(), 0]
+		self.sOpenArray = sName
+
+	def extend(self, values):
+		"""appends values (anything array() takes) to the open array"""
+		entry = self.mapArrays[self.sOpenArray]
+		if not isinstance(values, array) or values.typecode != entry[0]:
+			values = array(entry[0], values)
+		if sys.byteorder != 'little':
+			values = array(values.typecode, values)
+			values.byteswap()
+		self.file.write(values.tobytes())
+		entry[2] += len(values)
+
+	def endArray(self):
+		self.sOpenArray = None
+
+	def addArray(self, sName, sTypecode, values):
+		self.beginArray(sName, sTypecode)
+		self.extend(values)
+		self.endArray()
+
+	def close(self):
+		self.endArray()
+		sIndex = json.dumps({ 'meta' : self.meta, 'arrays' : self.mapArrays }).encode("utf-8")
+		ofsIndex = self.file.tell()
+		self.file.write(sIndex)
+		self.file.seek(0)
+		self.file.write(struct.pack(sHeaderFormat, sMagic, iVersion, 0, ofsIndex, len(sIndex)))
+		self.file.close()
+
+	def discard(self):
+		"""closes and removes the incomplete cache (cancelled export)"""
+		self.file.close()
+		os.remove(self.filename)
+
+
+class BakeCache:
+	"""a baked cache, memory-mapped: the arrays are views into the file"""
+
+	def __init__(self, filename):
+		self.file = open(filename, 'rb')
+		self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+		magic, version, reserved, ofsIndex, cIndex = struct.unpack_from(sHeaderFormat, self.map)
+		if magic != sMagic:
+			raise ValueError("'%s' is no bake cache" % filename)
+		if version != iVersion:
+			raise ValueError("'%s' is a bake cache of version %i, expected version %i" % (filename, version, iVersion))
+		index = json.loads(self.map[ofsIndex:ofsIndex+cIndex].decode("utf-8"))
+		self.meta = index['meta']
+		self.mapArrays = index['arrays']
+
+	def __contains__(self, sName):
+		return sName in self.mapArrays
+
+	def getArray(self, sName):
+		sTypecode, ofs, count = self.mapArrays[sName]
+		cBytes = count * array(sTypecode).itemsize
+		if sys.byteorder == 'little':
+			return memoryview(self.map)[ofs:ofs+cBytes].cast(sTypecode)
+		values = array(sTypecode, self.map[ofs:ofs+cBytes])
+		values.byteswap()
+		return values
+
+	def getTuples(self, sName, cComponents):
+		values = self.getArray(sName)
+		return list(zip(*[values[i::cComponents] for i in range(cComponents)]))
+
+	def getFaces(self, sName, rgSizes):
+		"""splits a flat index array into faces of the given sizes"""
+		values = self.getArray(sName)
+		rgFaces = []
+		iStart = 0
+		for cSize in rgSizes:
+			rgFaces.append(tuple(values[iStart:iStart+cSize]))
+			iStart += cSize
+		return rgFaces
+
+	def close(self):
+		self.map.close()
+		self.file.close()
+
+
+############ md2 ############
+
+def encodeMD2(cache, fnOut, rScale=None):
+	"""writes the md2 file of a cache baked by md2_export_263.py"""
+	import md2_format
+	meta = cache.meta['md2']
+	if rScale is None:
+		rScale = meta['scale']
+	cXYZ = meta['cXYZ']
+	rgFaceVertices = cache.getTuples('md2.faceVertices', 3)
+	rgFaceUVs = [None] * len(rgFaceVertices)
+	if 'md2.faceUVs' in cache:
+		rgFaceUVs = [((u0, v0), (u1, v1), (u2, v2)) for u0, v0, u1, v1, u2, v2 in cache.getTuples('md2.faceUVs', 6)]
+
+	frames = cache.getArray('md2.frames')
+	def writeFrames(file):
+		# per frame: coordinates, then normals (3 floats per vertex each)
+		for iFrame, sName in enumerate(meta['frameNames']):
+			iStart = iFrame * 6 * cXYZ
+			rgCoords = list(zip(frames[iStart:iStart+3*cXYZ:3], frames[iStart+1:iStart+3*cXYZ:3], frames[iStart+2:iStart+3*cXYZ:3]))
+			iStart += 3 * cXYZ
+			rgNormals = list(zip(frames[iStart:iStart+3*cXYZ:3], frames[iStart+1:iStart+3*cXYZ:3], frames[iStart+2:iStart+3*cXYZ:3]))
+			file.write(md2_format.packFrame(rgCoords, rgNormals, sName, rScale))
+
+	file = open(fnOut, 'wb')
+	try:
+		md2_format.writeMD2(file, meta['skins'], rgFaceUVs, rgFaceVertices, cXYZ, len(meta['frameNames']), writeFrames)
+	finally:
+		file.close()
+
+
+############ vrml ############
+
+def encodeVRML(cache, fnOut, mapOptions=None):
+	"""writes a vrml file of a cache baked by vrml_export_263.py: the objects
+	(with their hierarchy) and the sampled transformations; the options
+	(see the meta 'options' of the cache) may differ from the baked ones."""
+	import vrml_format
+	meta = cache.meta['vrml']
+	options = dict(meta['options'])
+	options.update(mapOptions or {})
+	shapeOptions = (options['precisionXYZ'], options['precisionUV'], options['precisionNormal'],
+		options['creaseAngle'], options['fSolidHints'])
+
+	mapChildren = {}
+	for iObj, obj in enumerate(meta['objects']):
+		mapChildren.setdefault(obj['parent'], []).append(iObj)
+
+	mapAppearances = {}
+	def getAppearanceNode(obj):
+		# the first shape with a material and texture defines the appearance, the others use it
+		keyAppearance = (obj['matDEF'], obj['texture'])
+		if keyAppearance in mapAppearances:
+			return "appearance USE %s" % mapAppearances[keyAppearance]
+		sDEF = "APP_%i_%s" % (len(mapAppearances), obj['matDEF'] or "NOMAT")
+		mapAppearances[keyAppearance] = sDEF
+		return "appearance DEF %s %s" % (sDEF, obj['appearance'])
+
+	fl = open(fnOut, "wt")
+	def writeObject(iObj):
+		obj = meta['objects'][iObj]
+		sPrefix = "obj.%i." % iObj
+		rgSizes = cache.getArray(sPrefix + "faceSizes")
+		geometryArrays = (cache.getTuples(sPrefix + "coords", 3), cache.getFaces(sPrefix + "coordIndex", rgSizes),
+			cache.getTuples(sPrefix + "texCoords", 2), cache.getFaces(sPrefix + "texCoordIndex", rgSizes) if obj['fTexCoords'] else [],
+			cache.getTuples(sPrefix + "normals", 3), cache.getFaces(sPrefix + "normalIndex", rgSizes) if obj['fNormals'] else [],
+			obj['fConvex'])
+
+		if obj['transform']:
+			scale, rotation, location = obj['transform']
+			fl.write("DEF %s Transform {\n	scale %.5f %.5f %.5f\n	rotation %.5f %.5f %.5f %.5f\n	translation %.5f %.5f %.5f\n	children [ \n"
+				% tuple([obj['name']] + scale + rotation + location))
+		fl.write(vrml_format.formatShape(getAppearanceNode(obj), geometryArrays, None, shapeOptions))
+		for iChild in mapChildren.get(obj['name'], []):
+			writeObject(iChild)
+		if obj['transform']:
+			fl.write("\n ] } # end of transform for '%s'\n\n" % obj['name'])
+
+	try:
+		fl.write("#VRML V2.0 utf8\n#re-encoded by bake_cache.py from '%s'\n" % meta['blend'])
+		if options['globalScale'] != 1.0:
+			s = options['globalScale']
+			fl.write("DEF GLOBAL_SCALE Transform {\n scale %.5f %.5f %.5f\n children [\n" % (s,s,s))
+		for iObj in mapChildren.get(None, []):
+			writeObject(iObj)
+		if options['globalScale'] != 1.0:
+			fl.write("\n] } # GLOBAL_SCALE\n\n")
+
+		anim = meta.get('animation')
+		if anim:
+			timerDEF = "TIMER"
+			fl.write("\n DEF %s TimeSensor {\n	cycleInterval %.3f\n	loop %s\n}\n" % (timerDEF,
+				options['rAnimationDurationSec'], "TRUE" if options['fLoopAnimation'] else "FALSE"))
+
+			cFrames = anim['cFrames']
+			rgKeys = [iFrame / float(cFrames) for iFrame in range(cFrames)]
+			sPrecKey = ("%%.%if "% options['precisionKey']) + ", "
+			sPrecXYZW = 4*("%%.%if "% options['precisionXYZ']) + ", "
+			sPrecXYZ = 3*("%%.%if "% options['precisionXYZ']) + ", "
+			rTolChange = 0.5 * 10**-options['precisionXYZ']
+			for iObj, sName in enumerate(anim['objects']):
+				for sChannel, cComponents, sNodeType, sSuffix, sPrecValue, sField in (
+						('rotation', 4, "OrientationInterpolator", "OriInt", sPrecXYZW, "set_rotation"),
+						('translation', 3, "PositionInterpolator", "PosInt", sPrecXYZ, "set_translation"),
+						('scale', 3, "PositionInterpolator", "ScaleInt", sPrecXYZ, "scale")):
+					values = cache.getArray("anim." + sChannel)[iObj*cFrames*cComponents:(iObj+1)*cFrames*cComponents]
+					# only what changes more than the written precision
+					if max([max(values[i::cComponents]) - min(values[i::cComponents]) for i in range(cComponents)]) <= rTolChange:
+						continue
+					if sChannel == 'rotation':
+						rgValues = vrml_format.getAxisAngles(values)
+					else:
+						rgValues = list(zip(*[values[i::cComponents] for i in range(cComponents)]))
+					fl.write(vrml_format.formatInterpolator(sNodeType, "%s_%s" % (sName, sSuffix), rgKeys, rgValues,
+						None, sPrecValue, sPrecKey, timerDEF, sName, sField))
+	finally:
+		fl.close()
+
+
+def main(rgArgs):
+	import argparse
+	parser = argparse.ArgumentParser(description="Write .md2/.wrl files from a bake cache (without blender).")
+	parser.add_argument("cache")
+	parser.add_argument("output")
+	parser.add_argument("--scale", type=float, help="md2: scale (blender units -> md2 units)")
+	parser.add_argument("--precision", type=int, help="vrml: digits of the coordinates")
+	parser.add_argument("--uv-precision", type=int, help="vrml: digits of the texture coordinates")
+	parser.add_argument("--normal-precision", type=int, help="vrml: digits of the normals")
+	parser.add_argument("--key-precision", type=int, help="vrml: digits of the interpolator keys")
+	parser.add_argument("--duration", type=float, help="vrml: seconds of the animation")
+	parser.add_argument("--loop", type=int, choices=[0, 1], help="vrml: loop the animation")
+	parser.add_argument("--global-scale", type=float, help="vrml: scale of the whole scene")
+	args = parser.parse_args(rgArgs)
+
+	sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+	cache = BakeCache(args.cache)
+	try:
+		if 'md2' in cache.meta:
+			encodeMD2(cache, args.output, args.scale)
+		else:
+			mapOptions = {}
+			for sOption, value in (('precisionXYZ', args.precision), ('precisionUV', args.uv_precision),
+					('precisionNormal', args.normal_precision), ('precisionKey', args.key_precision),
+					('rAnimationDurationSec', args.duration), ('globalScale', args.global_scale),
+					('fLoopAnimation', None if args.loop is None else bool(args.loop))):
+				if value is not None:
+					mapOptions[sOption] = value
+			encodeVRML(cache, args.output, mapOptions)
+	finally:
+		cache.close()
+
+
+if __name__ == "__main__":
+	main(sys.argv[1:])
@@ -0,0 +1,322 @@
+# ***** BEGIN GPL LICENSE BLOCK *****
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+
+# ***** END GPL LICENCE BLOCK *****
+
+# batch export of many .blend files with background blender processes.
+#
+# as driver (plain python):
+#   python batch_export.py manifest.json [-j 4] [--blender /path/to/blender] [--report report.json]
+#
+# the manifest is a list of jobs (or {"jobs": [...]}), e.g.
+#   [ { "blend": "models/robot.blend", "objects": ["Robot"], "format": "MD2",
+#       "output": "out/robot.md2", "options": { "fExportAnimation": true } },
+#     { "blend": "models/hall.blend", "format": "VRML", "output": "out/hall.wrl" },
+#     { "blend": "models/robot.blend", "objects": ["Robot"], "format": "MD2+VRML",
+#       "output": "out/robot.md2", "outputVRML": "out/robot.wrl", "optionsVRML": { "fExportAnimation": true } } ]
+# (no "objects": all selectable objects of the scene; relative paths are
+# relative to the manifest)
+#
+# each job runs in its own blender as
+#   blender -b file.blend --python batch_export.py -- --job job.json --result result.json
+# which is the other half of this file: it loads the exporters (next to this
+# file), selects the objects and calls the operator without invoke.
+
+import sys
+import os
+import json
+import time
+import tempfile
+
+try:
+	import bpy
+except ImportError:
+	bpy = None
+
+# format -> (module next to this file, operator in bpy.ops)
+mapFormats = {
+	'MD2' : ('md2_export_263', 'export_quake.md2'),
+	'VRML' : ('vrml_export_263', 'export.wrl'),
+}
+
+
+############ inside blender ############
+
+def getOperator(sFormat):
+	"""the export operator of a format, loads the exporter (next to this
+	file, not necessarily installed as addon) if necessary"""
+	sModule, sOperator = mapFormats[sFormat]
+
+	dirHere = os.path.dirname(os.path.abspath(__file__))
+	if dirHere not in sys.path:
+		sys.path.insert(0, dirHere)
+	module = __import__(sModule)
+	sCategory, sName = sOperator.split(".")
+	if not hasattr(bpy.types, "%s_OT_%s" % (sCategory.upper(), sName)):
+		module.register()
+	return getattr(getattr(bpy.ops, sCategory), sName), module
+
+def selectObjects(job):
+	"""selects the objects of the job (all if none are given), returns the
+	names of the missing ones"""
+	scene = bpy.context.scene
+	if bpy.context.mode != 'OBJECT':
+		bpy.ops.object.mode_set(mode='OBJECT', toggle=False)
+
+	rgNames = job.get('objects')
+	rgObjects = [obj for obj in scene.objects if not rgNames or obj.name in rgNames]
+	rgMissing = [sName for sName in (rgNames or []) if sName not in scene.objects]
+
+	for obj in scene.objects:
+		obj.select = obj in rgObjects
+	if rgObjects:
+		scene.objects.active = rgObjects[0]
+	return rgMissing
+
+def runJob(job):
+	"""exports one job in the current blender file, returns the result dict"""
+	if job['format'] == 'MD2+VRML':
+		return runCombinedJob(job)
+
+	operator, module = getOperator(job['format'])
+	rgMissing = selectObjects(job)
+	if rgMissing:
+		return { 'status' : 'FAILED', 'error' : "Missing object(s) '%s'" % "', '".join(rgMissing) }
+
+	rgResult = operator('EXEC_DEFAULT', filepath=job['output'], **job.get('options', {}))
+	result = { 'status' : list(rgResult)[0] if rgResult else 'FAILED' }
+	if job['format'] == 'VRML':
+		result['inlineFiles'] = list(module.Export_VRML.rgLastInlineFiles)
+	return result
+
+def runCombinedJob(job):
+	"""exports one object as md2 ('output', 'options') and as vrml
+	('outputVRML', 'optionsVRML'), see exportMD2AndVRML"""
+	rgMissing = selectObjects(job)
+	if rgMissing:
+		return { 'status' : 'FAILED', 'error' : "Missing object(s) '%s'" % "', '".join(rgMissing) }
+
+	rgResultMD2, rgResultVRML, rgInlineFiles = exportMD2AndVRML(job['output'], job['outputVRML'],
+		job.get('options'), job.get('optionsVRML'))
+	rgStatus = set(rgResultMD2[:1] + rgResultVRML[:1])
+	return { 'status' : rgStatus.pop() if len(rgStatus) == 1 else 'FAILED',
+		'statusMD2' : rgResultMD2, 'statusVRML' : rgResultVRML, 'inlineFilesVRML' : rgInlineFiles }
+
+def exportMD2AndVRML(fnMD2, fnVRML, optionsMD2=None, optionsVRML=None):
+	"""exports the selected object as md2 and as vrml (options: the operator
+	properties) with one shared frame_set sweep: the vrml export samples its
+	frames while the md2 export sets them. only the evaluation of the scene
+	per frame is shared, each export still prepares and evaluates its own mesh
+	(the md2 one needs its triangulated copy). also for scripts in blender,
+	with the directory of the exporters in sys.path:
+	  import batch_export
+	  batch_export.exportMD2AndVRML("/out/robot.md2", "/out/robot.wrl", None, { 'fExportAnimation' : True })
+	returns the results of both operators and the inline files of the vrml export"""
+	operatorMD2, moduleMD2 = getOperator('MD2')
+	operatorVRML, moduleVRML = getOperator('VRML')
+	scene = bpy.context.scene
+	rgSelected = [obj.name for obj in scene.objects if obj.select]
+	objActive = scene.objects.active
+	rgResultMD2 = []
+
+	def exportMD2():
+		rgResultMD2.extend(operatorMD2('EXEC_DEFAULT', filepath=fnMD2, **(optionsMD2 or {})))
+
+	def sweepFrames(rgFrames, fnSampleFrame):
+		# the md2 export sets the frames 1 .. number of frames of the scene
+		mapSamples = dict([(iFrame, iSample) for iSample, iFrame in enumerate(rgFrames)])
+		def sampleFrames(rgFramesHere):
+			for iFrame in rgFramesHere:
+				scene.frame_set(iFrame)
+				fnSampleFrame(mapSamples.pop(iFrame))
+
+		sampleFrames([iFrame for iFrame in rgFrames if iFrame < 1])
+		def onFrame(iFrame):
+			if iFrame in mapSamples:
+				fnSampleFrame(mapSamples.pop(iFrame))
+		moduleMD2.MD2.fnFrameCallback = onFrame
+		exportMD2()
+		moduleMD2.MD2.fnFrameCallback = None
+		sampleFrames(sorted(mapSamples.keys()))
+
+	# (the hooks are class attributes: whatever happens, the next export must not see them)
+	try:
+		moduleVRML.Export_VRML.fnSweepFrames = sweepFrames
+		rgResultVRML = list(operatorVRML('EXEC_DEFAULT', filepath=fnVRML, **(optionsVRML or {})))
+		moduleVRML.Export_VRML.fnSweepFrames = None
+
+		# (no animation in the vrml export: nothing was swept)
+		if not rgResultMD2:
+			for obj in scene.objects:
+				obj.select = obj.name in rgSelected
+			scene.objects.active = objActive
+			exportMD2()
+	finally:
+		moduleMD2.MD2.fnFrameCallback = None
+		moduleVRML.Export_VRML.fnSweepFrames = None
+
+	return list(rgResultMD2), rgResultVRML, list(moduleVRML.Export_VRML.rgLastInlineFiles)
+
+def mainBlender(rgArgs):
+	fnJob = rgArgs[rgArgs.index("--job") + 1]
+	fnResult = rgArgs[rgArgs.index("--result") + 1]
+	with open(fnJob, "rt") as fl:
+		job = json.load(fl)
+
+	try:
+		result = runJob(job)
+	except Exception as e:
+		import traceback
+		traceback.print_exc()
+		result = { 'status' : 'FAILED', 'error' : "%s: %s" % (type(e).__name__, e) }
+
+	with open(fnResult, "wt") as fl:
+		json.dump(result, fl)
+
+
+############ driver ############
+
+def getOutputSize(fnOutput, rgInlineFiles=None):
+	"""size of the output file, including the inline files the export wrote
+	next to it (their names as in the result of the job)"""
+	if not os.path.exists(fnOutput):
+		return None
+	cBytes = os.path.getsize(fnOutput)
+	dirOutput = os.path.dirname(fnOutput) or "."
+	for fn in rgInlineFiles or []:
+		fn = os.path.join(dirOutput, fn)
+		if os.path.exists(fn):
+			cBytes += os.path.getsize(fn)
+	return cBytes
+
+def runBlender(fnBlender, job, rTimeout=None):
+	"""runs one job in a background blender, returns its report entry"""
+	import subprocess
+
+	dirTemp = tempfile.mkdtemp(prefix="batch_export_")
+	fnJob = os.path.join(dirTemp, "job.json")
+	fnResult = os.path.join(dirTemp, "result.json")
+	with open(fnJob, "wt") as fl:
+		json.dump(job, fl)
+
+	report = { 'blend' : job['blend'], 'format' : job['format'], 'output' : job['output'] }
+	timeStart = time.time()
+	try:
+		process = subprocess.Popen([fnBlender, "-b", job['blend'], "--python", os.path.abspath(__file__),
+			"--", "--job", fnJob, "--result", fnResult], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+		# the timeout kills blender from a timer thread (no communicate(timeout=)
+		# in the python 3.2 of blender 2.63, this also runs inside blender)
+		rgTimedOut = []
+		timer = None
+		if rTimeout:
+			def kill():
+				rgTimedOut.append(True)
+				try:
+					process.kill()
+				except OSError:
+					pass # (just exited)
+			import threading
+			timer = threading.Timer(rTimeout, kill)
+			timer.start()
+		try:
+			sOutput = process.communicate()[0]
+		finally:
+			if timer:
+				timer.cancel()
+		if rgTimedOut:
+			report['error'] = "Timeout after %.0f s" % rTimeout
+		report['returncode'] = process.returncode
+
+		if os.path.exists(fnResult):
+			with open(fnResult, "rt") as fl:
+				report.update(json.load(fl))
+		else:
+			report['status'] = 'FAILED'
+			report.setdefault('error', "Blender did not run the job")
+			report['log'] = sOutput.decode("utf-8", "replace")[-4000:]
+	except OSError as e:
+		report['status'] = 'FAILED'
+		report['error'] = "Could not start blender: %s" % e
+	finally:
+		for fn in (fnJob, fnResult):
+			if os.path.exists(fn):
+				os.remove(fn)
+		os.rmdir(dirTemp)
+
+	report['seconds'] = round(time.time() - timeStart, 3)
+	report['bytes'] = getOutputSize(job['output'], report.get('inlineFiles'))
+	if 'outputVRML' in job:
+		report['bytesVRML'] = getOutputSize(job['outputVRML'], report.get('inlineFilesVRML'))
+	return report
+
+def loadManifest(fnManifest):
+	"""the jobs of a manifest, with paths made absolute"""
+	with open(fnManifest, "rt") as fl:
+		manifest = json.load(fl)
+	rgJobs = manifest['jobs'] if isinstance(manifest, dict) else manifest
+
+	dirManifest = os.path.dirname(os.path.abspath(fnManifest))
+	for job in rgJobs:
+		job['format'] = job['format'].upper()
+		if job['format'] not in mapFormats and job['format'] != 'MD2+VRML':
+			raise ValueError("Unknown format '%s' (supported: %s, MD2+VRML)" % (job['format'], ", ".join(sorted(mapFormats))))
+		for sKey in ('blend', 'output', 'outputVRML'):
+			if sKey not in job:
+				continue
+			job[sKey] = os.path.join(dirManifest, job[sKey])
+			if sKey != 'blend' and not os.path.isdir(os.path.dirname(job[sKey])):
+				os.makedirs(os.path.dirname(job[sKey]))
+	return rgJobs
+
+def runJobs(rgJobs, fnBlender, cProcesses, rTimeout=None):
+	"""runs the jobs in cProcesses blenders at a time, returns the reports in job order"""
+	from concurrent.futures import ThreadPoolExecutor
+	with ThreadPoolExecutor(max_workers=max(1, cProcesses)) as executor:
+		rgFutures = [executor.submit(runBlender, fnBlender, job, rTimeout) for job in rgJobs]
+		rgReports = []
+		for future in rgFutures:
+			report = future.result()
+			print("%-8s %7.2fs  %s -> %s" % (report.get('status'), report['seconds'], report['blend'], report['output']))
+			rgReports.append(report)
+	return rgReports
+
+def mainDriver(rgArgs):
+	import argparse
+	parser = argparse.ArgumentParser(description="Export many .blend files with background blender processes.")
+	parser.add_argument("manifest", help="JSON list of jobs (blend, objects, format, output, options)")
+	parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count() if hasattr(os, "cpu_count") else 2,
+		help="number of blender processes at a time")
+	parser.add_argument("--blender", default=os.environ.get("BLENDER", "blender"), help="blender executable")
+	parser.add_argument("--timeout", type=float, default=None, help="seconds per job")
+	parser.add_argument("--report", default="batch_export_report.json", help="JSON report of all jobs")
+	args = parser.parse_args(rgArgs)
+
+	rgJobs = loadManifest(args.manifest)
+	timeStart = time.time()
+	rgReports = runJobs(rgJobs, args.blender, args.jobs, args.timeout)
+
+	cFailed = len([report for report in rgReports if report.get('status') != 'FINISHED'])
+	with open(args.report, "wt") as fl:
+		json.dump({ 'seconds' : round(time.time() - timeStart, 3), 'failed' : cFailed, 'jobs' : rgReports }, fl, indent=1)
+	print("%i of %i jobs failed, report: %s" % (cFailed, len(rgReports), args.report))
+	return 1 if cFailed else 0
+
+
+if __name__ == "__main__":
+	if bpy:
+		mainBlender(sys.argv[sys.argv.index("--") + 1:] if "--" in sys.argv else [])
+	else:
+		sys.exit(mainDriver(sys.argv[1:]))
@@ -0,0 +1,259 @@
+# ***** BEGIN GPL LICENSE BLOCK *****
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+
+# ***** END GPL LICENCE BLOCK *****
+
+# export server: keeps background blenders with the exporters loaded and
+# their .blend open, so a request does not pay for blender startup and
+# file loading.
+#
+#   python export_server.py [--port 7862] [--blender /path/to/blender] [--max-files 4]
+#
+# a client connects to 127.0.0.1:port and sends one JSON job per line, the
+# same as in a batch_export.py manifest (absolute paths), e.g.
+#   {"blend": "/models/robot.blend", "objects": ["Robot"], "format": "MD2", "output": "/out/robot.md2"}
+# and gets one JSON result per line back, in order ({"status": "FINISHED", "seconds": ...}).
+# {"cmd": "status"} lists the open files.
+#
+# blender only has one file open at a time: every recently used .blend has
+# its own blender ("worker"), the least recently used one is closed when
+# --max-files are open. a worker reloads its file when it changed on disk
+# or a job failed in it, and restores the frame and selection after every job.
+#
+# the worker is the other half of this file:
+#   blender -b file.blend --python export_server.py -- --worker
+
+import sys
+import os
+import json
+import time
+import threading
+
+try:
+	import bpy
+except ImportError:
+	bpy = None
+
+# prefix of the result lines of a worker (blender and the exporters print to stdout, too)
+sResultMarker = "@@export_server@@ "
+
+
+############ inside blender ############
+
+def getState():
+	"""what a job changes in the file: the frame and the selection"""
+	scene = bpy.context.scene
+	return { 'frame' : scene.frame_current,
+		'selected' : [obj.name for obj in scene.objects if obj.select],
+		'active' : scene.objects.active.name if scene.objects.active else None }
+
+def setState(state):
+	"""restores getState() for the next job"""
+	scene = bpy.context.scene
+	if bpy.context.mode != 'OBJECT':
+		bpy.ops.object.mode_set(mode='OBJECT', toggle=False)
+	for obj in scene.objects:
+		obj.select = obj.name in state['selected']
+	scene.objects.active = scene.objects.get(state['active']) if state['active'] else None
+	if scene.frame_current != state['frame']:
+		scene.frame_set(state['frame'])
+
+def mainWorker():
+	dirHere = os.path.dirname(os.path.abspath(__file__))
+	if dirHere not in sys.path:
+		sys.path.insert(0, dirHere)
+	import batch_export
+
+	fnBlend = bpy.data.filepath
+	timeModified = os.path.getmtime(fnBlend)
+	# a failed job may have left anything behind (temporary objects, other modes...)
+	fReload = False
+
+	for sLine in iter(sys.stdin.readline, ""):
+		if not sLine.strip():
+			continue
+		timeStart = time.time()
+		try:
+			job = json.loads(sLine)
+
+			# the file changed since we loaded it (or the last job failed)?
+			if fReload or os.path.getmtime(fnBlend) != timeModified:
+				timeModified = os.path.getmtime(fnBlend)
+				fReload = True
+				bpy.ops.wm.open_mainfile(filepath=fnBlend)
+				fReload = False
+
+			state = getState()
+			try:
+				result = batch_export.runJob(job)
+			finally:
+				setState(state)
+		except Exception as e:
+			import traceback
+			traceback.print_exc()
+			result = { 'status' : 'FAILED', 'error' : "%s: %s" % (type(e).__name__, e) }
+		if result.get('status') != 'FINISHED':
+			fReload = True
+		result['seconds'] = round(time.time() - timeStart, 3)
+
+		sys.stdout.write(sResultMarker + json.dumps(result) + "\n")
+		sys.stdout.flush()
+
+
+############ server ############
+
+class Worker:
+	"""a background blender with one .blend open, runs one job at a time"""
+
+	def __init__(self, fnBlender, fnBlend):
+		import subprocess
+		self.fnBlend = fnBlend
+		self.lock = threading.Lock()
+		self.process = subprocess.Popen([fnBlender, "-b", fnBlend, "--python", os.path.abspath(__file__),
+			"--", "--worker"], stdin=subprocess.PIPE, stdout=subprocess.PIPE, universal_newlines=True)
+
+	def run(self, job):
+		"""sends the job and waits for its result (the log lines in between are dropped)"""
+		with self.lock:
+			self.process.stdin.write(json.dumps(job) + "\n")
+			self.process.stdin.flush()
+			for sLine in iter(self.process.stdout.readline, ""):
+				if sLine.startswith(sResultMarker):
+					return json.loads(sLine[len(sResultMarker):])
+		return { 'status' : 'FAILED', 'error' : "Blender exited (%s)" % self.process.wait() }
+
+	def isAlive(self):
+		return self.process.poll() is None
+
+	def close(self):
+		# (waits for a running job)
+		with self.lock:
+			self.process.stdin.close()
+			# (no wait(timeout=) in python 3.2)
+			timeEnd = time.time() + 10
+			while self.process.poll() is None and time.time() < timeEnd:
+				time.sleep(0.1)
+			if self.process.poll() is None:
+				self.process.kill()
+				self.process.wait()
+
+
+class WorkerPool:
+	"""the workers by .blend file, least recently used first"""
+
+	def __init__(self, fnBlender, cMaxFiles):
+		import collections
+		self.fnBlender = fnBlender
+		self.cMaxFiles = cMaxFiles
+		self.mapWorkers = collections.OrderedDict()
+		self.lock = threading.Lock()
+
+	def getWorker(self, fnBlend):
+		rgEvicted = []
+		with self.lock:
+			worker = self.mapWorkers.pop(fnBlend, None)
+			if worker and not worker.isAlive():
+				worker = None
+			if not worker:
+				while len(self.mapWorkers) >= self.cMaxFiles:
+					rgEvicted.append(self.mapWorkers.popitem(last=False)[1])
+				worker = Worker(self.fnBlender, fnBlend)
+			self.mapWorkers[fnBlend] = worker
+
+		for workerEvicted in rgEvicted:
+			print("Closing '%s'" % workerEvicted.fnBlend)
+			workerEvicted.close()
+		return worker
+
+	def run(self, job):
+		timeStart = time.time()
+		result = self.getWorker(os.path.realpath(job['blend'])).run(job)
+		result['secondsTotal'] = round(time.time() - timeStart, 3)
+		return result
+
+	def getStatus(self):
+		with self.lock:
+			return { 'files' : list(self.mapWorkers.keys()) }
+
+	def close(self):
+		with self.lock:
+			rgWorkers = list(self.mapWorkers.values())
+			self.mapWorkers.clear()
+		for worker in rgWorkers:
+			worker.close()
+
+
+def serve(pool, iPort):
+	import socketserver
+
+	class Handler(socketserver.StreamRequestHandler):
+		def handle(self):
+			for sLine in iter(self.rfile.readline, b""):
+				if not sLine.strip():
+					continue
+				try:
+					job = json.loads(sLine.decode("utf-8"))
+					if job.get('cmd') == 'status':
+						result = pool.getStatus()
+					else:
+						result = pool.run(job)
+				except Exception as e:
+					result = { 'status' : 'FAILED', 'error' : "%s: %s" % (type(e).__name__, e) }
+				self.wfile.write((json.dumps(result) + "\n").encode("utf-8"))
+				self.wfile.flush()
+
+	socketserver.ThreadingTCPServer.allow_reuse_address = True
+	server = socketserver.ThreadingTCPServer(("127.0.0.1", iPort), Handler)
+	server.daemon_threads = True
+	print("Export server on 127.0.0.1:%i" % iPort)
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		server.server_close()
+		pool.close()
+
+def request(rgJobs, iPort=7862):
+	"""sends jobs to a running server, yields the results as they arrive"""
+	import socket
+	sock = socket.create_connection(("127.0.0.1", iPort))
+	try:
+		for job in rgJobs:
+			sock.sendall((json.dumps(job) + "\n").encode("utf-8"))
+		sock.shutdown(socket.SHUT_WR)
+		with sock.makefile("rb") as fl:
+			for sLine in fl:
+				yield json.loads(sLine.decode("utf-8"))
+	finally:
+		sock.close()
+
+def mainServer(rgArgs):
+	import argparse
+	parser = argparse.ArgumentParser(description="Serve export jobs with warm background blenders.")
+	parser.add_argument("--port", type=int, default=7862)
+	parser.add_argument("--blender", default=os.environ.get("BLENDER", "blender"), help="blender executable")
+	parser.add_argument("--max-files", type=int, default=4, help="blenders (= open .blend files) at most")
+	args = parser.parse_args(rgArgs)
+
+	serve(WorkerPool(args.blender, max(1, args.max_files)), args.port)
+
+
+if __name__ == "__main__":
+	if bpy:
+		mainWorker()
+	else:
+		mainServer(sys.argv[1:])
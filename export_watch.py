@@ -0,0 +1,279 @@
+# ***** BEGIN GPL LICENSE BLOCK *****
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+
+# ***** END GPL LICENCE BLOCK *****
+
+# watch mode of the 2.63 exporters: an export with "Watch" checked is
+# repeated whenever its objects change (or the file is saved), once they
+# stopped changing for rDebounceSeconds.
+#
+# the repeated export runs in a background blender (see batch_export.py) on
+# a copy of the current file, incrementally (only the changed shapes/frames
+# are encoded again), so the UI is not blocked while it runs. the copy is
+# saved by a modal timer operator (WatchTimer), not in the scene update
+# handler, which only notes the changes.
+#
+# both exporters call register()/unregister() of this module from their own.
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import threading
+
+import bpy
+
+# seconds without changes before the export is repeated
+rDebounceSeconds = 1.0
+
+# handlers survive loading another file (where available)
+persistent = getattr(bpy.app.handlers, "persistent", lambda fn: fn)
+
+
+class Watch:
+	"""one watched export: the format, object names and output of the job,
+	and the options of the operator"""
+
+	def __init__(self, sFormat, rgObjectNames, fnOutput, options):
+		self.sFormat = sFormat
+		self.rgObjectNames = rgObjectNames
+		self.fnOutput = fnOutput
+		self.options = options
+		# time of the last change which is not exported yet (None: up to date)
+		self.timeChanged = None
+		# the first update after adding the watch comes from its own export
+		self.fSkipUpdate = True
+
+	def getJob(self, fnBlend, fnSource):
+		options = dict(self.options)
+		options['fIncremental'] = True
+		if self.sFormat == 'VRML':
+			# (the output names the original file, not the copy: unchanged outputs stay unchanged)
+			options['sSourceFile'] = fnSource
+		return { 'blend' : fnBlend, 'objects' : self.rgObjectNames, 'format' : self.sFormat,
+			'output' : self.fnOutput, 'options' : options }
+
+
+# output file -> Watch
+mapWatches = {}
+# the background export: (thread, watches) or None
+running = None
+# reports of finished background exports, printed in the main thread
+rgReports = []
+# set while the copy for the background blender is saved (it calls the save handlers, too)
+fSaving = False
+# whether the WatchTimer operator runs
+fTimerRunning = False
+# the frame of the last scene update (see onSceneUpdate)
+iLastFrame = None
+cRegistered = 0
+
+
+def getOptions(operator, rgIgnore=()):
+	"""the properties of an operator as JSON values (for the background job)"""
+	options = {}
+	for sKey in operator.properties.keys():
+		if sKey in rgIgnore:
+			continue
+		value = getattr(operator, sKey)
+		if not isinstance(value, (bool, int, float, str)):
+			value = list(value)
+		options[sKey] = value
+	return options
+
+def addWatch(sFormat, rgObjectNames, fnOutput, options):
+	fnOutput = os.path.abspath(fnOutput)
+	mapWatches[fnOutput] = Watch(sFormat, list(rgObjectNames), fnOutput, options)
+	print("Watching '%s' for %s" % ("', '".join(rgObjectNames), fnOutput))
+	if not fTimerRunning and not bpy.app.background and bpy.context.window:
+		bpy.ops.export.watch_timer('INVOKE_DEFAULT')
+
+def removeWatch(fnOutput):
+	if mapWatches.pop(os.path.abspath(fnOutput), None):
+		print("Stopped watching for %s" % fnOutput)
+
+def isChanged(obj):
+	# (is_updated is set by the dependency graph for the scene update it was changed in)
+	return getattr(obj, "is_updated", False) or getattr(obj, "is_updated_data", False)
+
+
+@persistent
+def onSceneUpdate(scene):
+	global iLastFrame
+	if not mapWatches:
+		return
+
+	# animated objects are updated on every frame change (playback, scrubbing):
+	# these updates are no edits
+	if scene.frame_current != iLastFrame:
+		iLastFrame = scene.frame_current
+		for watch in mapWatches.values():
+			watch.fSkipUpdate = False
+		return
+
+	timeNow = time.time()
+	for watch in mapWatches.values():
+		fChanged = False
+		for sName in watch.rgObjectNames:
+			obj = scene.objects.get(sName)
+			if obj and isChanged(obj):
+				fChanged = True
+		if watch.fSkipUpdate:
+			watch.fSkipUpdate = False
+		elif fChanged:
+			watch.timeChanged = timeNow
+
+def runDueExports():
+	"""starts the exports which stopped changing for rDebounceSeconds (see WatchTimer)"""
+	global running
+
+	while rgReports:
+		report = rgReports.pop(0)
+		print("Watch export %s: %s (%.2fs)%s" % (report['output'], report.get('status'), report['seconds'],
+			" - " + report['error'] if 'error' in report else ""))
+
+	timeNow = time.time()
+	if running:
+		if running[0].is_alive():
+			return
+		running = None
+
+	rgDue = [watch for watch in mapWatches.values()
+		if watch.timeChanged is not None and timeNow - watch.timeChanged >= rDebounceSeconds]
+	if rgDue:
+		startExports(rgDue)
+
+@persistent
+def onSave(dummy):
+	if fSaving:
+		return
+	for watch in mapWatches.values():
+		watch.timeChanged = time.time()
+
+@persistent
+def onLoad(dummy):
+	global fTimerRunning
+	# the watched objects were in the previous file (and the timer is gone with its window)
+	mapWatches.clear()
+	fTimerRunning = False
+
+def startExports(rgWatches):
+	"""saves a copy of the current state and exports rgWatches from it in a
+	background blender (in a thread: the UI goes on)"""
+	global running, fSaving
+	dirHere = os.path.dirname(os.path.abspath(__file__))
+	if dirHere not in sys.path:
+		sys.path.insert(0, dirHere)
+	import batch_export
+
+	for watch in rgWatches:
+		watch.timeChanged = None
+
+	dirTemp = tempfile.mkdtemp(prefix="export_watch_")
+	fnBlend = os.path.join(dirTemp, "watch.blend")
+	fSaving = True
+	try:
+		bpy.ops.wm.save_as_mainfile(filepath=fnBlend, copy=True, relative_remap=True, check_existing=False)
+	except Exception as e:
+		print("Watch export: could not save a copy (%s)" % e)
+		shutil.rmtree(dirTemp, ignore_errors=True)
+		return
+	finally:
+		fSaving = False
+
+	rgJobs = [watch.getJob(fnBlend, bpy.data.filepath) for watch in rgWatches]
+	def run():
+		try:
+			for job in rgJobs:
+				rgReports.append(batch_export.runBlender(bpy.app.binary_path, job))
+		finally:
+			shutil.rmtree(dirTemp, ignore_errors=True)
+
+	thread = threading.Thread(target=run)
+	thread.daemon = True
+	thread.start()
+	running = (thread, rgWatches)
+	print("Watch export of %i file(s) started" % len(rgJobs))
+
+
+class WatchTimer(bpy.types.Operator):
+	"""Start the due watch exports (runs as long as there are watches)"""
+	bl_idname = "export.watch_timer"
+	bl_label = "Watch export timer"
+
+	def invoke(self, context, event):
+		global fTimerRunning
+		fTimerRunning = True
+		self.timer = context.window_manager.event_timer_add(0.25, context.window)
+		context.window_manager.modal_handler_add(self)
+		return {'RUNNING_MODAL'}
+
+	def modal(self, context, event):
+		if not mapWatches:
+			return self.cancel(context)
+		if event.type == 'TIMER':
+			runDueExports()
+		return {'PASS_THROUGH'}
+
+	def cancel(self, context):
+		global fTimerRunning
+		fTimerRunning = False
+		context.window_manager.event_timer_remove(self.timer)
+		return {'CANCELLED'}
+
+class StopWatchExports(bpy.types.Operator):
+	"""Stop repeating the exports with "Watch" checked"""
+	bl_idname = "export.watch_stop"
+	bl_label = "Stop watch exports"
+
+	def execute(self, context):
+		cWatches = len(mapWatches)
+		mapWatches.clear()
+		self.report({'INFO'}, "Stopped %i watch export(s)" % cWatches)
+		return {'FINISHED'}
+
+def menuCB(self, context):
+	if mapWatches:
+		self.layout.operator(StopWatchExports.bl_idname, text="Stop watch exports (%i)" % len(mapWatches))
+
+
+# both exporters register this module: the first one adds the handlers, the last one removes them
+def register():
+	global cRegistered
+	cRegistered += 1
+	if cRegistered > 1:
+		return
+	bpy.utils.register_class(WatchTimer)
+	bpy.utils.register_class(StopWatchExports)
+	bpy.types.INFO_MT_file_export.append(menuCB)
+	bpy.app.handlers.scene_update_post.append(onSceneUpdate)
+	bpy.app.handlers.save_post.append(onSave)
+	bpy.app.handlers.load_post.append(onLoad)
+
+def unregister():
+	global cRegistered
+	cRegistered -= 1
+	if cRegistered > 0:
+		return
+	mapWatches.clear()
+	for handlers, fn in ((bpy.app.handlers.scene_update_post, onSceneUpdate),
+			(bpy.app.handlers.save_post, onSave), (bpy.app.handlers.load_post, onLoad)):
+		if fn in handlers:
+			handlers.remove(fn)
+	bpy.types.INFO_MT_file_export.remove(menuCB)
+	bpy.utils.unregister_class(StopWatchExports)
+	bpy.utils.unregister_class(WatchTimer)
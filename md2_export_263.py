@@ -40,460 +40,319 @@ import math
 from math import pi
 import mathutils
 
-import struct
 import random
 import os
+import sys
 import shutil
+import json
+import tempfile
+import io
+import time
+
+if __name__ == "__main__":
+	# run as frame shard (blender --python): the helper modules are next to this file
+	sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import md2_format
+import bake_cache
+import export_watch
+import modal_export
+import asset_copy
+import texture_convert
 
 
-MD2_NORMALS=((-0.525731, 0.000000, 0.850651),
-             (-0.442863, 0.238856, 0.864188),
-             (-0.295242, 0.000000, 0.955423),
-             (-0.309017, 0.500000, 0.809017),
-             (-0.162460, 0.262866, 0.951056),
-             ( 0.000000, 0.000000, 1.000000),
-             ( 0.000000, 0.850651, 0.525731),
-             (-0.147621, 0.716567, 0.681718),
-             ( 0.147621, 0.716567, 0.681718),
-             ( 0.000000, 0.525731, 0.850651),
-             ( 0.309017, 0.500000, 0.809017),
-             ( 0.525731, 0.000000, 0.850651),
-             ( 0.295242, 0.000000, 0.955423),
-             ( 0.442863, 0.238856, 0.864188),
-             ( 0.162460, 0.262866, 0.951056),
-             (-0.681718, 0.147621, 0.716567),
-             (-0.809017, 0.309017, 0.500000),
-             (-0.587785, 0.425325, 0.688191),
-             (-0.850651, 0.525731, 0.000000),
-             (-0.864188, 0.442863, 0.238856),
-             (-0.716567, 0.681718, 0.147621),
-             (-0.688191, 0.587785, 0.425325),
-             (-0.500000, 0.809017, 0.309017),
-             (-0.238856, 0.864188, 0.442863),
-             (-0.425325, 0.688191, 0.587785),
-             (-0.716567, 0.681718,-0.147621),
-             (-0.500000, 0.809017,-0.309017),
-             (-0.525731, 0.850651, 0.000000),
-             ( 0.000000, 0.850651,-0.525731),
-             (-0.238856, 0.864188,-0.442863),
-             ( 0.000000, 0.955423,-0.295242),
-             (-0.262866, 0.951056,-0.162460),
-             ( 0.000000, 1.000000, 0.000000),
-             ( 0.000000, 0.955423, 0.295242),
-             (-0.262866, 0.951056, 0.162460),
-             ( 0.238856, 0.864188, 0.442863),
-             ( 0.262866, 0.951056, 0.162460),
-             ( 0.500000, 0.809017, 0.309017),
-             ( 0.238856, 0.864188,-0.442863),
-             ( 0.262866, 0.951056,-0.162460),
-             ( 0.500000, 0.809017,-0.309017),
-             ( 0.850651, 0.525731, 0.000000),
-             ( 0.716567, 0.681718, 0.147621),
-             ( 0.716567, 0.681718,-0.147621),
-             ( 0.525731, 0.850651, 0.000000),
-             ( 0.425325, 0.688191, 0.587785),
-             ( 0.864188, 0.442863, 0.238856),
-             ( 0.688191, 0.587785, 0.425325),
-             ( 0.809017, 0.309017, 0.500000),
-             ( 0.681718, 0.147621, 0.716567),
-             ( 0.587785, 0.425325, 0.688191),
-             ( 0.955423, 0.295242, 0.000000),
-             ( 1.000000, 0.000000, 0.000000),
-             ( 0.951056, 0.162460, 0.262866),
-             ( 0.850651,-0.525731, 0.000000),
-             ( 0.955423,-0.295242, 0.000000),
-             ( 0.864188,-0.442863, 0.238856),
-             ( 0.951056,-0.162460, 0.262866),
-             ( 0.809017,-0.309017, 0.500000),
-             ( 0.681718,-0.147621, 0.716567),
-             ( 0.850651, 0.000000, 0.525731),
-             ( 0.864188, 0.442863,-0.238856),
-             ( 0.809017, 0.309017,-0.500000),
-             ( 0.951056, 0.162460,-0.262866),
-             ( 0.525731, 0.000000,-0.850651),
-             ( 0.681718, 0.147621,-0.716567),
-             ( 0.681718,-0.147621,-0.716567),
-             ( 0.850651, 0.000000,-0.525731),
-             ( 0.809017,-0.309017,-0.500000),
-             ( 0.864188,-0.442863,-0.238856),
-             ( 0.951056,-0.162460,-0.262866),
-             ( 0.147621, 0.716567,-0.681718),
-             ( 0.309017, 0.500000,-0.809017),
-             ( 0.425325, 0.688191,-0.587785),
-             ( 0.442863, 0.238856,-0.864188),
-             ( 0.587785, 0.425325,-0.688191),
-             ( 0.688191, 0.587785,-0.425325),
-             (-0.147621, 0.716567,-0.681718),
-             (-0.309017, 0.500000,-0.809017),
-             ( 0.000000, 0.525731,-0.850651),
-             (-0.525731, 0.000000,-0.850651),
-             (-0.442863, 0.238856,-0.864188),
-             (-0.295242, 0.000000,-0.955423),
-             (-0.162460, 0.262866,-0.951056),
-             ( 0.000000, 0.000000,-1.000000),
-             ( 0.295242, 0.000000,-0.955423),
-             ( 0.162460, 0.262866,-0.951056),
-             (-0.442863,-0.238856,-0.864188),
-             (-0.309017,-0.500000,-0.809017),
-             (-0.162460,-0.262866,-0.951056),
-             ( 0.000000,-0.850651,-0.525731),
-             (-0.147621,-0.716567,-0.681718),
-             ( 0.147621,-0.716567,-0.681718),
-             ( 0.000000,-0.525731,-0.850651),
-             ( 0.309017,-0.500000,-0.809017),
-             ( 0.442863,-0.238856,-0.864188),
-             ( 0.162460,-0.262866,-0.951056),
-             ( 0.238856,-0.864188,-0.442863),
-             ( 0.500000,-0.809017,-0.309017),
-             ( 0.425325,-0.688191,-0.587785),
-             ( 0.716567,-0.681718,-0.147621),
-             ( 0.688191,-0.587785,-0.425325),
-             ( 0.587785,-0.425325,-0.688191),
-             ( 0.000000,-0.955423,-0.295242),
-             ( 0.000000,-1.000000, 0.000000),
-             ( 0.262866,-0.951056,-0.162460),
-             ( 0.000000,-0.850651, 0.525731),
-             ( 0.000000,-0.955423, 0.295242),
-             ( 0.238856,-0.864188, 0.442863),
-             ( 0.262866,-0.951056, 0.162460),
-             ( 0.500000,-0.809017, 0.309017),
-             ( 0.716567,-0.681718, 0.147621),
-             ( 0.525731,-0.850651, 0.000000),
-             (-0.238856,-0.864188,-0.442863),
-             (-0.500000,-0.809017,-0.309017),
-             (-0.262866,-0.951056,-0.162460),
-             (-0.850651,-0.525731, 0.000000),
-             (-0.716567,-0.681718,-0.147621),
-             (-0.716567,-0.681718, 0.147621),
-             (-0.525731,-0.850651, 0.000000),
-             (-0.500000,-0.809017, 0.309017),
-             (-0.238856,-0.864188, 0.442863),
-             (-0.262866,-0.951056, 0.162460),
-             (-0.864188,-0.442863, 0.238856),
-             (-0.809017,-0.309017, 0.500000),
-             (-0.688191,-0.587785, 0.425325),
-             (-0.681718,-0.147621, 0.716567),
-             (-0.442863,-0.238856, 0.864188),
-             (-0.587785,-0.425325, 0.688191),
-             (-0.309017,-0.500000, 0.809017),
-             (-0.147621,-0.716567, 0.681718),
-             (-0.425325,-0.688191, 0.587785),
-             (-0.162460,-0.262866, 0.951056),
-             ( 0.442863,-0.238856, 0.864188),
-             ( 0.162460,-0.262866, 0.951056),
-             ( 0.309017,-0.500000, 0.809017),
-             ( 0.147621,-0.716567, 0.681718),
-             ( 0.000000,-0.525731, 0.850651),
-             ( 0.425325,-0.688191, 0.587785),
-             ( 0.587785,-0.425325, 0.688191),
-             ( 0.688191,-0.587785, 0.425325),
-             (-0.955423, 0.295242, 0.000000),
-             (-0.951056, 0.162460, 0.262866),
-             (-1.000000, 0.000000, 0.000000),
-             (-0.850651, 0.000000, 0.525731),
-             (-0.955423,-0.295242, 0.000000),
-             (-0.951056,-0.162460, 0.262866),
-             (-0.864188, 0.442863,-0.238856),
-             (-0.951056, 0.162460,-0.262866),
-             (-0.809017, 0.309017,-0.500000),
-             (-0.864188,-0.442863,-0.238856),
-             (-0.951056,-0.162460,-0.262866),
-             (-0.809017,-0.309017,-0.500000),
-             (-0.681718, 0.147621,-0.716567),
-             (-0.681718,-0.147621,-0.716567),
-             (-0.850651, 0.000000,-0.525731),
-             (-0.688191, 0.587785,-0.425325),
-             (-0.587785, 0.425325,-0.688191),
-             (-0.425325, 0.688191,-0.587785),
-             (-0.425325,-0.688191,-0.587785),
-             (-0.587785,-0.425325,-0.688191),
-             (-0.688191,-0.587785,-0.425325))
-
-			 
 class MD2:
+	# called with the frame number after each frame_set of the animation export,
+	# so other exporters can sample the same evaluation (only set by batch_export.exportMD2AndVRML)
+	fnFrameCallback = None
+
 	def __init__(self, options):
 		self.options = options
 		self.object = None
-		self.progressBarDisplayed = -10
+		self.bake = None
+		# the textures to copy next to the md2 file
+		self.assets = None
+		# incremental: hash -> frame block of the previous export, and the hashes of this one
+		self.mapPreviousFrames = None
+		self.rgFrameHashes = []
 		return
 
 	def setObject(self, object, scale=1.0):
 		self.object = object
 		self.scale = scale
 		
-	def write(self, filename):
-		self.version = 8
-
-		self.skinwidth = 2**10-1 #1023
-		self.skinheight = 2**10-1 #1023
-
-		# self.framesize : see below
-
+	def writeSteps(self, filename):
+		"""writes the md2 file, as generator which yields the progress (see modal_export.py)"""
 		mesh = self.object.data
 
-		skins = Util.getSkins(mesh)
-
-		self.num_skins = len(skins)
-		self.num_xyz = len(mesh.vertices)
-		self.num_st = len(mesh.tessfaces)*3
-		self.num_tris = len(mesh.tessfaces)
-		self.num_glcmds = self.num_tris * (1+3*3) + 1
-
 		self.num_frames = 1
 		if self.options.fExportAnimation:
 			self.num_frames = 1 + bpy.context.scene.frame_end - bpy.context.scene.frame_start
 
-		self.framesize = 40+4*self.num_xyz
-
-		self.ofs_skins = 68 # size of the header
-		self.ofs_st = self.ofs_skins + 64*self.num_skins
-		self.ofs_tris = self.ofs_st + 4*self.num_st
-		self.ofs_frames = self.ofs_tris + 12*self.num_tris
-		self.ofs_glcmds = self.ofs_frames + self.framesize*self.num_frames
-		self.ofs_end = self.ofs_glcmds + 4*self.num_glcmds
+		self.framesize = md2_format.getFrameSize(len(mesh.vertices))
 
-		file = open(filename, 'wb')
-		try:
-			# write header
-			bin = struct.pack('<4B16i', #bin = struct.pack('<4s16i',
-			                  ord('I'),
-			                  ord('D'),
-			                  ord('P'),
-			                  ord('2'),
-			                  self.version,
-			                  self.skinwidth,
-			                  self.skinheight,
-			                  self.framesize,
-			                  self.num_skins,
-			                  self.num_xyz,
-			                  self.num_st, #  number of texture coordinates
-			                  self.num_tris,
-			                  self.num_glcmds,
-			                  self.num_frames,
-			                  self.ofs_skins,
-			                  self.ofs_st,
-			                  self.ofs_tris,
-			                  self.ofs_frames,
-			                  self.ofs_glcmds,
-			                  self.ofs_end)
-			file.write(bin)
-			
-			# write skin file names
-			for iSkin, skin in enumerate(skins):
+		# write skin file names (the textures are copied at the end, see asset_copy.py)
+		skins = []
+		self.assets = asset_copy.AssetCopier(self.options.sTextureCopy, converter=texture_convert.createConverter(
+			self.options.iMaxTextureSize, self.options.fTexturePowerOfTwo, self.options.sTextureFormat))
+		for iSkin, skin in enumerate(Util.getSkins(mesh)):
 
-				fnImg = bpy.path.abspath(skin)
+			fnImg = bpy.path.abspath(skin)
 
-				if self.options.fCopyTextureSxS:
-					fnSxS = os.path.join(os.path.dirname(filename), os.path.basename(fnImg))
+			if self.options.fCopyTextureSxS:
+				fnSxS = os.path.join(os.path.dirname(filename), os.path.basename(fnImg))
 
-					if iSkin == 0 and self.options.fNameTextureToMD2Filename:
-						# rename first skin to basename
-						fnSxS = os.path.splitext(filename)[0] + os.path.splitext(fnImg)[1]
+				if iSkin == 0 and self.options.fNameTextureToMD2Filename:
+					# rename first skin to basename
+					fnSxS = os.path.splitext(filename)[0] + os.path.splitext(fnImg)[1]
 
-					print("Copying texture %s to %s" % (fnImg, fnSxS))
-					try:
-						shutil.copy(fnImg, fnSxS)
-					except:
-						print("Copying texture %s to %s failed." % (fnImg, fnSxS))
+				fnImg = self.assets.add(fnImg, fnSxS) # for proper referencing in the MD2 file (as delivered)
 
 
-					fnImg = fnSxS # for proper referencing in the MD2 file
+			if len(fnImg) > 63 and not self.options.fExportOnlyTextureBasename:
+				print("WARNING: The texture path '"+fnImg+"' is too long. It is automatically truncated to the file basename.")
+				
+			if len(fnImg) > 63 or self.options.fExportOnlyTextureBasename:
+				fnImg = os.path.basename(fnImg)
 
+			skins.append(fnImg)
+		
+		# uvs per face (None: no uvs)
+		if len(mesh.tessface_uv_textures) != 0:
+			rgFaceUVs = [[tuple(uv) for uv in meshTextureFace.uv] for meshTextureFace in mesh.tessface_uv_textures[0].data]
+		else:
+			rgFaceUVs = [None] * len(mesh.tessfaces)
+		rgFaceVertices = [tuple(face.vertices) for face in mesh.tessfaces]
+
+		rgFrames = [(1, 'frame')]
+		if self.options.fExportAnimation:
+			rgFrames = self.getFrameNames()
+
+		# the sampled frames can be saved for re-encoding (see bake_cache.py)
+		self.bake = None
+		if getattr(self.options, "sBakeCache", ""):
+			self.bake = bake_cache.BakeCacheWriter(bpy.path.abspath(self.options.sBakeCache))
+			self.bake.meta['md2'] = { 'skins' : skins, 'cXYZ' : len(mesh.vertices), 'scale' : self.scale,
+				'frameNames' : [name for frame, name in rgFrames] }
+			self.bake.addArray('md2.faceVertices', 'I', [iVertex for vertices in rgFaceVertices for iVertex in vertices])
+			if rgFaceUVs and rgFaceUVs[0] is not None:
+				self.bake.addArray('md2.faceUVs', 'f', [r for uvs in rgFaceUVs for uv in uvs for r in uv])
+			self.bake.beginArray('md2.frames', 'f')
+
+		# incremental: the frames of the previous export (by the hashes of their inputs)
+		fnHashes = filename + ".hashes"
+		self.mapPreviousFrames = None
+		self.rgFrameHashes = []
+		if getattr(self.options, "fIncremental", False):
+			self.mapPreviousFrames = {}
+			if os.path.exists(fnHashes):
+				try:
+					with open(fnHashes, "rt") as fl:
+						hashes = json.load(fl)
+					rgHashes = hashes['frames']
+					# (only if the file is still the one the hashes belong to)
+					rgBlocks = md2_format.readFrames(filename, hashes['file'])
+					if len(rgBlocks) == len(rgHashes):
+						self.mapPreviousFrames = dict(zip(rgHashes, rgBlocks))
+				except (ValueError, KeyError) as e:
+					print("Ignoring '%s' (%s)" % (fnHashes, e))
+
+		# the frames are sampled into memory first (a few kB each), the file
+		# is only written when they are all there
+		flFrames = io.BytesIO()
+		try:
+			if not self.options.fExportAnimation:
+				self.outFrame(flFrames)
+			else:
+				# (the shards would have to hash their frames, too)
+				cShards = min(self.options.iFrameShards, len(rgFrames) // 2)
+				if cShards > 1 and not MD2.fnFrameCallback and not self.bake and self.mapPreviousFrames is None:
+					for rProgress in self.outFramesSharded(flFrames, rgFrames, cShards):
+						yield rProgress
+				else:
+					for iFrame, (frame, name) in enumerate(rgFrames):
+						bpy.context.scene.frame_set(frame)
+						if MD2.fnFrameCallback:
+							MD2.fnFrameCallback(frame)
+						self.outFrame(flFrames, name)
+						yield (iFrame + 1) / len(rgFrames)
+			if self.bake:
+				self.bake.close()
+				self.bake = None
+		finally:
+			# cancelled or failed: no partial cache
+			if self.bake:
+				self.bake.discard()
+				self.bake = None
 
-				if len(fnImg) > 63 and not self.options.fExportOnlyTextureBasename:
-					print("WARNING: The texture path '"+fnImg+"' is too long. It is automatically truncated to the file basename.")
-					
-				if len(fnImg) > 63 or self.options.fExportOnlyTextureBasename:
-					fnImg = os.path.basename(fnImg)
+		def writeFrames(file):
+			file.write(flFrames.getvalue())
 
-				
-				bin = struct.pack('<64s', bytes(fnImg[0:63], encoding='utf8'))
-				file.write(bin) # skin name
-			
-			
-			#define meshTextureFaces
-			if len(mesh.tessface_uv_textures) != 0:
-				meshTextureFaces = mesh.tessface_uv_textures[0].data
-			else:
-				meshTextureFaces = mesh.tessfaces # does this make sense?
-				
-			for meshTextureFace in meshTextureFaces: # for face in mesh.faces:
-				try:
-					uvs = meshTextureFace.uv
-				except:
-					uvs = ([0,0],[0,0],[0,0])
-				
-				# (u,v) in blender -> (u,1-v)
-				bin = struct.pack('<6h',
-								  int(uvs[0][0]*self.skinwidth),
-								  int((1-uvs[0][1])*self.skinheight),
-								  int(uvs[1][0]*self.skinwidth),
-								  int((1-uvs[1][1])*self.skinheight),
-								  int(uvs[2][0]*self.skinwidth),
-								  int((1-uvs[2][1])*self.skinheight),
-								  )
-				file.write(bin) # uv
-				# (uv index is : face.index*3+i)
-			
-			for face in mesh.tessfaces:
-				# 0,2,1 for good cw/ccw
-				bin = struct.pack('<3H',
-				                  face.vertices[0],
-				                  face.vertices[2],
-				                  face.vertices[1]
-				                )
-				file.write(bin) # vert index
-				bin = struct.pack('<3H',
-				                  face.index*3 + 0,
-				                  face.index*3 + 2,
-				                  face.index*3 + 1,
-				                  )
-				
-				file.write(bin) # uv index
+		# incremental: into memory first, an unchanged file is left untouched
+		file = io.BytesIO() if self.mapPreviousFrames is not None else open(filename, 'wb')
+		try:
+			md2_format.writeMD2(file, skins, rgFaceUVs, rgFaceVertices, len(mesh.vertices), self.num_frames, writeFrames)
+		finally:
+			if self.mapPreviousFrames is None:
+				file.close()
+
+		if self.mapPreviousFrames is not None:
+			data = file.getvalue()
+			print("%i of %i frames reused" % (len([sHash for sHash in self.rgFrameHashes if sHash in self.mapPreviousFrames]),
+				len(self.rgFrameHashes)))
+			fChanged = True
+			if os.path.exists(filename) and os.path.getsize(filename) == len(data):
+				with open(filename, 'rb') as fl:
+					if fl.read() == data:
+						print("%s is unchanged" % filename)
+						fChanged = False
+			if fChanged:
+				with open(filename, 'wb') as fl:
+					fl.write(data)
+			# (only written if it changed, like the md2 file)
+			sHashes = json.dumps({ 'version' : 2, 'file' : md2_format.getDataHash(data), 'frames' : self.rgFrameHashes }, sort_keys=True)
+			if os.path.exists(fnHashes):
+				with open(fnHashes, "rt") as fl:
+					if fl.read() == sHashes:
+						sHashes = None
+			if sHashes is not None:
+				with open(fnHashes, "wt") as fl:
+					fl.write(sHashes)
+			self.mapPreviousFrames = None
+
+		if self.assets.mapAssets:
+			# (the progress is the one of the texture conversions now)
+			for rProgress in self.assets.copySteps():
+				yield rProgress
+			print("%i of %i texture(s) copied" % (self.assets.cCopied, len(self.assets.mapAssets)))
+
+	def getFrameNames(self):
+		"""(frame, name) of all exported frames, named after the timeline markers"""
+		timeLineMarkers =[]
+		for marker in bpy.context.scene.timeline_markers:
+			timeLineMarkers.append(marker)
 			
-			if self.options.fExportAnimation:
-				min = None
-				max = None
-				
-				timeLineMarkers =[]
-				for marker in bpy.context.scene.timeline_markers:
-					timeLineMarkers.append(marker)
-					
-				# sort the markers. The marker with the frame number closest to 0 will be the first marker in the list. 
-				# The marker with the biggest frame number will be the last marker in the list
-				timeLineMarkers.sort(key=lambda marker: marker.frame)
-				markerIdx = 0
-				
-				# delete markers at same frame positions
-				if len(timeLineMarkers) > 1:
-					markerFrame = timeLineMarkers[len(timeLineMarkers)-1].frame
-					for i in range(len(timeLineMarkers)-2, -1, -1):
-						if timeLineMarkers[i].frame == markerFrame:
-							del timeLineMarkers[i]
-						else:
-							markerFrame = timeLineMarkers[i].frame
-				
-				# BL: to fix: 1 is assumed to be the frame start (this is
-				# hardcoded sometimes...)
-				for frame in range(1, self.num_frames+1):
-					percent = (frame - bpy.context.scene.frame_start) / ( 1. + self.num_frames)
-					
-					#Display the progress status of the export in the console
-					progressStatus = math.floor(percent*100)
-					if progressStatus - self.progressBarDisplayed >= 1:
-						# only show major updates (>=1%)
-						print("Export progress: %3i%%\r" % int(progressStatus), end=' ')
-						self.progressBarDisplayed = progressStatus
-
-					if frame == self.num_frames:
-						print("Export progress: %3i%% - Model exported." % 100)
-
-					bpy.context.scene.frame_set(frame)
-				
-					if len(timeLineMarkers) != 0:
-						if markerIdx + 1 != len(timeLineMarkers):
-							if frame >= timeLineMarkers[markerIdx + 1].frame:
-								markerIdx += 1
-						name = timeLineMarkers[markerIdx].name
-					else:
-						name = 'frame'
-							
-					self.outFrame(file, name + str(frame))
+		# sort the markers. The marker with the frame number closest to 0 will be the first marker in the list. 
+		# The marker with the biggest frame number will be the last marker in the list
+		timeLineMarkers.sort(key=lambda marker: marker.frame)
+		markerIdx = 0
+		
+		# delete markers at same frame positions
+		if len(timeLineMarkers) > 1:
+			markerFrame = timeLineMarkers[len(timeLineMarkers)-1].frame
+			for i in range(len(timeLineMarkers)-2, -1, -1):
+				if timeLineMarkers[i].frame == markerFrame:
+					del timeLineMarkers[i]
+				else:
+					markerFrame = timeLineMarkers[i].frame
+		
+		# BL: to fix: 1 is assumed to be the frame start (this is
+		# hardcoded sometimes...)
+		rgFrames = []
+		for frame in range(1, self.num_frames+1):
+			if len(timeLineMarkers) != 0:
+				if markerIdx + 1 != len(timeLineMarkers):
+					if frame >= timeLineMarkers[markerIdx + 1].frame:
+						markerIdx += 1
+				name = timeLineMarkers[markerIdx].name
 			else:
-				self.outFrame(file)
-
-			# gl commands
-			for meshTextureFace in meshTextureFaces: 
-				try:
-					uvs = meshTextureFace.uv
-				except:
-					uvs = ([0,0],[0,0],[0,0])
-				bin = struct.pack('<i', 3)
-				file.write(bin)
-				# 0,2,1 for good cw/ccw (also flips/inverts normal)
-				for vert in [0,2,1]:
-					# (u,v) in blender -> (u,1-v)
-					bin = struct.pack('<ffI',
-						uvs[vert][0],
-						(1.0 - uvs[vert][1]),
-						face.vertices[vert])
-					
-					file.write(bin)
-			# NULL command
-			bin = struct.pack('<I', 0)
-			file.write(bin)
+				name = 'frame'
+			rgFrames.append((frame, name + str(frame)))
+		return rgFrames
+
+	def outFramesSharded(self, file, rgFrames, cShards):
+		"""samples the frames in cShards background blenders (on a copy of
+		the current file) and appends their frame blocks in order. generator:
+		yields the progress while it waits for them"""
+		import subprocess
+
+		dirTemp = tempfile.mkdtemp(prefix="md2_shards_")
+		rgShards = []
+		# (no subprocess.DEVNULL in the python 3.2 of blender 2.63)
+		flNull = open(os.devnull, "wb")
+		try:
+			# the shards need the current state (e.g. the temporary triangulated object)
+			fnBlend = os.path.join(dirTemp, "shard.blend")
+			bpy.ops.wm.save_as_mainfile(filepath=fnBlend, copy=True, relative_remap=True, check_existing=False)
+
+			# contiguous frame ranges: each shard steps through its frames in order
+			for iShard in range(cShards):
+				rgShardFrames = rgFrames[iShard * len(rgFrames) // cShards : (iShard+1) * len(rgFrames) // cShards]
+				fnJob = os.path.join(dirTemp, "shard%i.json" % iShard)
+				fnOut = os.path.join(dirTemp, "shard%i.frames" % iShard)
+				with open(fnJob, "wt") as fl:
+					json.dump({ 'object' : self.object.name, 'scale' : self.scale,
+						'frames' : rgShardFrames, 'output' : fnOut }, fl)
+				process = subprocess.Popen([bpy.app.binary_path, "-b", fnBlend, "--python", os.path.abspath(__file__),
+					"--", "--md2-shard", fnJob], stdout=flNull)
+				rgShards.append((process, rgShardFrames, fnOut))
+			print("Exporting %i frames in %i processes..." % (len(rgFrames), cShards))
+
+			for iShard, (process, rgShardFrames, fnOut) in enumerate(rgShards):
+				while process.poll() is None:
+					time.sleep(0.01)
+					yield iShard / cShards
+				if process.returncode == 0 and os.path.exists(fnOut) and \
+						os.path.getsize(fnOut) == self.framesize * len(rgShardFrames):
+					with open(fnOut, "rb") as flShard:
+						shutil.copyfileobj(flShard, file)
+				else:
+					# the frames are done here instead
+					print("Frame shard %i failed (%s), exporting its frames here." % (iShard, process.returncode))
+					for frame, name in rgShardFrames:
+						bpy.context.scene.frame_set(frame)
+						self.outFrame(file, name)
+						yield iShard / cShards
+				yield (iShard + 1) / cShards
 		finally:
-			file.close()
+			# (cancelled: the shards which still run are not needed any more)
+			for process, rgShardFrames, fnOut in rgShards:
+				if process.poll() is None:
+					process.kill()
+					process.wait()
+			flNull.close()
+			shutil.rmtree(dirTemp, ignore_errors=True)
 
 	def outFrame(self, file, frameName = 'frame'):
 		mesh = self.object.to_mesh(bpy.context.scene, True, 'PREVIEW')
-		
-		mesh.transform(self.object.matrix_world)
-		mesh.transform(mathutils.Matrix.Rotation(pi/2, 4, 'X')) 
-		mesh.transform(mathutils.Matrix.Rotation(pi, 4, 'Z')) 
-
-		###### compute the bounding box ###############
-		min = [mesh.vertices[0].co[0],
-		       mesh.vertices[0].co[1],
-		       mesh.vertices[0].co[2]]
-		max = [mesh.vertices[0].co[0],
-		       mesh.vertices[0].co[1],
-		       mesh.vertices[0].co[2]]
-
-		for vert in mesh.vertices:
-			for i in range(3):
-				if vert.co[i] < min[i]:
-					min[i] = vert.co[i]
-				if vert.co[i] > max[i]:
-					max[i] = vert.co[i]
-		########################################
-
-		# BL: some caching to speed it up:
-		# -> sd_ gets the vertices between [0 and 255]
-		#    which is our important quantization.
-		sdx = (max[0]-min[0]) / 255.0
-		sdy = (max[1]-min[1]) / 255.0
-		sdz = (max[2]-min[2]) / 255.0
-		isdx = 255.0 / (max[0]-min[0])
-		isdy = 255.0 / (max[1]-min[1])
-		isdz = 255.0 / (max[2]-min[2])
-
-		# note about the scale: self.object.scale is already applied via matrix_world
-		bin = struct.pack('<6f16s', 
-			# writing the scale of the model 
-			self.scale * sdx,
-			self.scale * sdy,
-			self.scale * sdz,
-			## now the initial offset [= min of bounding box (correctly scaled)]
-			self.scale * min[0],
-			self.scale * min[1],
-			self.scale * min[2],
-			# and finally the name.
-			bytes(frameName, encoding='utf8'))
-			
-		file.write(bin) # frame header
-
-		for vert in mesh.vertices:
-
-			# find the closest normal for every vertex
-			for iN in range(162):
-			 	# BL: what's the magic here??
-				dot =  vert.normal[1]*MD2_NORMALS[iN][0] + \
-				      -vert.normal[0]*MD2_NORMALS[iN][1] + \
-				       vert.normal[2]*MD2_NORMALS[iN][2]
-
-				if iN==0 or dot > maxDot:
-					maxDot = dot
-					bestNormalIndex = iN
-
-			# and now write the normal.
-			bin = struct.pack('<4B',
-			                  int((vert.co[0]-min[0])*isdx),
-			                  int((vert.co[1]-min[1])*isdy),
-			                  int((vert.co[2]-min[2])*isdz),
-			                  bestNormalIndex)
-			
-			file.write(bin) # write vertex and normal
+		try:
+			mesh.transform(self.object.matrix_world)
+			mesh.transform(mathutils.Matrix.Rotation(pi/2, 4, 'X')) 
+			mesh.transform(mathutils.Matrix.Rotation(pi, 4, 'Z')) 
+
+			rgCoords = [tuple(vert.co) for vert in mesh.vertices]
+			rgNormals = [tuple(vert.normal) for vert in mesh.vertices]
+		finally:
+			bpy.data.meshes.remove(mesh)
+
+		if self.mapPreviousFrames is None:
+			file.write(md2_format.packFrame(rgCoords, rgNormals, frameName, self.scale))
+		else:
+			sHash = md2_format.getFrameHash(rgCoords, rgNormals, frameName, self.scale)
+			self.rgFrameHashes.append(sHash)
+			block = self.mapPreviousFrames.get(sHash)
+			file.write(block if block is not None else md2_format.packFrame(rgCoords, rgNormals, frameName, self.scale))
+
+		if self.bake:
+			self.bake.extend([r for co in rgCoords for r in co])
+			self.bake.extend([r for normal in rgNormals for r in normal])
+
+
+def runFrameShard(fnJob):
+	"""writes the frames of one shard (see MD2.outFramesSharded), in a background blender"""
+	with open(fnJob, "rt") as fl:
+		job = json.load(fl)
+
+	md2 = MD2(None)
+	md2.setObject(bpy.data.objects[job['object']], job['scale'])
+	file = open(job['output'], 'wb')
+	try:
+		for frame, name in job['frames']:
+			bpy.context.scene.frame_set(frame)
+			md2.outFrame(file, name)
+	finally:
+		file.close()
+
 
 class Util:
 	@staticmethod
@@ -615,7 +474,7 @@ class ObjectInfo:
 	def __init__(self, object):
 		self.triang = True
 		self.vertices = -1
-		self.cTessfaces = 0
+		self.cTessFaces = 0
 		self.status = ('','')
 
 		self.ismesh = object and object.type == 'MESH'
@@ -647,7 +506,7 @@ class ObjectInfo:
 		print(self.status)
 		
 		
-class Export_MD2(bpy.types.Operator, ExportHelper):
+class Export_MD2(bpy.types.Operator, ExportHelper, modal_export.ModalExport):
 	"""Export to Quake2 file format (.md2)"""
 	bl_idname = "export_quake.md2"
 	bl_label = "Export to Quake2 file format (.md2)"
@@ -674,10 +533,46 @@ class Export_MD2(bpy.types.Operator, ExportHelper):
 							description="default: True",
 							default=True)
 
+	sTextureCopy = EnumProperty(name="Texture copies",
+							items=[('COPY', "Copy", "Copy the textures next to the .md2"),
+							       ('HARDLINK', "Hardlink", "Hardlink the textures next to the .md2 (copies where that is not possible)"),
+							       ('REFLINK', "Reflink", "Copy-on-write clones of the textures, on file systems which can (copies elsewhere)")],
+							description="How the textures are put next to the .md2 (unchanged ones are not copied again)",
+							default='COPY')
+
+	iMaxTextureSize = IntProperty(name="Max. texture size",
+							description="Scale the copied textures down to at most this many pixels on the longer side (0: keep the size)",
+							default=0, min=0, max=16384)
+
+	fTexturePowerOfTwo = BoolProperty(name="Power of two textures",
+							description="Scale the copied textures down to powers of two",
+							default=False)
+
+	sTextureFormat = EnumProperty(name="Texture format",
+							items=[('SOURCE', "Source", "Keep the format of the textures"),
+							       ('PNG', "PNG", "Deliver the textures as PNG"),
+							       ('JPEG', "JPEG", "Deliver the textures as JPEG (smaller, no alpha)")],
+							description="Format of the copied textures (converted textures are cached by the hash of their source)",
+							default='SOURCE')
+
 	fNameTextureToMD2Filename = BoolProperty(name="Name first texture similar to .md2",
 							description="default: True",
 							default=True)
 
+	sBakeCache = StringProperty(name="Bake cache file",
+							description="Also save the sampled frames to this file (re-encode without blender: bake_cache.py)",
+							default="", subtype='FILE_PATH')
+
+	iFrameShards = IntProperty(name="Frame shards",
+							description="Background blender processes which export the animation frames in parallel (1: all here)",
+							default=1, min=1, max=64)
+	fIncremental = BoolProperty(name="Incremental",
+							description="Reuse the unchanged frames of the previous export (hashes in <file>.hashes) and leave an unchanged file untouched",
+							default=False)
+	fWatch = BoolProperty(name="Watch",
+							description="Repeat this export in the background whenever the object changes or the file is saved (incremental)",
+							default=False)
+
 
 
 	# id_export   = 1
@@ -704,6 +599,16 @@ class Export_MD2(bpy.types.Operator, ExportHelper):
 		filepath = self.filepath
 		filepath = bpy.path.ensure_ext(filepath, self.filename_ext)
 
+		# (also checked here: scripts call the operator without invoke)
+		sError = self.checkObject()
+		if sError:
+			self.report({'ERROR'}, sError)
+			return {'CANCELLED'}
+
+		return self.runExport(context, self.exportSteps(filepath))
+
+	def exportSteps(self, filepath):
+		"""the export as generator, yields the progress (see modal_export.py)"""
 		object = self.object
 		originalObject = object
 
@@ -729,8 +634,10 @@ class Export_MD2(bpy.types.Operator, ExportHelper):
 		try:
 			md2 = MD2(self)
 			md2.setObject(object, self.rScaleFactor)
-			md2.write(filepath) 
+			for rProgress in md2.writeSteps(filepath):
+				yield rProgress
 		finally:
+			# (also when the export is cancelled)
 			if object.name == tmpObjectName:
 				originalObject.select = True
 				bpy.context.scene.objects.active = originalObject
@@ -738,29 +645,46 @@ class Export_MD2(bpy.types.Operator, ExportHelper):
 			if self.fExportAnimation:
 				bpy.context.scene.frame_set(frame)
 
-			self.report({'INFO'},  "Model '"+originalObject.name+"' exported")
-		return {'FINISHED'}
+		self.report({'INFO'},  "Model '"+originalObject.name+"' exported")
+		sCopyErrors = md2.assets.getReport()
+		if sCopyErrors:
+			print(sCopyErrors)
+			self.report({'WARNING'}, sCopyErrors)
+
+		# watch mode: the export is repeated in the background (see export_watch.py)
+		if self.fWatch:
+			export_watch.addWatch('MD2', [originalObject.name], filepath,
+				export_watch.getOptions(self, ('filepath', 'filename', 'check_existing', 'filter_glob', 'fWatch')))
+		else:
+			export_watch.removeWatch(filepath)
 	
-	def invoke(self, context, event):
-
-		if not context.selected_objects:
-			self.report({'ERROR'}, "Please, select an object to export!")
-			return {'CANCELLED'}
+	def checkObject(self):
+		"""returns why the selection cannot be exported (None: it can)"""
+		if not bpy.context.selected_objects:
+			return "Please, select an object to export!"
 		
 		if len(bpy.context.selected_objects) > 1:
-			self.report({'ERROR'}, "Please, select exactly one object to export!")
-			return {'CANCELLED'}
+			return "Please, select exactly one object to export!"
 
-		# check how many faces we have (there is a max..)
-		obj = bpy.context.selected_objects[0]
+		if not self.info.ismesh:
+			return "Selected object must be a mesh!"
 
-		info = ObjectInfo(obj)
-		cFinalTriangles = info.cTessFaces
+		# check how many faces we have (there is a max..)
+		cFinalTriangles = self.info.cTessFaces
 		if cFinalTriangles*3 > 2**16:
-			self.report({'ERROR'}, 
-			   "Object has too many (triangulated) faces (%i), at most %i are supported in md2" % (cFinalTriangles, (2**16)/3))
+			return "Object has too many (triangulated) faces (%i), at most %i are supported in md2" % (cFinalTriangles, (2**16)/3)
+
+		return None
+
+	def invoke(self, context, event):
+
+		sError = self.checkObject()
+		if sError:
+			self.report({'ERROR'}, sError)
 			return {'CANCELLED'}
 
+		# the export runs modal (see modal_export.py)
+		self.fModal = True
 		wm = context.window_manager
 		wm.fileselect_add(self)
 		return {'RUNNING_MODAL'}
@@ -772,10 +696,16 @@ def menuCB(self, context):
 def register():
 	bpy.utils.register_module(__name__)
 	bpy.types.INFO_MT_file_export.append(menuCB)
+	export_watch.register()
  
 def unregister():
+	export_watch.unregister()
 	bpy.utils.unregister_module(__name__)
 	bpy.types.INFO_MT_file_export.remove(menuCB)
  
 if __name__ == "__main__":
-	register()
+	if "--md2-shard" in sys.argv:
+		# blender -b copy.blend --python md2_export_263.py -- --md2-shard job.json
+		runFrameShard(sys.argv[sys.argv.index("--md2-shard") + 1])
+	else:
+		register()
@@ -0,0 +1,389 @@
+# ***** BEGIN GPL LICENSE BLOCK *****
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+
+# ***** END GPL LICENCE BLOCK *****
+
+# the md2 file layout of md2_export_263.py, without bpy: also used to
+# re-encode baked animations outside blender (see bake_cache.py).
+
+import struct
+
+
+MD2_NORMALS=((-0.525731, 0.000000, 0.850651),
+             (-0.442863, 0.238856, 0.864188),
+             (-0.295242, 0.000000, 0.955423),
+             (-0.309017, 0.500000, 0.809017),
+             (-0.162460, 0.262866, 0.951056),
+             ( 0.000000, 0.000000, 1.000000),
+             ( 0.000000, 0.850651, 0.525731),
+             (-0.147621, 0.716567, 0.681718),
+             ( 0.147621, 0.716567, 0.681718),
+             ( 0.000000, 0.525731, 0.850651),
+             ( 0.309017, 0.500000, 0.809017),
+             ( 0.525731, 0.000000, 0.850651),
+             ( 0.295242, 0.000000, 0.955423),
+             ( 0.442863, 0.238856, 0.864188),
+             ( 0.162460, 0.262866, 0.951056),
+             (-0.681718, 0.147621, 0.716567),
+             (-0.809017, 0.309017, 0.500000),
+             (-0.587785, 0.425325, 0.688191),
+             (-0.850651, 0.525731, 0.000000),
+             (-0.864188, 0.442863, 0.238856),
+             (-0.716567, 0.681718, 0.147621),
+             (-0.688191, 0.587785, 0.425325),
+             (-0.500000, 0.809017, 0.309017),
+             (-0.238856, 0.864188, 0.442863),
+             (-0.425325, 0.688191, 0.587785),
+             (-0.716567, 0.681718,-0.147621),
+             (-0.500000, 0.809017,-0.309017),
+             (-0.525731, 0.850651, 0.000000),
+             ( 0.000000, 0.850651,-0.525731),
+             (-0.238856, 0.864188,-0.442863),
+             ( 0.000000, 0.955423,-0.295242),
+             (-0.262866, 0.951056,-0.162460),
+             ( 0.000000, 1.000000, 0.000000),
+             ( 0.000000, 0.955423, 0.295242),
+             (-0.262866, 0.951056, 0.162460),
+             ( 0.238856, 0.864188, 0.442863),
+             ( 0.262866, 0.951056, 0.162460),
+             ( 0.500000, 0.809017, 0.309017),
+             ( 0.238856, 0.864188,-0.442863),
+             ( 0.262866, 0.951056,-0.162460),
+             ( 0.500000, 0.809017,-0.309017),
+             ( 0.850651, 0.525731, 0.000000),
+             ( 0.716567, 0.681718, 0.147621),
+             ( 0.716567, 0.681718,-0.147621),
+             ( 0.525731, 0.850651, 0.000000),
+             ( 0.425325, 0.688191, 0.587785),
+             ( 0.864188, 0.442863, 0.238856),
+             ( 0.688191, 0.587785, 0.425325),
+             ( 0.809017, 0.309017, 0.500000),
+             ( 0.681718, 0.147621, 0.716567),
+             ( 0.587785, 0.425325, 0.688191),
+             ( 0.955423, 0.295242, 0.000000),
+             ( 1.000000, 0.000000, 0.000000),
+             ( 0.951056, 0.162460, 0.262866),
+             ( 0.850651,-0.525731, 0.000000),
+             ( 0.955423,-0.295242, 0.000000),
+             ( 0.864188,-0.442863, 0.238856),
+             ( 0.951056,-0.162460, 0.262866),
+             ( 0.809017,-0.309017, 0.500000),
+             ( 0.681718,-0.147621, 0.716567),
+             ( 0.850651, 0.000000, 0.525731),
+             ( 0.864188, 0.442863,-0.238856),
+             ( 0.809017, 0.309017,-0.500000),
+             ( 0.951056, 0.162460,-0.262866),
+             ( 0.525731, 0.000000,-0.850651),
+             ( 0.681718, 0.147621,-0.716567),
+             ( 0.681718,-0.147621,-0.716567),
+             ( 0.850651, 0.000000,-0.525731),
+             ( 0.809017,-0.309017,-0.500000),
+             ( 0.864188,-0.442863,-0.238856),
+             ( 0.951056,-0.162460,-0.262866),
+             ( 0.147621, 0.716567,-0.681718),
+             ( 0.309017, 0.500000,-0.809017),
+             ( 0.425325, 0.688191,-0.587785),
+             ( 0.442863, 0.238856,-0.864188),
+             ( 0.587785, 0.425325,-0.688191),
+             ( 0.688191, 0.587785,-0.425325),
+             (-0.147621, 0.716567,-0.681718),
+             (-0.309017, 0.500000,-0.809017),
+             ( 0.000000, 0.525731,-0.850651),
+             (-0.525731, 0.000000,-0.850651),
+             (-0.442863, 0.238856,-0.864188),
+             (-0.295242, 0.000000,-0.955423),
+             (-0.162460, 0.262866,-0.951056),
+             ( 0.000000, 0.000000,-1.000000),
+             ( 0.295242, 0.000000,-0.955423),
+             ( 0.162460, 0.262866,-0.951056),
+             (-0.442863,-0.238856,-0.864188),
+             (-0.309017,-0.500000,-0.809017),
+             (-0.162460,-0.262866,-0.951056),
+             ( 0.000000,-0.850651,-0.525731),
+             (-0.147621,-0.716567,-0.681718),
+             ( 0.147621,-0.716567,-0.681718),
+             ( 0.000000,-0.525731,-0.850651),
+             ( 0.309017,-0.500000,-0.809017),
+             ( 0.442863,-0.238856,-0.864188),
+             ( 0.162460,-0.262866,-0.951056),
+             ( 0.238856,-0.864188,-0.442863),
+             ( 0.500000,-0.809017,-0.309017),
+             ( 0.425325,-0.688191,-0.587785),
+             ( 0.716567,-0.681718,-0.147621),
+             ( 0.688191,-0.587785,-0.425325),
+             ( 0.587785,-0.425325,-0.688191),
+             ( 0.000000,-0.955423,-0.295242),
+             ( 0.000000,-1.000000, 0.000000),
+             ( 0.262866,-0.951056,-0.162460),
+             ( 0.000000,-0.850651, 0.525731),
+             ( 0.000000,-0.955423, 0.295242),
+             ( 0.238856,-0.864188, 0.442863),
+             ( 0.262866,-0.951056, 0.162460),
+             ( 0.500000,-0.809017, 0.309017),
+             ( 0.716567,-0.681718, 0.147621),
+             ( 0.525731,-0.850651, 0.000000),
+             (-0.238856,-0.864188,-0.442863),
+             (-0.500000,-0.809017,-0.309017),
+             (-0.262866,-0.951056,-0.162460),
+             (-0.850651,-0.525731, 0.000000),
+             (-0.716567,-0.681718,-0.147621),
+             (-0.716567,-0.681718, 0.147621),
+             (-0.525731,-0.850651, 0.000000),
+             (-0.500000,-0.809017, 0.309017),
+             (-0.238856,-0.864188, 0.442863),
+             (-0.262866,-0.951056, 0.162460),
+             (-0.864188,-0.442863, 0.238856),
+             (-0.809017,-0.309017, 0.500000),
+             (-0.688191,-0.587785, 0.425325),
+             (-0.681718,-0.147621, 0.716567),
+             (-0.442863,-0.238856, 0.864188),
+             (-0.587785,-0.425325, 0.688191),
+             (-0.309017,-0.500000, 0.809017),
+             (-0.147621,-0.716567, 0.681718),
+             (-0.425325,-0.688191, 0.587785),
+             (-0.162460,-0.262866, 0.951056),
+             ( 0.442863,-0.238856, 0.864188),
+             ( 0.162460,-0.262866, 0.951056),
+             ( 0.309017,-0.500000, 0.809017),
+             ( 0.147621,-0.716567, 0.681718),
+             ( 0.000000,-0.525731, 0.850651),
+             ( 0.425325,-0.688191, 0.587785),
+             ( 0.587785,-0.425325, 0.688191),
+             ( 0.688191,-0.587785, 0.425325),
+             (-0.955423, 0.295242, 0.000000),
+             (-0.951056, 0.162460, 0.262866),
+             (-1.000000, 0.000000, 0.000000),
+             (-0.850651, 0.000000, 0.525731),
+             (-0.955423,-0.295242, 0.000000),
+             (-0.951056,-0.162460, 0.262866),
+             (-0.864188, 0.442863,-0.238856),
+             (-0.951056, 0.162460,-0.262866),
+             (-0.809017, 0.309017,-0.500000),
+             (-0.864188,-0.442863,-0.238856),
+             (-0.951056,-0.162460,-0.262866),
+             (-0.809017,-0.309017,-0.500000),
+             (-0.681718, 0.147621,-0.716567),
+             (-0.681718,-0.147621,-0.716567),
+             (-0.850651, 0.000000,-0.525731),
+             (-0.688191, 0.587785,-0.425325),
+             (-0.587785, 0.425325,-0.688191),
+             (-0.425325, 0.688191,-0.587785),
+             (-0.425325,-0.688191,-0.587785),
+             (-0.587785,-0.425325,-0.688191),
+             (-0.688191,-0.587785,-0.425325))
+
+
+def getFrameSize(cXYZ):
+	"""bytes per frame: header (scale, translate, name) + 4 per vertex"""
+	return 40+4*cXYZ
+
+def writeMD2(file, rgSkins, rgFaceUVs, rgFaceVertices, cXYZ, cFrames, fnWriteFrames,
+		skinwidth=2**10-1, skinheight=2**10-1):
+	"""writes a whole md2 file.
+	rgSkins: skin names, rgFaceUVs: ((u,v) x3) per triangle (None: no uvs),
+	rgFaceVertices: (3 vertex indices) per triangle,
+	fnWriteFrames(file): writes the cFrames frames (see packFrame)"""
+	version = 8
+
+	num_skins = len(rgSkins)
+	num_xyz = cXYZ
+	num_st = len(rgFaceVertices)*3
+	num_tris = len(rgFaceVertices)
+	num_glcmds = num_tris * (1+3*3) + 1
+	num_frames = cFrames
+
+	framesize = getFrameSize(cXYZ)
+
+	ofs_skins = 68 # size of the header
+	ofs_st = ofs_skins + 64*num_skins
+	ofs_tris = ofs_st + 4*num_st
+	ofs_frames = ofs_tris + 12*num_tris
+	ofs_glcmds = ofs_frames + framesize*num_frames
+	ofs_end = ofs_glcmds + 4*num_glcmds
+
+	# write header
+	bin = struct.pack('<4B16i', #bin = struct.pack('<4s16i',
+	                  ord('I'),
+	                  ord('D'),
+	                  ord('P'),
+	                  ord('2'),
+	                  version,
+	                  skinwidth,
+	                  skinheight,
+	                  framesize,
+	                  num_skins,
+	                  num_xyz,
+	                  num_st, #  number of texture coordinates
+	                  num_tris,
+	                  num_glcmds,
+	                  num_frames,
+	                  ofs_skins,
+	                  ofs_st,
+	                  ofs_tris,
+	                  ofs_frames,
+	                  ofs_glcmds,
+	                  ofs_end)
+	file.write(bin)
+
+	# write skin file names
+	for fnImg in rgSkins:
+		bin = struct.pack('<64s', bytes(fnImg[0:63], encoding='utf8'))
+		file.write(bin) # skin name
+
+	for uvs in rgFaceUVs:
+		if uvs is None:
+			uvs = ([0,0],[0,0],[0,0])
+		
+		# (u,v) in blender -> (u,1-v)
+		bin = struct.pack('<6h',
+						  int(uvs[0][0]*skinwidth),
+						  int((1-uvs[0][1])*skinheight),
+						  int(uvs[1][0]*skinwidth),
+						  int((1-uvs[1][1])*skinheight),
+						  int(uvs[2][0]*skinwidth),
+						  int((1-uvs[2][1])*skinheight),
+						  )
+		file.write(bin) # uv
+		# (uv index is : face.index*3+i)
+	
+	for iFace, vertices in enumerate(rgFaceVertices):
+		# 0,2,1 for good cw/ccw
+		bin = struct.pack('<3H',
+		                  vertices[0],
+		                  vertices[2],
+		                  vertices[1]
+		                )
+		file.write(bin) # vert index
+		bin = struct.pack('<3H',
+		                  iFace*3 + 0,
+		                  iFace*3 + 2,
+		                  iFace*3 + 1,
+		                  )
+		
+		file.write(bin) # uv index
+
+	fnWriteFrames(file)
+
+	# gl commands
+	for uvs, vertices in zip(rgFaceUVs, rgFaceVertices):
+		if uvs is None:
+			uvs = ([0,0],[0,0],[0,0])
+		bin = struct.pack('<i', 3)
+		file.write(bin)
+		# 0,2,1 for good cw/ccw (also flips/inverts normal)
+		for vert in [0,2,1]:
+			# (u,v) in blender -> (u,1-v)
+			bin = struct.pack('<ffI',
+				uvs[vert][0],
+				(1.0 - uvs[vert][1]),
+				vertices[vert])
+			
+			file.write(bin)
+	# NULL command
+	bin = struct.pack('<I', 0)
+	file.write(bin)
+
+def packFrame(rgCoords, rgNormals, frameName, scale):
+	"""one frame: the vertices (already in md2 orientation) quantized into
+	their bounding box, with the index of the closest md2 normal"""
+
+	###### compute the bounding box ###############
+	min = [rgCoords[0][0],
+	       rgCoords[0][1],
+	       rgCoords[0][2]]
+	max = [rgCoords[0][0],
+	       rgCoords[0][1],
+	       rgCoords[0][2]]
+
+	for co in rgCoords:
+		for i in range(3):
+			if co[i] < min[i]:
+				min[i] = co[i]
+			if co[i] > max[i]:
+				max[i] = co[i]
+	########################################
+
+	# BL: some caching to speed it up:
+	# -> sd_ gets the vertices between [0 and 255]
+	#    which is our important quantization.
+	sdx = (max[0]-min[0]) / 255.0
+	sdy = (max[1]-min[1]) / 255.0
+	sdz = (max[2]-min[2]) / 255.0
+	isdx = 255.0 / (max[0]-min[0])
+	isdy = 255.0 / (max[1]-min[1])
+	isdz = 255.0 / (max[2]-min[2])
+
+	# note about the scale: the object scale is already applied (matrix_world)
+	rgOut = [struct.pack('<6f16s', 
+		# writing the scale of the model 
+		scale * sdx,
+		scale * sdy,
+		scale * sdz,
+		## now the initial offset [= min of bounding box (correctly scaled)]
+		scale * min[0],
+		scale * min[1],
+		scale * min[2],
+		# and finally the name.
+		bytes(frameName, encoding='utf8'))] # frame header
+
+	for co, normal in zip(rgCoords, rgNormals):
+
+		# find the closest normal for every vertex
+		for iN in range(162):
+		 	# BL: what's the magic here??
+			dot =  normal[1]*MD2_NORMALS[iN][0] + \
+			      -normal[0]*MD2_NORMALS[iN][1] + \
+			       normal[2]*MD2_NORMALS[iN][2]
+
+			if iN==0 or dot > maxDot:
+				maxDot = dot
+				bestNormalIndex = iN
+
+		# and now write the normal.
+		rgOut.append(struct.pack('<4B',
+		                  int((co[0]-min[0])*isdx),
+		                  int((co[1]-min[1])*isdy),
+		                  int((co[2]-min[2])*isdz),
+		                  bestNormalIndex)) # write vertex and normal
+
+	return b"".join(rgOut)
+
+def getFrameHash(rgCoords, rgNormals, frameName, scale):
+	"""hash of the inputs of packFrame (incremental export)"""
+	import hashlib
+	return hashlib.sha1(repr((rgCoords, rgNormals, frameName, scale)).encode("utf-8")).hexdigest()
+
+def getDataHash(data):
+	import hashlib
+	return hashlib.sha1(data).hexdigest()
+
+def readFrames(fn, sHash=None):
+	"""the frame blocks of an md2 file as list of bytes ([] if it is no md2
+	file, or its sha1 is not sHash)"""
+	try:
+		with open(fn, "rb") as fl:
+			data = fl.read()
+		header = struct.unpack('<4B16i', data[:68])
+	except (IOError, struct.error):
+		return []
+	if sHash is not None and getDataHash(data) != sHash:
+		return []
+	if bytes(header[:4]) != b"IDP2":
+		return []
+	framesize, num_frames, ofs_frames = header[7], header[13], header[17]
+	if ofs_frames + framesize*num_frames > len(data):
+		return []
+	return [data[ofs_frames + framesize*i : ofs_frames + framesize*(i+1)] for i in range(num_frames)]
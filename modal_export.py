@@ -0,0 +1,133 @@
+# ***** BEGIN GPL LICENSE BLOCK *****
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+
+# ***** END GPL LICENCE BLOCK *****
+
+# the non-blocking export of the 2.63 exporters: the export is a generator
+# which yields its progress (0..1) after every frame or object. invoked from
+# the UI, it runs in slices on timer events, shows its progress in the
+# window manager and is cancelled with Esc; called from scripts (or in
+# background mode) it runs to the end at once.
+
+import time
+
+import bpy
+
+
+class ModalExport:
+	"""mixin of the export operators (see runExport)"""
+
+	# seconds of export work per timer event (the UI gets the rest)
+	rSliceSeconds = 0.05
+
+	# set by invoke: the export after the file browser runs modal
+	fModal = False
+
+	# the events which still reach blender while the export runs: view
+	# navigation only, editing the exported objects in between the slices
+	# would export inconsistent data (or objects which are gone)
+	setPassThroughEvents = set(['MOUSEMOVE', 'INBETWEEN_MOUSEMOVE', 'MIDDLEMOUSE',
+		'WHEELUPMOUSE', 'WHEELDOWNMOUSE', 'WHEELINMOUSE', 'WHEELOUTMOUSE',
+		'TRACKPADPAN', 'TRACKPADZOOM', 'NDOF_MOTION',
+		'NUMPAD_0', 'NUMPAD_1', 'NUMPAD_2', 'NUMPAD_3', 'NUMPAD_4', 'NUMPAD_5',
+		'NUMPAD_6', 'NUMPAD_7', 'NUMPAD_8', 'NUMPAD_9', 'NUMPAD_PERIOD', 'NUMPAD_PLUS', 'NUMPAD_MINUS',
+		'WINDOW_DEACTIVATE'])
+
+	def runExport(self, context, steps):
+		"""runs the generator steps, modal if the operator was invoked.
+		self.addCleanup(fn) registers what has to be undone (temporary files,
+		open files...) if the export is cancelled or fails; the generator
+		also gets closed then, so its finally blocks run, too."""
+		self.steps = steps
+		if not self.fModal or bpy.app.background:
+			iPrinted = 0
+			try:
+				for rProgress in steps:
+					if int(10 * rProgress) > iPrinted:
+						iPrinted = int(10 * rProgress)
+						print("Export progress: %3i%%" % (10 * iPrinted))
+			except:
+				self.endExport(context, False)
+				raise
+			self.endExport(context, True)
+			return {'FINISHED'}
+
+		wm = context.window_manager
+		self.timer = wm.event_timer_add(0.01, context.window)
+		if hasattr(wm, "progress_begin"):
+			wm.progress_begin(0, 100)
+		wm.modal_handler_add(self)
+		return {'RUNNING_MODAL'}
+
+	def addCleanup(self, fnCleanup):
+		if not hasattr(self, "rgCleanups"):
+			self.rgCleanups = []
+		self.rgCleanups.append(fnCleanup)
+
+	def modal(self, context, event):
+		if event.type == 'ESC':
+			self.endExport(context, False)
+			self.report({'WARNING'}, "Export cancelled")
+			return {'CANCELLED'}
+		if event.type != 'TIMER':
+			if event.type in self.setPassThroughEvents:
+				return {'PASS_THROUGH'}
+			return {'RUNNING_MODAL'}
+
+		# at least one step per event
+		timeEnd = time.time() + self.rSliceSeconds
+		try:
+			rProgress = next(self.steps)
+			while time.time() < timeEnd:
+				rProgress = next(self.steps)
+		except StopIteration:
+			self.endExport(context, True)
+			return {'FINISHED'}
+		except:
+			self.endExport(context, False)
+			raise
+
+		wm = context.window_manager
+		if hasattr(wm, "progress_update"):
+			wm.progress_update(int(100 * rProgress))
+		return {'RUNNING_MODAL'}
+
+	def cancel(self, context):
+		# (blender cancels running modal operators e.g. when the window closes)
+		self.endExport(context, False)
+		return {'CANCELLED'}
+
+	def endExport(self, context, fFinished):
+		if getattr(self, "timer", None):
+			wm = context.window_manager
+			wm.event_timer_remove(self.timer)
+			if hasattr(wm, "progress_end"):
+				wm.progress_end()
+			self.timer = None
+
+		if self.steps:
+			self.steps.close()
+			self.steps = None
+
+		rgCleanups = getattr(self, "rgCleanups", [])
+		self.rgCleanups = []
+		if fFinished:
+			return
+		for fnCleanup in reversed(rgCleanups):
+			try:
+				fnCleanup()
+			except Exception as e:
+				print("Cleanup after the cancelled export failed: %s" % e)
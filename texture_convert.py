@@ -0,0 +1,214 @@
+# ***** BEGIN GPL LICENSE BLOCK *****
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+
+# ***** END GPL LICENCE BLOCK *****
+
+# resizing and transcoding of the delivered textures (see asset_copy.py):
+# the converted images are made by background blenders and kept in a cache
+# by the hash of the source file and the options, so each one is only
+# converted once.
+#
+# the background blender is the other half of this file:
+#   blender -b --python texture_convert.py -- --convert jobs.json
+
+import sys
+import os
+import json
+import hashlib
+import tempfile
+
+if __name__ == "__main__":
+	# run in a background blender: the helper modules are next to this file
+	sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import asset_copy
+
+try:
+	import bpy
+except ImportError:
+	bpy = None
+
+# output format -> (extension, blender file format)
+mapFormats = {
+	'PNG' : ('.png', 'PNG'),
+	'JPEG' : ('.jpg', 'JPEG'),
+}
+# extensions of the sources (format 'SOURCE': the same format again)
+mapExtensionFormats = {
+	'.png' : 'PNG',
+	'.jpg' : 'JPEG',
+	'.jpeg' : 'JPEG',
+	'.tga' : 'TARGA',
+	'.bmp' : 'BMP',
+}
+
+dirDefaultCache = os.path.join(tempfile.gettempdir(), "blender_texture_cache")
+
+
+def getTargetSize(cWidth, cHeight, iMaxSize, fPowerOfTwo):
+	"""the size of the delivered image: at most iMaxSize (0: any) on the
+	longer side, keeping the aspect, and rounded down to powers of two"""
+	if iMaxSize and max(cWidth, cHeight) > iMaxSize:
+		rScale = float(iMaxSize) / max(cWidth, cHeight)
+		cWidth, cHeight = max(1, int(cWidth * rScale + 0.5)), max(1, int(cHeight * rScale + 0.5))
+	if fPowerOfTwo:
+		cWidth, cHeight = [1 << (max(1, c).bit_length() - 1) for c in (cWidth, cHeight)]
+	return cWidth, cHeight
+
+
+def createConverter(iMaxSize, fPowerOfTwo, sFormat):
+	"""the converter for the export options, None if the textures are delivered as they are"""
+	if not iMaxSize and not fPowerOfTwo and sFormat == 'SOURCE':
+		return None
+	return TextureConverter(iMaxSize, fPowerOfTwo, sFormat)
+
+
+class TextureConverter:
+	"""the conversion options of an export (see asset_copy.AssetCopier)"""
+
+	def __init__(self, iMaxSize=0, fPowerOfTwo=False, sFormat='SOURCE', fnBlender=None, dirCache=None, cProcesses=None):
+		import multiprocessing
+		self.iMaxSize = iMaxSize
+		self.fPowerOfTwo = fPowerOfTwo
+		self.sFormat = sFormat
+		self.fnBlender = fnBlender or (bpy.app.binary_path if bpy else "blender")
+		self.dirCache = dirCache or dirDefaultCache
+		self.cProcesses = cProcesses or multiprocessing.cpu_count()
+
+	def getName(self, fnDest):
+		"""the name of the delivered file (the extension of the format)"""
+		if self.sFormat == 'SOURCE':
+			# (sources in other formats are delivered as png, see getFormat)
+			if os.path.splitext(fnDest)[1].lower() in mapExtensionFormats:
+				return fnDest
+			return os.path.splitext(fnDest)[0] + mapFormats['PNG'][0]
+		return os.path.splitext(fnDest)[0] + mapFormats[self.sFormat][0]
+
+	def getFormat(self, fnSource):
+		if self.sFormat == 'SOURCE':
+			return mapExtensionFormats.get(os.path.splitext(fnSource)[1].lower(), mapFormats['PNG'][1])
+		return mapFormats[self.sFormat][1]
+
+	def getCacheName(self, fnSource):
+		"""the file in the cache for fnSource with these options"""
+		sKey = hashlib.sha1(("%s %i %i %s" % (asset_copy.getFileHash(fnSource), self.iMaxSize,
+			self.fPowerOfTwo, self.getFormat(fnSource))).encode("utf-8")).hexdigest()
+		return os.path.join(self.dirCache, sKey + os.path.splitext(self.getName(fnSource))[1])
+
+	def convert(self, rgSources):
+		"""converts the sources which are not yet in the cache, in up to
+		cProcesses background blenders. returns source -> cache file and the
+		(source, error) of the ones which failed"""
+		for rProgress in self.convertSteps(rgSources):
+			pass
+		return self.mapConverted, self.rgFailures
+
+	def convertSteps(self, rgSources):
+		"""convert() as generator, yields the progress (0..1) while it hashes
+		the sources and waits for the blenders (see modal_export.py). the
+		results are in mapConverted and rgFailures afterwards."""
+		import subprocess
+		import time
+
+		self.mapConverted = mapConverted = {}
+		self.rgFailures = rgFailures = []
+		rgJobs = []
+		for iSource, fnSource in enumerate(rgSources):
+			try:
+				fnCache = self.getCacheName(fnSource)
+			except (OSError, IOError) as e:
+				rgFailures.append((fnSource, str(e)))
+				continue
+			mapConverted[fnSource] = fnCache
+			if not os.path.exists(fnCache):
+				rgJobs.append({ 'source' : fnSource, 'output' : fnCache, 'format' : self.getFormat(fnSource),
+					'maxSize' : self.iMaxSize, 'powerOfTwo' : self.fPowerOfTwo })
+			yield 0.1 * (iSource + 1) / len(rgSources)
+		if not rgJobs:
+			return
+
+		if not os.path.isdir(self.dirCache):
+			os.makedirs(self.dirCache)
+		dirTemp = tempfile.mkdtemp(prefix="texture_convert_")
+		rgProcesses = []
+		# (no subprocess.DEVNULL in the python 3.2 of blender 2.63)
+		flNull = open(os.devnull, "wb")
+		try:
+			cProcesses = max(1, min(self.cProcesses, len(rgJobs)))
+			for iProcess in range(cProcesses):
+				fnJobs = os.path.join(dirTemp, "jobs%i.json" % iProcess)
+				with open(fnJobs, "wt") as fl:
+					json.dump(rgJobs[iProcess::cProcesses], fl)
+				rgProcesses.append(subprocess.Popen([self.fnBlender, "-b", "--python", os.path.abspath(__file__),
+					"--", "--convert", fnJobs], stdout=flNull, stderr=subprocess.STDOUT))
+			print("Converting %i texture(s) in %i processes..." % (len(rgJobs), cProcesses))
+			while True:
+				cRunning = len([process for process in rgProcesses if process.poll() is None])
+				if not cRunning:
+					break
+				time.sleep(0.01)
+				yield 0.1 + 0.9 * (cProcesses - cRunning) / cProcesses
+		except OSError as e:
+			rgFailures.append(("", "Could not start blender: %s" % e))
+		finally:
+			# (cancelled: the conversions which still run are not needed any more)
+			for process in rgProcesses:
+				if process.poll() is None:
+					process.kill()
+					process.wait()
+			flNull.close()
+			import shutil
+			shutil.rmtree(dirTemp, ignore_errors=True)
+
+		for job in rgJobs:
+			if not os.path.exists(job['output']):
+				rgFailures.append((job['source'], "not converted"))
+				del mapConverted[job['source']]
+
+
+############ inside blender ############
+
+def convertImage(job):
+	image = bpy.data.images.load(job['source'])
+	try:
+		cWidth, cHeight = image.size
+		size = getTargetSize(cWidth, cHeight, job['maxSize'], job['powerOfTwo'])
+		if size != (cWidth, cHeight):
+			image.scale(size[0], size[1])
+
+		settings = bpy.context.scene.render.image_settings
+		settings.file_format = job['format']
+		if job['format'] == 'JPEG':
+			settings.quality = 90
+		# (into a temporary name first: the cache never has half written files)
+		fnTemp = job['output'] + ".part"
+		image.save_render(fnTemp, bpy.context.scene)
+		os.rename(fnTemp, job['output'])
+	finally:
+		bpy.data.images.remove(image)
+
+def mainBlender(rgArgs):
+	with open(rgArgs[rgArgs.index("--convert") + 1], "rt") as fl:
+		rgJobs = json.load(fl)
+	for job in rgJobs:
+		try:
+			convertImage(job)
+		except Exception as e:
+			print("Could not convert '%s': %s" % (job['source'], e))
+
+
+if __name__ == "__main__" and bpy:
+	mainBlender(sys.argv[sys.argv.index("--") + 1:] if "--" in sys.argv else [])
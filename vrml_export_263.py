@@ -30,10 +30,6 @@ bl_info = {
     "tracker_url": "http://metaio.com",
     "category": "Import-Export"}
 
-# open TODOs:
-#   DEF/ USE for reuse of materials and textures (when using multiple objects)
-#   pack animations (e.g. only export at keys)
-
 import bpy
 from bpy.props import *
 
@@ -46,9 +42,20 @@ import mathutils
 import struct
 import random
 import os
+import json
+import tempfile
+import io
+from array import array
+
+import vrml_format
+import bake_cache
+import export_watch
+import modal_export
+import asset_copy
+import texture_convert
 
 
-class Export_VRML(bpy.types.Operator):
+class Export_VRML(bpy.types.Operator, modal_export.ModalExport):
 	"""Export to VRML file format (.wrl)"""
 	bl_idname = "export.wrl"
 	bl_label = "Export to VRML file format (.wrl)"
@@ -61,7 +68,31 @@ class Export_VRML(bpy.types.Operator):
 #exported by vrml_export258.py - version %i.%i
 """ % bl_info["version"]
 
-	rgCachedMaterials = []
+	# exported parent and children per object name (see fKeepHierarchy)
+	mapExportParent = {}
+	mapExportChildren = {}
+
+	# (file name, content) of the Inline files of the current export
+	rgInlineFiles = []
+	# the names of the Inline files the last export wrote (see batch_export.py)
+	rgLastInlineFiles = []
+	# the worker processes of the current export (None: format in blender)
+	pool = None
+	# the bake cache of the current export (None: no cache)
+	bake = None
+	# hash -> text of the previous export (None: not incremental)
+	mapPreviousChunks = None
+
+	# replaces the frame_set loop of the sampling if set (only by batch_export.exportMD2AndVRML):
+	# fnSweepFrames(rgFrames, fnSampleFrame) has to set every frame of rgFrames in
+	# ascending order and call fnSampleFrame(index of the frame in rgFrames) there.
+	fnSweepFrames = None
+
+	# DEF names of materials and appearances already written (reused via USE)
+	setCachedMaterials = set()
+	mapCachedAppearances = {}
+	# the textures to copy next to the VRML file (see asset_copy.py)
+	assets = None
 
 	templateMatNode = """
 					material DEF %(name)s Material 
@@ -84,6 +115,12 @@ class Export_VRML(bpy.types.Operator):
 	creaseAngle = FloatProperty(name = "crease angle (rad)", 
 				 default = 0.0, min = 0.0, max = 6.28,
 				 description = "Crease angle - how normals should be shared on creases.")
+	fExportNormals = BoolProperty(name = "Export normals", 
+				 default = False,
+				 description = "Write precomputed (shared) normals, so clients do not have to compute them")
+	precisionNormal = IntProperty(name = "normal precision", 
+				 default = 3, min = 1, max = 8,
+				 description = "How many digits each normal component should have (equal normals are shared).")
 	globalScale = FloatProperty(name = "global scale", 
 				 default = 1.0, 
 				 description = "A global scaling can be applied to all coordinates.")
@@ -110,23 +147,147 @@ class Export_VRML(bpy.types.Operator):
 				 default = ((bpy.context.scene.frame_end - bpy.context.scene.frame_start+1) / float(bpy.context.scene.frame_step * bpy.context.scene.render.fps)),
 				 min = 0.0,
 				 description = "How long the animation (one loop) should last (in seconds).")
+	sAnimPacking = EnumProperty(name = "Animation packing",
+				 items = [('NONE', "None", "Write every sampled frame"),
+				          ('KEYS', "Keyframes", "Only write the samples at the keyframes of the object's (and its parents') actions"),
+				          ('TOLERANCE', "Tolerance", "Drop samples which are interpolated within the given tolerances")],
+				 default = 'NONE',
+				 description = "How the sampled animation should be reduced before writing the interpolators.")
+	rTolTranslation = FloatProperty(name = "Translation tolerance", 
+				 default = 0.001, min = 0.0,
+				 description = "Max. deviation of the interpolated translation (blender units) when packing by tolerance.")
+	rTolRotation = FloatProperty(name = "Rotation tolerance (rad)", 
+				 default = 0.002, min = 0.0, max = 3.14,
+				 description = "Max. deviation of the interpolated rotation when packing by tolerance.")
+	rTolScale = FloatProperty(name = "Scale tolerance", 
+				 default = 0.001, min = 0.0,
+				 description = "Max. deviation of the interpolated scale when packing by tolerance.")
+	fExportNgons = BoolProperty(name = "Export n-gons", 
+				 default = False,
+				 description = "Write polygons as they are instead of tesselated faces (only concave polygons are split)")
+	fKeepHierarchy = BoolProperty(name = "Keep parent hierarchy", 
+				 default = False,
+				 description = "Nest the transforms of exported children in their parents (local matrices, smaller animations)")
+	sBakeCache = StringProperty(name = "Bake cache file", 
+				 default = "", subtype = 'FILE_PATH',
+				 description = "Also save the sampled geometry and animation to this file (re-encode without blender: bake_cache.py)")
+	fGenerateLOD = BoolProperty(name = "Generate LOD", 
+				 default = False,
+				 description = "Write LOD nodes with decimated levels of each (static) shape for distant viewing")
+	iLODLevels = IntProperty(name = "LOD levels", 
+				 default = 2, min = 1, max = 3,
+				 description = "Number of decimated levels besides the full geometry")
+	rLODCellSize = FloatProperty(name = "LOD cell size", 
+				 default = 0.05, min = 0.001, max = 0.5,
+				 description = "Size of the vertex clusters of the first decimated level (relative to the object size, doubled per level)")
+	rLODDistance = FloatProperty(name = "LOD distance", 
+				 default = 10.0, min = 0.0,
+				 description = "Viewer distance at which the first decimated level is used (doubled per level)")
+	fSolidHints = BoolProperty(name = "Solid/ccw hints", 
+				 default = True,
+				 description = "Mark closed, consistently wound meshes as solid (one-sided, back face culling) with their orientation")
+	iWorkerProcesses = IntProperty(name = "Worker processes", 
+				 default = 1, min = 1, max = 64,
+				 description = "Processes which format the shapes into text in parallel (1: all in blender)")
+	fSplitInline = BoolProperty(name = "Geometry in Inline files", 
+				 default = False,
+				 description = "Write the shapes of each object (and batch) into their own .wrl file, referenced by an Inline node")
+	sTextureCopy = EnumProperty(name = "Texture copies",
+				 items = [('COPY', "Copy", "Copy the textures next to the VRML file"),
+				          ('HARDLINK', "Hardlink", "Hardlink the textures next to the VRML file (copies where that is not possible)"),
+				          ('REFLINK', "Reflink", "Copy-on-write clones of the textures, on file systems which can (copies elsewhere)")],
+				 default = 'COPY',
+				 description = "How the textures are put next to the VRML file (unchanged ones are not copied again)")
+	iMaxTextureSize = IntProperty(name = "Max. texture size", 
+				 default = 0, min = 0, max = 16384,
+				 description = "Scale the copied textures down to at most this many pixels on the longer side (0: keep the size)")
+	fTexturePowerOfTwo = BoolProperty(name = "Power of two textures", 
+				 default = False,
+				 description = "Scale the copied textures down to powers of two")
+	sTextureFormat = EnumProperty(name = "Texture format",
+				 items = [('SOURCE', "Source", "Keep the format of the textures"),
+				          ('PNG', "PNG", "Deliver the textures as PNG"),
+				          ('JPEG', "JPEG", "Deliver the textures as JPEG (smaller, no alpha)")],
+				 default = 'SOURCE',
+				 description = "Format of the copied textures (converted textures are cached by the hash of their source)")
+	fIncremental = BoolProperty(name = "Incremental", 
+				 default = False,
+				 description = "Reuse the text of unchanged shapes and animations from the previous export (hashes in <file>.hashes) and leave unchanged files untouched")
+	fWatch = BoolProperty(name = "Watch", 
+				 default = False,
+				 description = "Repeat this export in the background whenever the exported objects change or the file is saved (incremental)")
+	sSourceFile = StringProperty(name = "Source file", 
+				 default = "", options = {'HIDDEN'},
+				 description = "The .blend named in the output (empty: the current file), the watch exports run on a copy of it")
+	fBatchStatic = BoolProperty(name = "Batch static objects", 
+				 default = False,
+				 description = "Merge all non-animated objects with the same material/texture into one shape (world coordinates)")
+	fSpatialHierarchy = BoolProperty(name = "Spatial hierarchy", 
+				 default = False,
+				 description = "Group static objects into a bounding volume hierarchy of Group nodes (for culling on the client)")
+	iMaxLeafObjects = IntProperty(name = "Objects per group", 
+				 default = 8, min = 1, max = 1000,
+				 description = "How many objects a group of the spatial hierarchy holds at most.")
+	fExportVertexAnimation = BoolProperty(name = "Export vertex animation", 
+				 default = False,
+				 description = "Whether deformed meshes (armatures, deforming modifiers, shape keys) should be animated per vertex")
+	fOmitStaticVertices = BoolProperty(name = "Omit static vertices", 
+				 default = True,
+				 description = "Only animate the faces of deformed meshes which actually move")
+	rTolVertex = FloatProperty(name = "Vertex tolerance", 
+				 default = 0.0, min = 0.0,
+				 description = "Drop frames of the vertex animation which are interpolated within this deviation (blender units, 0: keep all)")
 			
 
-	def writeObject(self, flVRML, obj, dirOut):
+	def getAppearance(self, obj, dirOut):
+		"""returns material, material DEF name and texture file name of obj
+		(and adds the texture to the files copied next to the VRML file)"""
 
-
-		# object has material?
-		materialNode = ""
-
-		if obj.material_slots:
-			# see if we already wrote this material (to save space)
+		# object has material? (only the first slot is exported)
+		mat = None
+		sMatNameDEF = None
+		if obj.material_slots and obj.material_slots[0].material:
 			mat = obj.material_slots[0].material
 			sMatNameDEF = mat.name.replace(".","_").replace(" ","_")
 
-			if sMatNameDEF in self.rgCachedMaterials:
+		# see if we also have a texture (as image):
+		fnTexture = None
+		for matTex in obj.data.materials:
+			if not matTex:
+				continue
+			for texSlot in matTex.texture_slots:
+				if texSlot and texSlot.texture.type == "IMAGE":
+					# this is now relative to the scene file (important for
+					# copying later)
+					fnTexture = bpy.path.relpath(texSlot.texture.image.filepath)[2:]
+					# (copied at the end of the export, each file once; the
+					# url is the delivered file, it may be converted)
+					fnTexture = self.assets.add(bpy.path.abspath(texSlot.texture.image.filepath),
+						os.path.join(dirOut, os.path.basename(fnTexture)))
+					break
+
+		return mat, sMatNameDEF, fnTexture
+
+	def getAppearanceNode(self, mat, sMatNameDEF, fnTexture):
+		# the whole appearance (material + texture) is shared between shapes:
+		# the first shape writes it with DEF, all others only USE it.
+		keyAppearance = (sMatNameDEF, fnTexture)
+		if keyAppearance in self.mapCachedAppearances:
+			return "appearance USE %s" % self.mapCachedAppearances[keyAppearance]
+
+		sAppearanceDEF = "APP_%i_%s" % (len(self.mapCachedAppearances), sMatNameDEF or "NOMAT")
+		self.mapCachedAppearances[keyAppearance] = sAppearanceDEF
+		return "appearance DEF %s %s" % (sAppearanceDEF, self.formatAppearance(mat, sMatNameDEF, fnTexture))
+
+	def formatAppearance(self, mat, sMatNameDEF, fnTexture):
+		"""the Appearance node itself (without DEF), the material is only USEd if it was written before"""
+		materialNode = ""
+		if mat:
+			# see if we already wrote this material (e.g. with another texture)
+			if sMatNameDEF in self.setCachedMaterials:
 				materialNode = "\n material USE %s\n" % sMatNameDEF
 			else:
-				self.rgCachedMaterials.append(sMatNameDEF)
+				self.setCachedMaterials.add(sMatNameDEF)
 
 				diffuseColor = "%.5f %.5f %.5f" % tuple(mat.diffuse_color)
 				ambientIntensity = "%.5f" % mat.diffuse_intensity
@@ -144,163 +305,447 @@ class Export_VRML(bpy.types.Operator):
 					'name' : sMatNameDEF,
 				}
 
-
-		# see if we also have a texture (as image):
-		fnTexture = None
-		for mat in obj.data.materials:
-			for texSlot in mat.texture_slots:
-				if texSlot and texSlot.texture.type == "IMAGE":
-					# this is now relative to the scene file (important for
-					# copying later)
-					fnTexture = bpy.path.relpath(texSlot.texture.image.filepath)[2:]
-					break
-			
 		textureNode = ""
-		if fnTexture:		
-			# a) copy the texture
-			import os.path
-			import shutil
-			# path to blender scene is this:
-			fnBlend = bpy.data.filepath
-			try:
-				shutil.copy2(os.path.join(os.path.dirname(fnBlend), fnTexture),
-					os.path.join(dirOut, os.path.basename(fnTexture)))
-			except: 
-				print("Could not copy texture.")
-				
+		if fnTexture:
 			# ok -> now tell the VRML that we have a texture:
 			textureNode = 'texture ImageTexture { url "%s" }' % os.path.basename(fnTexture)
-				
+
+		return """Appearance 
+		{
+			%s
+			%s
+		}""" % (materialNode, textureNode)
+
+	def writeObject(self, flVRML, obj, mesh, dirOut, vertexStream=None, fClose=True):
+
+		mat, sMatNameDEF, fnTexture = self.getAppearance(obj, dirOut)
 
 		# now deal with the transformation:
+		matrix = self.getExportMatrix(obj)
 		axisAngle = [0.0,0.0,0.0,0.0] # first axis, then angle
-		quat = obj.matrix_world.to_quaternion()
+		quat = matrix.to_quaternion()
 		axisAngle[0:3] = quat.axis
 		axisAngle[3] = quat.angle
 
 		#tuple(obj.material_slots[0].material.diffuse_color)
 
 		mapValues = { 'name' : obj.name.replace(".", "_"),
-			'scale' : "%.5f %.5f %.5f" % obj.matrix_world.to_scale().to_tuple(),
-			'location' : "%.5f %.5f %.5f" % obj.matrix_world.to_translation().to_tuple(),
+			'scale' : "%.5f %.5f %.5f" % matrix.to_scale().to_tuple(),
+			'location' : "%.5f %.5f %.5f" % matrix.to_translation().to_tuple(),
 			'rotation' : "%.5f %.5f %.5f %.5f" % tuple(axisAngle),
-			'materialNode' : materialNode,
-			'textureNode' : textureNode,
-			'creaseAngle' : self.creaseAngle,
 		}
 
+		# (BLENDER MUST BE IN OBJECT MODE FOR THIS)
+		geometry = self.getGeometry(mesh, fnTexture)
+
+		if self.bake:
+			objParent = self.mapExportParent.get(obj.name)
+			self.bakeObject(mapValues['name'], objParent.name.replace(".", "_") if objParent else None,
+				[list(matrix.to_scale()), axisAngle, list(matrix.to_translation())], geometry, mat, sMatNameDEF, fnTexture)
+
+		# the bounding box (in object space) also covers the vertex animation
+		bounds = geometry.getBounds()
+		if obj.name in self.mapExportChildren:
+			bounds = None # would have to enclose the (possibly animated) children, too
+		if bounds and vertexStream and vertexStream.fValid:
+			bounds = Util.unionBounds(bounds, vertexStream.getBounds())
+
 		# write the first chunk:
 		flVRML.write(
 """DEF %(name)s Transform {
 	scale %(scale)s
 	rotation %(rotation)s
 	translation %(location)s
-	children [ 
-	Shape 
-	{
-		appearance Appearance 
-		{
-			%(materialNode)s
-			%(textureNode)s
-		}
-		geometry IndexedFaceSet {
-			solid FALSE
-			creaseAngle %(creaseAngle).3f
 """ % mapValues)
+		if bounds:
+			flVRML.write("	bboxCenter %s\n	bboxSize %s\n" % Util.formatBounds(bounds))
+		flVRML.write("	children [ \n")
+
+		# deformed meshes: the animated part gets its own (DEF'd) coordinates
+		rgParts = [(geometry, None)]
+		if vertexStream and vertexStream.fValid:
+			rgParts = vertexStream.splitGeometry(geometry, "%s_Coord" % mapValues['name'])
+
+		# (the animated coordinates have to stay here, ROUTEs cannot reach into an Inline)
+		if self.fSplitInline:
+			rgInlineGeometries = [geometryPart for geometryPart, coordDEF in rgParts if coordDEF is None]
+			rgParts = [part for part in rgParts if part[1] is not None]
+			if rgInlineGeometries:
+				self.writeInline(flVRML, mapValues['name'], mat, sMatNameDEF, fnTexture, rgInlineGeometries)
+
+		for geometryPart, coordDEF in rgParts:
+			self.writeGeometry(flVRML, mat, sMatNameDEF, fnTexture, geometryPart, coordDEF)
+
+		if fClose:
+			# this closes the transform.
+			flVRML.write("\n ] } # end of transform for '%s'\n\n" % obj.name)
+
+	def writeItem(self, flVRML, item, scene, dirOut, mapBatches, mapVertexStreams):
+		"""writes one object (with its own transform) or one batch of static objects"""
+		sType, payload = item
+		if sType == 'OBJECT':
+			obj = payload
+			print("   ...'%s'" % obj.name)
 
-		######### UV COORDS ###########
-		# if we have a texture: write the coords.
-		if fnTexture:
-			# ok -> just trying: (BLENDER MUST BE IN OBJECT MODE FOR THIS)
-
-			# dump all faces.
-			iTexCoord = 0
-			rgTexIndex = []
-
-			flVRML.write(" texCoord TextureCoordinate { \n point [ \n")
-			uvData = obj.data.tessface_uv_textures[0].data # shortcut for below.
-
-			sPrecUV = 2*("%%.%if "% self.precisionUV)+ ", "
-			for texFace in uvData:
-				rgLocIndex = []
-				for uv in texFace.uv:
-					rgLocIndex.append(iTexCoord)
-					iTexCoord+=1
-					flVRML.write(sPrecUV % tuple(uv))
-				rgTexIndex.append(tuple(rgLocIndex))
-
-			flVRML.write("] \n } \n")
-
-			# now write the indices
-			flVRML.write(" texCoordIndex [ \n" )
-			for texIndexFace in rgTexIndex:
-				for texIndex in texIndexFace:
-					flVRML.write("%i " % texIndex)
-				flVRML.write("-1 ")
-			flVRML.write("\n]\n")
-					
-
-			
-
-		######### XYZ COORDS ###########
-		# ok, now on to the actual coordinates of the mesh etc.
-		flVRML.write("coordIndex [\n ")
-		for face in obj.data.tessfaces:
-			for iCoord in face.vertices:
-				flVRML.write("%i, " % iCoord)
-			flVRML.write("-1, ")
-
-		flVRML.write("] \n coord Coordinate { point [\n ")
-
+			# export this one (one evaluated mesh at a time):
+			mesh = obj.to_mesh(scene, True, 'PREVIEW')
+			try:
+				if not self.fExportNgons:
+					mesh.update(calc_tessface=True) # compute tesselation from ngons
+				self.writeObject(flVRML, obj, mesh, dirOut, mapVertexStreams.get(obj.name), False)
+			finally:
+				bpy.data.meshes.remove(mesh)
+
+			# the children are nested in the transform of their parent
+			for objChild in self.mapExportChildren.get(obj.name, []):
+				self.writeItem(flVRML, ('OBJECT', objChild), scene, dirOut, mapBatches, mapVertexStreams)
+
+			# this closes the transform.
+			flVRML.write("\n ] } # end of transform for '%s'\n\n" % obj.name)
+			return
+
+		(mat, sMatNameDEF, fnTexture), rgBatchObjects = mapBatches[payload]
+		print("   ...batch of %i static objects (%s)" % (len(rgBatchObjects), sMatNameDEF or "no material"))
+
+		geometry = Geometry()
+		for obj in rgBatchObjects:
+			mesh = obj.to_mesh(scene, True, 'PREVIEW')
+			try:
+				# bake the world transform into the vertices (in one go)
+				mesh.transform(obj.matrix_world)
+				if hasattr(mesh, "calc_normals"):
+					mesh.calc_normals()
+				if not self.fExportNgons:
+					mesh.update(calc_tessface=True)
+				geometryObj = self.getGeometry(mesh, fnTexture)
+				if obj.matrix_world.determinant() < 0.0:
+					geometryObj.flip() # mirrored -> keep the faces pointing outwards
+				geometry.extend(geometryObj)
+			finally:
+				bpy.data.meshes.remove(mesh)
+
+		flVRML.write("# static batch of: %s\n" % ", ".join([obj.name for obj in rgBatchObjects]))
+		if self.bake:
+			self.bakeObject("BATCH_%i" % len(self.bake.meta['vrml']['objects']), None, None, geometry, mat, sMatNameDEF, fnTexture)
+		if self.fSplitInline:
+			sName = "BATCH_%s_%s" % (sMatNameDEF or "NOMAT", 
+				os.path.splitext(os.path.basename(fnTexture))[0] if fnTexture else "NOTEX")
+			self.writeInline(flVRML, sName, mat, sMatNameDEF, fnTexture, [geometry])
+		else:
+			self.writeGeometry(flVRML, mat, sMatNameDEF, fnTexture, geometry)
+
+	def bakeObject(self, sName, sParent, transform, geometry, mat, sMatNameDEF, fnTexture):
+		"""saves the geometry of one object (or batch) in the bake cache"""
+		# the appearance on its own (without DEF, with its material), whatever was
+		# written before: the re-encoding shares it by material and texture
+		cacheMaterials = self.setCachedMaterials
+		self.setCachedMaterials = set()
+		try:
+			sAppearance = self.formatAppearance(mat, sMatNameDEF, fnTexture)
+		finally:
+			self.setCachedMaterials = cacheMaterials
+
+		rgObjects = self.bake.meta['vrml']['objects']
+		sPrefix = "obj.%i." % len(rgObjects)
+		self.bake.addArray(sPrefix + "faceSizes", 'I', [len(face) for face in geometry.rgCoordIndex])
+		for sArray, sTypecode, rgValues in (('coords', 'f', geometry.rgCoords), ('coordIndex', 'I', geometry.rgCoordIndex),
+				('texCoords', 'f', geometry.rgTexCoords), ('texCoordIndex', 'I', geometry.rgTexCoordIndex),
+				('normals', 'f', geometry.rgNormals), ('normalIndex', 'I', geometry.rgNormalIndex)):
+			self.bake.addArray(sPrefix + sArray, sTypecode, [value for rgTuple in rgValues for value in rgTuple])
+		rgObjects.append({ 'name' : sName, 'parent' : sParent, 'transform' : transform, 'appearance' : sAppearance,
+			'matDEF' : sMatNameDEF, 'texture' : os.path.basename(fnTexture) if fnTexture else None,
+			'fConvex' : geometry.fConvex, 'fTexCoords' : bool(geometry.rgTexCoordIndex), 'fNormals' : bool(geometry.rgNormalIndex) })
+
+	def writeInline(self, flVRML, sName, mat, sMatNameDEF, fnTexture, rgGeometries):
+		"""writes the shapes into their own file (kept in rgInlineFiles for now)
+		and references it by an Inline node"""
+		fnInline = "%s_%s.wrl" % (os.path.splitext(os.path.basename(self.fnLast))[0],
+			"".join([c if c.isalnum() or c in "-_" else "_" for c in sName]))
+
+		# DEF/USE does not work across files -> the inline file has its own appearances
+		cacheMaterials, cacheAppearances = self.setCachedMaterials, self.mapCachedAppearances
+		self.setCachedMaterials, self.mapCachedAppearances = set(), {}
+		flInline = vrml_format.OrderedOutput(io.StringIO(), self.pool, self.mapPreviousChunks)
+		try:
+			flInline.write(self.vrmlHeader)
+			bounds = None
+			for geometry in rgGeometries:
+				self.writeGeometry(flInline, mat, sMatNameDEF, fnTexture, geometry)
+				boundsGeometry = geometry.getBounds()
+				if boundsGeometry:
+					bounds = Util.unionBounds(bounds, boundsGeometry) if bounds else boundsGeometry
+		finally:
+			self.setCachedMaterials, self.mapCachedAppearances = cacheMaterials, cacheAppearances
+		self.rgInlineFiles.append((fnInline, flInline))
+
+		flVRML.write('	Inline {\n		url "%s"\n' % fnInline)
+		if bounds:
+			flVRML.write("		bboxCenter %s\n		bboxSize %s\n" % Util.formatBounds(bounds))
+		flVRML.write("	}\n")
+
+	def writeHierarchy(self, flVRML, node, scene, dirOut, mapBatches, mapVertexStreams):
+		"""writes a node of the spatial hierarchy as Group (with bounding box),
+		yields every item when it is written"""
+		flVRML.write("Group {\n	bboxCenter %s\n	bboxSize %s\n	children [\n" % Util.formatBounds(node.bounds))
+		for child in node.rgChildren:
+			for item in self.writeHierarchy(flVRML, child, scene, dirOut, mapBatches, mapVertexStreams):
+				yield item
+		for item in node.rgItems:
+			self.writeItem(flVRML, item, scene, dirOut, mapBatches, mapVertexStreams)
+			yield item
+		flVRML.write("] } # end of group\n")
+
+	def getExportMatrix(self, obj):
+		"""the world matrix, or the matrix relative to the exported parent (hierarchy)"""
+		objParent = self.mapExportParent.get(obj.name)
+		if objParent:
+			return objParent.matrix_world.inverted() * obj.matrix_world
+		return obj.matrix_world
+
+	def isRelativeToParent(self, obj):
+		"""whether obj is nested directly in the transform of its blender parent"""
+		objParent = self.mapExportParent.get(obj.name)
+		return objParent is not None and objParent == obj.parent and obj.parent_type == 'OBJECT'
+
+	def getSubtree(self, obj):
+		"""obj and all its exported descendants"""
+		rgSubtree = [obj]
+		for objChild in self.mapExportChildren.get(obj.name, []):
+			rgSubtree.extend(self.getSubtree(objChild))
+		return rgSubtree
+
+	def getGeometry(self, mesh, fnTexture):
+		cNormalDigits = self.precisionNormal if self.fExportNormals else None
+		if self.fExportNgons:
+			fTexCoords = fnTexture is not None and len(mesh.uv_layers) > 0
+			return Geometry.fromPolygons(mesh, fTexCoords, cNormalDigits)
+
+		fTexCoords = fnTexture is not None and len(mesh.tessface_uv_textures) > 0
+		return Geometry.fromTessfaces(mesh, fTexCoords, cNormalDigits)
+
+	def isAnimated(self, obj, store, mapVertexStreams):
+		"""whether the transformation or the vertices of obj change during the exported animation"""
+		if not self.fExportAnimation:
+			return False
+		if obj.name in mapVertexStreams:
+			return True
+		if obj.name not in store:
+			return False
+		rTolChange = 0.5 * 10**-self.precisionXYZ
+		for sChannel in AnimSampleStore.mapComponents:
+			if store.isAnimated(obj.name, sChannel, rTolChange):
+				return True
+		return False
+
+	def writeGeometry(self, flVRML, mat, sMatNameDEF, fnTexture, geometry, coordDEF=None):
+		"""writes the shape, or a LOD node with the shape and its decimated levels
+		(not for animated coordinates, the interpolator only knows the full level)"""
+		bounds = geometry.getBounds()
+		if not self.fGenerateLOD or coordDEF or not bounds:
+			self.writeShape(flVRML, self.getAppearanceNode(mat, sMatNameDEF, fnTexture), geometry, coordDEF)
+			return
+
+		# the cells of the vertex clustering double in size with every level
+		rSize = max([bounds[1][i] - bounds[0][i] for i in range(3)])
+		rgLevels = [geometry]
+		for iLevel in range(self.iLODLevels):
+			geometryLevel = geometry.decimate(rSize * self.rLODCellSize * 2**iLevel)
+			if not geometryLevel.rgCoordIndex:
+				break # nothing left to show
+			rgLevels.append(geometryLevel)
+
+		rgRanges = [self.rLODDistance * 2**iLevel for iLevel in range(len(rgLevels) - 1)]
+		center = [(bounds[0][i] + bounds[1][i]) / 2.0 for i in range(3)]
+		flVRML.write("	LOD {\n	center %.5f %.5f %.5f\n" % tuple(center))
+		flVRML.write("	range [ %s ]\n	level [\n" % ", ".join(["%.5f" % r for r in rgRanges]))
+		for geometryLevel in rgLevels:
+			# the first level defines the appearance, the others USE it
+			self.writeShape(flVRML, self.getAppearanceNode(mat, sMatNameDEF, fnTexture), geometryLevel)
+		flVRML.write("	] } # end of LOD\n")
+
+	def writeShape(self, flVRML, appearanceNode, geometry, coordDEF=None):
+		# the formatting is pure python and may run in a worker process (see vrml_format)
+		geometryArrays = (geometry.rgCoords, geometry.rgCoordIndex, geometry.rgTexCoords,
+			geometry.rgTexCoordIndex, geometry.rgNormals, geometry.rgNormalIndex, geometry.fConvex)
+		options = (self.precisionXYZ, self.precisionUV, self.precisionNormal, self.creaseAngle, self.fSolidHints)
+		flVRML.writeFormatted(vrml_format.formatShape, appearanceNode, geometryArrays, coordDEF, options)
+
+	def writeInterpolator(self, flVRML, sNodeType, intDEF, rgKeys, rgValues, rgIndices, sPrecValue, timerDEF, objDEF, sField):
+		"""writes an interpolator for the samples rgIndices (None: all) and routes it to objDEF.sField"""
+		sPrecKEY = ("%%.%if "% self.precisionKey) + ", "
+		flVRML.writeFormatted(vrml_format.formatInterpolator, sNodeType, intDEF, rgKeys, rgValues, rgIndices,
+			sPrecValue, sPrecKEY, timerDEF, objDEF, sField)
+
+	def writeCoordinateInterpolator(self, flVRML, vertexStream, rgKeys, timerDEF, intDEF):
+		"""writes the streamed vertex animation (frame by frame) and routes it to its Coordinate node"""
+		sPrecKEY = ("%%.%if "% self.precisionKey) + ", "
 		sPrecXYZ = 3*("%%.%if "% self.precisionXYZ) + ", "
-		for vertex in obj.data.vertices:
-			flVRML.write(sPrecXYZ % tuple(vertex.co))
-			
-		# close the geometry, and off we go!
-		flVRML.write("""]
-				} # end of Coordinate""")
-
-		flVRML.write("\n  } # end of indexedFaceSet \n} # end of shape ")
 
-		# this closes the transform.
-		flVRML.write("\n ] } # end of transform for '%s'\n\n" % obj.name)
+		flVRML.write("""\nDEF %s CoordinateInterpolator {
+						key [ """ % intDEF)
+		for iSample in vertexStream.rgSamples:
+			flVRML.write(sPrecKEY % rgKeys[iSample])
+		flVRML.write("]\n keyValue [ ") 
+
+		for rgCoords in vertexStream.iterFrames():
+			flVRML.write("".join([sPrecXYZ % co for co in rgCoords]))
+			flVRML.write("\n")
+		flVRML.write("]\n}\n")
+
+		# and now route the animation.
+		flVRML.write("ROUTE %s.fraction_changed TO %s.set_fraction\n" % (timerDEF, intDEF))
+		flVRML.write("ROUTE %s.value_changed TO %s.set_point\n" % (intDEF, vertexStream.coordDEF))
+
+	def getKeyframeIndices(self, obj, cFrames):
+		"""returns the sample indices closest to the keyframes of obj and its parents (None: no keys found)"""
+		setIndices = set()
+		objKeyed = obj
+		while objKeyed:
+			if objKeyed.animation_data and objKeyed.animation_data.action:
+				for fcurve in objKeyed.animation_data.action.fcurves:
+					for keyframe in fcurve.keyframe_points:
+						iSample = int(round((keyframe.co[0] - self.iAnimFrameStart) / float(self.iAnimStep)))
+						if 0 <= iSample < cFrames:
+							setIndices.add(iSample)
+			objKeyed = objKeyed.parent
+
+		if not setIndices:
+			# animated by something else (constraints, drivers, ...) -> keep everything
+			return None
+
+		# always keep the first and the last sample (the loop must not change)
+		setIndices.update([0, cFrames-1])
+		return sorted(setIndices)
 
-		
 	def execute(self, context):
 		
 		fnVRML = self.filepath
 		fnVRML = bpy.path.ensure_ext(fnVRML, self.filename_ext)
 
-		# go into object mode before we start the actual export procedure
-		bpy.ops.object.mode_set(mode="OBJECT", toggle=False)
+		# called without invoke (scripts, batch_export.py): the scene still decides what was not given
+		self.setSceneDefaults(context.scene, True)
 
+		# go into object mode before we start the actual export procedure
+		# (edit mode changes are not yet in the mesh data otherwise)
+		if context.mode != 'OBJECT':
+			bpy.ops.object.mode_set(mode="OBJECT", toggle=False)
+
+		# the scene and the selection are not touched: the geometry is
+		# taken from a temporary evaluated mesh per object.
+		rgObjects = Util.getExportObjects(context)
+		if not rgObjects:
+			self.report({'ERROR'},  "No object to export left.")
+			return {'CANCELLED'}
 
-		# open the file
-		flVRML = open(fnVRML, "wt")
+		return self.runExport(context, self.exportSteps(context, fnVRML, rgObjects))
+
+	def exportSteps(self, context, fnVRML, rgObjects):
+		"""the export as generator, yields the progress (see modal_export.py)"""
+		# with the hierarchy, children are exported relative to (and inside of)
+		# their closest exported ancestor.
+		setObjNames = set([obj.name for obj in rgObjects])
+		self.mapExportParent = {}
+		self.mapExportChildren = {}
+		for obj in rgObjects:
+			objParent = None
+			if self.fKeepHierarchy:
+				objParent = obj.parent
+				while objParent and objParent.name not in setObjNames:
+					objParent = objParent.parent
+			self.mapExportParent[obj.name] = objParent
+			if objParent:
+				self.mapExportChildren.setdefault(objParent.name, []).append(obj)
+
+		# open the file (the shapes may be formatted by worker processes,
+		# they are written in order anyway). incremental: into a temporary
+		# file, which only replaces the old one if something changed
+		self.pool = vrml_format.createPool(self.iWorkerProcesses, getattr(bpy.app, "binary_path_python", None))
+		self.mapPreviousChunks = Util.loadChunks(fnVRML) if self.fIncremental else None
+		fnWrite = fnVRML + ".tmp" if self.fIncremental else fnVRML
+		flVRML = vrml_format.OrderedOutput(open(fnWrite, "wt"), self.pool, self.mapPreviousChunks)
+		# cancelled: the partial file goes (the old one stays if incremental),
+		# but not the finished one (e.g. cancelled while the textures are copied)
+		self.fFinishedVRML = False
+		def removePartial():
+			if self.fFinishedVRML:
+				return
+			flVRML.fl.close()
+			os.remove(fnWrite)
+		self.addCleanup(removePartial)
+		if self.pool:
+			self.addCleanup(self.pool.terminate)
 
 		print("Exporting to %s" % fnVRML)
 		flVRML.write(self.vrmlHeader)
-		flVRML.write("# from blender file: '%s'\n" % bpy.data.filepath)
+		flVRML.write("# from blender file: '%s'\n" % (self.sSourceFile or bpy.data.filepath))
 		if self.fExportAnimation:
 			flVRML.write("# animation created from frames %i to %i (stepsize %i)\n" %
 				(self.iAnimFrameStart, self.iAnimFrameStop, self.iAnimStep))
 
-		# the original names (to restore the selection and active object)
-		rgObjNamesOriginal = [obj.name for obj in context.selected_objects]
-		objNameActive = bpy.context.active_object.name
-
-		# for the tesselation, we need copies of the data anyhow -> duplicate them.
-		bpy.ops.object.duplicate()
-		# now apply the modifiers to the current selection:
-		bpy.ops.object.convert(keep_original=False)
-		# new selection will consist of only modified geometry.
-		for obj in context.selected_objects:
-			obj.data.update(calc_tessface=True) # compute tesselation from ngons
+		mapVertexStreams = {}
+		if self.fExportAnimation and self.fExportVertexAnimation:
+			rTolMoving = max(self.rTolVertex, 0.5 * 10**-self.precisionXYZ)
+			for obj in rgObjects:
+				if Util.hasDeformation(obj):
+					mapVertexStreams[obj.name] = VertexAnimStream(obj,
+						self.rTolVertex, rTolMoving, self.fOmitStaticVertices)
+		self.addCleanup(lambda: [vertexStream.close() for vertexStream in mapVertexStreams.values()])
 
 		scene = bpy.context.scene
 		iFrameInitial = scene.frame_current
+		self.addCleanup(lambda: scene.frame_set(iFrameInitial))
+		store = None
+
+		# sample the animation first (the geometry depends on the vertex animation)
 		if self.fExportAnimation:
-			iFrameInitial = scene.frame_current
+
+			print("Sampling animations...")
+			rgFrames = list(range(self.iAnimFrameStart, self.iAnimFrameStop+1, self.iAnimStep))
+
+			# only objects which are animated by something else than their
+			# own action need the (expensive) evaluation of the whole scene.
+			rgObjsAction = []
+			rgObjsSceneEval = []
+			for obj in rgObjects:
+				sSource = Util.getAnimationSource(obj, self.isRelativeToParent(obj))
+				if sSource == 'ACTION':
+					rgObjsAction.append(obj)
+				elif sSource == 'SCENE':
+					rgObjsSceneEval.append(obj)
+				# 'STATIC' -> no interpolators needed at all.
+
+			# save the affine transformation for every animated object
+			store = AnimSampleStore([obj.name for obj in rgObjsAction + rgObjsSceneEval], len(rgFrames))
+
+			for obj in rgObjsAction:
+				fRelative = self.isRelativeToParent(obj)
+				# exported ancestor further up (and static, else we would be 'SCENE')
+				matParentInv = mathutils.Matrix.Identity(4)
+				if self.mapExportParent[obj.name] and not fRelative:
+					matParentInv = self.mapExportParent[obj.name].matrix_world.inverted()
+				for iSample, matrix in enumerate(Util.evaluateActionMatrices(obj, rgFrames, fRelative)):
+					store.setSample(obj.name, iSample, matParentInv * matrix)
+
+			def sampleFrame(iSample):
+				for obj in rgObjsSceneEval:
+					store.setSample(obj.name, iSample, self.getExportMatrix(obj))
+				# deformed vertices are streamed to disk frame by frame
+				for vertexStream in mapVertexStreams.values():
+					vertexStream.addFrame(iSample, Util.getDeformedCoords(vertexStream.obj, scene))
+
+			if Export_VRML.fnSweepFrames:
+				# someone else walks the timeline (e.g. together with the md2 export)
+				Export_VRML.fnSweepFrames(rgFrames, sampleFrame)
+			elif rgObjsSceneEval or mapVertexStreams:
+				for iSample, iFrame in enumerate(rgFrames):
+					scene.frame_set(iFrame)
+					sampleFrame(iSample)
+					yield 0.5 * (iSample + 1) / len(rgFrames)
+
+			for vertexStream in mapVertexStreams.values():
+				vertexStream.finish()
+
+			# the static transforms are written for the first frame
 			scene.frame_set(self.iAnimFrameStart)
 			
 		# writing global scale info:
@@ -311,12 +756,82 @@ class Export_VRML(bpy.types.Operator):
 
 		print("Exporting geometry...")
 
-		self.rgCachedMaterials = []
-		for obj in context.selected_objects:
-			print("   ...'%s'" % obj.name)
-
-			# export this one:
-			self.writeObject(flVRML, obj, os.path.dirname(fnVRML))
+		self.setCachedMaterials = set()
+		self.mapCachedAppearances = {}
+		self.assets = asset_copy.AssetCopier(self.sTextureCopy, converter=texture_convert.createConverter(
+			self.iMaxTextureSize, self.fTexturePowerOfTwo, self.sTextureFormat))
+		self.rgInlineFiles = []
+		Export_VRML.rgLastInlineFiles = []
+		self.fnLast = fnVRML
+		dirOut = os.path.dirname(fnVRML)
+
+		self.bake = None
+		if self.sBakeCache:
+			self.bake = bake_cache.BakeCacheWriter(bpy.path.abspath(self.sBakeCache))
+			self.addCleanup(self.discardBake)
+			self.bake.meta['vrml'] = { 'blend' : self.sSourceFile or bpy.data.filepath, 'objects' : [], 'options' : dict([(sOption, getattr(self, sOption))
+				for sOption in ('precisionXYZ', 'precisionUV', 'precisionNormal', 'creaseAngle', 'fSolidHints', 'precisionKey',
+					'rAnimationDurationSec', 'fLoopAnimation', 'globalScale')]) }
+
+		# static objects can be merged per appearance (animated ones need their own transform)
+		rgObjectsSeparate = rgObjects
+		rgBatchKeys = []
+		mapBatches = {}
+		if self.fBatchStatic:
+			rgObjectsSeparate = []
+			for obj in rgObjects:
+				# objects in the hierarchy keep their transform (their children need it)
+				if self.isAnimated(obj, store, mapVertexStreams) or \
+						self.mapExportParent[obj.name] or obj.name in self.mapExportChildren:
+					rgObjectsSeparate.append(obj)
+					continue
+				appearance = self.getAppearance(obj, dirOut)
+				keyBatch = appearance[1:] # material DEF and texture
+				if keyBatch not in mapBatches:
+					rgBatchKeys.append(keyBatch)
+					mapBatches[keyBatch] = (appearance, [])
+				mapBatches[keyBatch][1].append(obj)
+
+		# the objects (and batches) which are grouped spatially: only static
+		# ones, animated objects have no fixed bounding box in the scene.
+		# (children are written by their parents)
+		rgItems = [('OBJECT', obj) for obj in rgObjectsSeparate if not self.mapExportParent[obj.name]] + \
+			[('BATCH', keyBatch) for keyBatch in rgBatchKeys]
+		rgHierarchyItems = []
+		if self.fSpatialHierarchy:
+			rgFlatItems = []
+			for item in rgItems:
+				if item[0] == 'OBJECT' and [objSub for objSub in self.getSubtree(item[1])
+						if self.isAnimated(objSub, store, mapVertexStreams)]:
+					rgFlatItems.append(item)
+				else:
+					rgHierarchyItems.append(item)
+			rgItems = rgFlatItems
+
+		# (progress: sampling up to 0.5, geometry up to 0.9, interpolators up to 1.0)
+		cItems = len(rgItems) + len(rgHierarchyItems)
+		for iItem, item in enumerate(rgItems):
+			self.writeItem(flVRML, item, scene, dirOut, mapBatches, mapVertexStreams)
+			yield 0.5 + 0.4 * (iItem + 1) / cItems
+
+		if rgHierarchyItems:
+			rgBoundedItems = []
+			for item in rgHierarchyItems:
+				if item[0] == 'OBJECT':
+					rgObjs = self.getSubtree(item[1])
+				else:
+					rgObjs = mapBatches[item[1]][1]
+				bounds = None
+				for obj in rgObjs:
+					boundsObj = Util.getWorldBounds(obj)
+					bounds = Util.unionBounds(bounds, boundsObj) if bounds else boundsObj
+				rgBoundedItems.append((bounds, item))
+
+			root = BVHNode.build(rgBoundedItems, self.iMaxLeafObjects)
+			iItem = len(rgItems)
+			for item in self.writeHierarchy(flVRML, root, scene, dirOut, mapBatches, mapVertexStreams):
+				iItem += 1
+				yield 0.5 + 0.4 * iItem / cItems
 
 		if self.globalScale != 1.0:
 			flVRML.write("\n] } # GLOBAL_SCALE\n\n")
@@ -324,36 +839,7 @@ class Export_VRML(bpy.types.Operator):
 		# now also export the animation:
 		if self.fExportAnimation:
 			
-
 			print("Exporting animations...")
-			# save the affine transformation for every exported object
-			mapObjRotation = {}
-			mapObjTranslation = {}
-			mapObjScale = {}
-			for iFrame in range(self.iAnimFrameStart, self.iAnimFrameStop+1, self.iAnimStep):
-				scene.frame_set(iFrame)
-				# bl 2011-10-18 - for now this is rather stupid - it dumps everything...
-				# get the position of each object
-				# get the rotation of each object
-				# get the scale of each object
-
-				for obj in context.selected_objects:
-					
-					if obj.name not in mapObjRotation.keys():
-						mapObjRotation[obj.name] = []
-						mapObjTranslation[obj.name] = []
-						mapObjScale[obj.name] = []
-
-					axisAngle = [0.0,0.0,0.0,0.0] # first axis, then angle
-					quat = obj.matrix_world.to_quaternion()
-					axisAngle[0:3] = quat.axis
-					axisAngle[3] = quat.angle
-
-
-					mapObjRotation[obj.name].append(tuple(axisAngle))
-					mapObjTranslation[obj.name].append(obj.matrix_world.to_translation().to_tuple())
-					mapObjScale[obj.name].append(obj.matrix_world.to_scale().to_tuple())
-
 			# ok - now we have all affine transforms per object.
 			# we further need one timer: #TODO exchange the cycle interval with Hz+FrameDuration
 			# TODO make the loop configurable.
@@ -367,178 +853,1033 @@ class Export_VRML(bpy.types.Operator):
 }\n""" % (timerDEF, self.rAnimationDurationSec, sLoop))
 
 
-			for obj in context.selected_objects:
+			sPrecXYZW = 4*("%%.%if "% self.precisionXYZ) + ", "
+			sPrecXYZ = 3*("%%.%if "% self.precisionXYZ) + ", "
+			# differences below the written precision are no animation
+			rTolChange = 0.5 * 10**-self.precisionXYZ
+			for iObj, obj in enumerate(rgObjects):
+				yield 0.9 + 0.1 * iObj / len(rgObjects)
+				if obj.name not in store:
+					continue # static object
+
 				# write the orientations first
 
 				print("   ...exporting animation of '%s'" % obj.name)
 				objDEF = obj.name.replace(".", "_")
-				sPrecKEY = ("%%.%if "% self.precisionKey) + ", "
-				sPrecXYZW = 4*("%%.%if "% self.precisionXYZ) + ", "
-				sPrecXYZ = 3*("%%.%if "% self.precisionXYZ) + ", "
-				cFrames = len(mapObjRotation[obj.name])
+				cFrames = store.cFrames
 				frameStep = 1.0 / cFrames
+				rgKeys = [iFrame * frameStep for iFrame in range(cFrames)]
+
+				rgKeyIndices = None
+				if self.sAnimPacking == 'KEYS':
+					rgKeyIndices = self.getKeyframeIndices(obj, cFrames)
 
 				# see if se have rotations
-				setRotations = set(mapObjRotation[obj.name])
-				if len(setRotations) > 1:
+				if store.isAnimated(obj.name, 'rotation', rTolChange):
 					# yes, we have different rotations:
-					orIntDEF = "%s_OriInt" % objDEF
-					flVRML.write("""\nDEF %s OrientationInterpolator {
-						key [ """ % orIntDEF)
+					rgIndices = rgKeyIndices
+					if self.sAnimPacking == 'TOLERANCE':
+						# orientations are interpolated on the shortest arc -> compare quaternions
+						rgIndices = Util.packSamples(store.getQuaternions(obj.name), Util.errorSlerp, self.rTolRotation)
 
-					curFramePercentage = 0
-					for iFrame in range(cFrames):
-						flVRML.write(sPrecKEY % curFramePercentage) 
-						curFramePercentage += frameStep
-					flVRML.write("]\n keyValue [ ") 
-
-					for axisAngle in mapObjRotation[obj.name]:
-						flVRML.write(sPrecXYZW % axisAngle)
-					flVRML.write("]\n}\n")
-
-					# and now route the animation.
-					flVRML.write("ROUTE %s.fraction_changed TO %s.set_fraction\n" % (timerDEF, orIntDEF))
-					flVRML.write("ROUTE %s.value_changed TO %s.set_rotation\n" % (orIntDEF, objDEF))
+					self.writeInterpolator(flVRML, "OrientationInterpolator", "%s_OriInt" % objDEF,
+						rgKeys, store.getAxisAngles(obj.name), rgIndices, sPrecXYZW, timerDEF, objDEF, "set_rotation")
 
 				#same for the translation:
-				setTranslations = set(mapObjTranslation[obj.name])
-				if len(setTranslations) > 1:
-					posIntDEF = "%s_PosInt" % objDEF
-					flVRML.write("""\nDEF %s PositionInterpolator {
-						key [ """ % posIntDEF)
-
-					curFramePercentage = 0
-					for iFrame in range(cFrames):
-						flVRML.write(sPrecKEY % curFramePercentage)
-						curFramePercentage += frameStep
-					flVRML.write("]\n keyValue [ ") 
-
+				if store.isAnimated(obj.name, 'translation', rTolChange):
+					rgTranslations = store.getValues(obj.name, 'translation')
+					rgIndices = rgKeyIndices
+					if self.sAnimPacking == 'TOLERANCE':
+						rgIndices = Util.packSamples(rgTranslations, Util.errorLinear, self.rTolTranslation)
 
-					for translation in mapObjTranslation[obj.name]:
-						flVRML.write(sPrecXYZ % translation)
-					flVRML.write("]\n}\n")
-
-					# and now route the animation.
-					flVRML.write("ROUTE %s.fraction_changed TO %s.set_fraction\n" % (timerDEF, posIntDEF))
-					flVRML.write("ROUTE %s.value_changed TO %s.set_translation\n" % (posIntDEF, objDEF))
+					self.writeInterpolator(flVRML, "PositionInterpolator", "%s_PosInt" % objDEF,
+						rgKeys, rgTranslations, rgIndices, sPrecXYZ, timerDEF, objDEF, "set_translation")
 
 				# and finally for the scale
-				setScale = set(mapObjScale[obj.name])
-				if len(setScale) > 1:
-					scaleIntDEF = "%s_ScaleInt" % objDEF
-					flVRML.write("""\nDEF %s PositionInterpolator {
-						key [ """ % scaleIntDEF)
-
-					curFramePercentage = 0
-					for iFrame in range(cFrames):
-						flVRML.write(sPrecKEY % curFramePercentage)
-						curFramePercentage += frameStep
-					flVRML.write("]\n keyValue [ ") 
-
-					for scale in mapObjScale[obj.name]:
-						flVRML.write(sPrecXYZ % scale)
-					flVRML.write("]\n}\n")
+				if store.isAnimated(obj.name, 'scale', rTolChange):
+					rgScales = store.getValues(obj.name, 'scale')
+					rgIndices = rgKeyIndices
+					if self.sAnimPacking == 'TOLERANCE':
+						rgIndices = Util.packSamples(rgScales, Util.errorLinear, self.rTolScale)
+
+					self.writeInterpolator(flVRML, "PositionInterpolator", "%s_ScaleInt" % objDEF,
+						rgKeys, rgScales, rgIndices, sPrecXYZ, timerDEF, objDEF, "scale")
+
+			# the vertex animation of deformed meshes
+			for obj in rgObjects:
+				vertexStream = mapVertexStreams.get(obj.name)
+				if not vertexStream or not vertexStream.coordDEF:
+					continue
+
+				print("   ...exporting vertex animation of '%s'" % obj.name)
+				frameStep = 1.0 / len(rgFrames)
+				rgKeys = [iFrame * frameStep for iFrame in range(len(rgFrames))]
+				self.writeCoordinateInterpolator(flVRML, vertexStream, rgKeys, timerDEF,
+					"%s_CoordInt" % obj.name.replace(".", "_"))
+
+		for vertexStream in mapVertexStreams.values():
+			vertexStream.close()
+
+		if self.bake:
+			if store:
+				# the transformations as sampled (vertex animations are not in the cache)
+				rgAnimNames = sorted(store.mapObjIndex.keys(), key=lambda objName: store.mapObjIndex[objName])
+				self.bake.meta['vrml']['animation'] = { 'cFrames' : store.cFrames,
+					'objects' : [objName.replace(".", "_") for objName in rgAnimNames] }
+				for sChannel, values in store.mapChannels.items():
+					self.bake.addArray("anim." + sChannel, 'f', values)
+			self.bake.close()
+			self.bake = None
 
-					# and now route the animation.
-					flVRML.write("ROUTE %s.fraction_changed TO %s.set_fraction\n" % (timerDEF, scaleIntDEF))
-					flVRML.write("ROUTE %s.value_changed TO %s.scale\n" % (scaleIntDEF, objDEF))
 
 
-
-		# now remove duplicates we possibly made
-		setObjNameNonDuplicates = set(
-			[obj.name for obj in context.selected_objects]) and set(rgObjNamesOriginal)
-
-		# traverse the selection and remove those we want to keep from it
-		for objNameDuplicate in setObjNameNonDuplicates:
-			bpy.data.objects[objNameDuplicate].select = False 
-
-		# now only the extra copies are selected -> remove them
-		bpy.ops.object.delete() # removes the selected object
-		
-		for objName in rgObjNamesOriginal:
-			bpy.data.objects[objName].select = True # and select the original one again.
-			# also make it active again.
-		bpy.context.scene.objects.active = bpy.data.objects[objNameActive]
+		if self.fExportAnimation:
+			scene.frame_set(iFrameInitial)
 
 		flVRML.close()
-		self.fnLast = fnVRML
 
-		self.report({'INFO'},  "Export finished.")
+		if self.fIncremental:
+			import filecmp
+			if os.path.exists(fnVRML) and filecmp.cmp(fnWrite, fnVRML, shallow=False):
+				print("   ...unchanged")
+				os.remove(fnWrite)
+			else:
+				if os.path.exists(fnVRML):
+					os.remove(fnVRML)
+				os.rename(fnWrite, fnVRML)
+			print("   ...%i of %i chunks reused" % (len([sKey for sKey in flVRML.mapChunks if sKey in self.mapPreviousChunks]),
+				len(flVRML.mapChunks)))
+		self.fFinishedVRML = True
+
+		if self.rgInlineFiles:
+			print("Writing %i inline files..." % len(self.rgInlineFiles))
+			cWritten = Util.writeFiles([(os.path.join(dirOut, fn), flInline.getvalue()) for fn, flInline in self.rgInlineFiles])
+			print("   ...%i changed" % cWritten)
+
+		if self.fIncremental:
+			rgOutputs = [(os.path.basename(fnVRML), flVRML)] + self.rgInlineFiles
+			Util.saveChunks(fnVRML, [(fn, flOut.mapChunks) for fn, flOut in rgOutputs])
+			self.mapPreviousChunks = None
+		Export_VRML.rgLastInlineFiles = [fn for fn, flInline in self.rgInlineFiles]
+		self.rgInlineFiles = []
+
+		if self.pool:
+			self.pool.close()
+			self.pool.join()
+			self.pool = None
+
+		if self.assets.mapAssets:
+			# (the progress is the one of the texture conversions now)
+			for rProgress in self.assets.copySteps():
+				yield rProgress
+			print("%i of %i texture(s) copied" % (self.assets.cCopied, len(self.assets.mapAssets)))
+		sCopyErrors = self.assets.getReport()
+		self.assets = None
+		if sCopyErrors:
+			print(sCopyErrors)
+			self.report({'WARNING'}, sCopyErrors)
+
+		# watch mode: the export is repeated in the background (see export_watch.py)
+		if self.fWatch:
+			export_watch.addWatch('VRML', [obj.name for obj in rgObjects], fnVRML,
+				export_watch.getOptions(self, ('filepath', 'check_existing', 'filter_glob', 'fWatch', 'sSourceFile')))
+		else:
+			export_watch.removeWatch(fnVRML)
 
-		
+		self.report({'INFO'},  "Export finished.")
 
-		return {'FINISHED'}
+	def discardBake(self):
+		if self.bake:
+			self.bake.discard()
+			self.bake = None
 	
-	def invoke(self, context, event):
-		# set some fields depending on the current scene:
-		scene = context.scene
+	# the fields which depend on the current scene
+	rgSceneDefaults = ['iAnimFrameStart', 'iAnimFrameStop', 'iAnimStep', 'rAnimationDurationSec', 'precisionKey']
 
+	def setSceneDefaults(self, scene, fOnlyUnset=False):
+		"""sets the frame range etc. from the scene (fOnlyUnset: keep the values
+		given to the operator, e.g. by a script calling it without invoke)"""
 		cFramesExported = (scene.frame_end - scene.frame_start+1) / scene.frame_step
 		secExported = cFramesExported / float(scene.render.fps)
 
-		self.iAnimFrameStart = scene.frame_start
-		self.iAnimFrameStop = scene.frame_end
-		self.iAnimStep = scene.frame_step
-		self.rAnimationDurationSec = secExported
-
-		# how much precision do we need on the exporter?
-		import math
-		self.precisionKey = int(math.ceil(math.log10(cFramesExported)))
+		mapValues = {
+			'iAnimFrameStart' : scene.frame_start,
+			'iAnimFrameStop' : scene.frame_end,
+			'iAnimStep' : scene.frame_step,
+			'rAnimationDurationSec' : secExported,
+			# how much precision do we need on the exporter?
+			'precisionKey' : max(1, int(math.ceil(math.log10(max(cFramesExported, 1))))),
+		}
+		for sProp in self.rgSceneDefaults:
+			if not (fOnlyUnset and self.properties.is_property_set(sProp)):
+				setattr(self, sProp, mapValues[sProp])
 
+	def invoke(self, context, event):
+		# set some fields depending on the current scene:
+		self.setSceneDefaults(context.scene)
 
-		if not context.selected_objects:
-			# select everybody.
-			bpy.ops.object.select_all(action="SELECT")
 
 		# check that we could export everything:
-		rgConvertableTypes = ['MESH', 'FONT', 'SURFACE', 'CURVE', 'META']
-		rgRemoveObjectsFromSelection = []
-		for obj in context.selected_objects:
-			if obj.type not in rgConvertableTypes:
-				rgRemoveObjectsFromSelection.append(obj.name)
-
-		# remove objects from the selection we could not export
-		# and notify the user about it
-		for objName in rgRemoveObjectsFromSelection:
-			bpy.data.objects[objName].select = False
+		rgObjects = Util.getExportObjects(context)
+		rgIgnoredObjects = [obj.name for obj in context.selected_objects if obj not in rgObjects]
 			
-		if rgRemoveObjectsFromSelection:
+		if rgIgnoredObjects:
 			self.report({'WARNING'},
-					"Ignoring object(s) '%s' and removing them from the selection.\n\nOnly objects of types %s were exported." % 
-						(",".join(rgRemoveObjectsFromSelection), "/".join(rgConvertableTypes)))
+					"Ignoring object(s) '%s'.\n\nOnly objects of types %s are exported." % 
+						(",".join(rgIgnoredObjects), "/".join(Util.rgConvertableTypes)))
 			#return {'CANCELLED'}
 		
-		# check again if there is something left...
-		if not context.selected_objects:
+		# check if there is something left...
+		if not rgObjects:
 			self.report({'ERROR'},  "No object to export left.")
 			return {'CANCELLED'}
 
-		# set first object as active object  (needed for convert and toggle)
-		context.scene.objects.active = context.selected_objects[0]
-
 		# reset the old filename for convenience.
 		if self.fnLast:
 			self.filepath = self.fnLast
 		else:
-			fnOut = context.selected_objects[0].name
+			fnOut = rgObjects[0].name
 			fnOut = fnOut.replace(" ", "_")
 			self.filepath = fnOut + ".wrl"
 
 
-		# then show the exporter.
+		# then show the exporter (the export runs modal, see modal_export.py)
+		self.fModal = True
 		wm = context.window_manager.fileselect_add(self)
 		return {'RUNNING_MODAL'}
 
 
+class Geometry:
+	"""The arrays of one IndexedFaceSet: coordinates, faces (tuples of
+	coordinate indices) and, if textured, texture coordinates together with
+	their per-face indices."""
+
+	def __init__(self):
+		self.rgCoords = []
+		self.rgCoordIndex = []
+		self.rgTexCoords = []
+		self.rgTexCoordIndex = []
+		self.rgNormals = []
+		self.rgNormalIndex = []
+		# the digits the normals are quantized to (see indexNormals)
+		self.cNormalDigits = None
+		# whether all faces are convex (None: unknown, nothing is written)
+		self.fConvex = None
+
+	@staticmethod
+	def fromTessfaces(mesh, fTexCoords, cNormalDigits=None):
+		fSplitNormals = cNormalDigits is not None and hasattr(mesh, "calc_normals_split")
+		if fSplitNormals:
+			# blender's split normals (auto smooth, sharp edges, ...) as in
+			# fromPolygons: the tessfaces take them from the loops when they are made
+			mesh.calc_normals_split()
+			mesh.calc_tessface()
+
+		geometry = Geometry()
+		geometry.rgCoords = [tuple(vertex.co) for vertex in mesh.vertices]
+		geometry.rgCoordIndex = [tuple(face.vertices) for face in mesh.tessfaces]
+
+		# triangles are convex anyway, only the quads have to be checked
+		geometry.fConvex = True
+		for face in mesh.tessfaces:
+			if len(face.vertices) > 3 and not Util.isConvexPolygon(
+					[geometry.rgCoords[iVertex] for iVertex in face.vertices], tuple(face.normal)):
+				geometry.fConvex = False
+				break
+
+		if fSplitNormals:
+			# (split_normals always has four, triangles use the first three)
+			geometry.indexNormals([[tuple(normal) for normal in face.split_normals][:len(face.vertices)]
+				for face in mesh.tessfaces], cNormalDigits)
+		elif cNormalDigits is not None:
+			# smooth faces use the vertex normals, flat ones the face normal
+			rgVertexNormals = [tuple(vertex.normal) for vertex in mesh.vertices]
+			rgCornerNormals = []
+			for face in mesh.tessfaces:
+				if face.use_smooth:
+					rgCornerNormals.append([rgVertexNormals[iVertex] for iVertex in face.vertices])
+				else:
+					rgCornerNormals.append([tuple(face.normal)] * len(face.vertices))
+			geometry.indexNormals(rgCornerNormals, cNormalDigits)
+
+		if fTexCoords:
+			# one texture coordinate per face corner
+			for texFace in mesh.tessface_uv_textures[0].data:
+				rgLocIndex = []
+				for uv in texFace.uv:
+					rgLocIndex.append(len(geometry.rgTexCoords))
+					geometry.rgTexCoords.append(tuple(uv))
+				geometry.rgTexCoordIndex.append(tuple(rgLocIndex))
+
+		return geometry
+
+	@staticmethod
+	def fromPolygons(mesh, fTexCoords, cNormalDigits=None):
+		"""n-gons are kept, only concave polygons are tesselated (-> convex)"""
+		geometry = Geometry()
+		geometry.rgCoords = [tuple(vertex.co) for vertex in mesh.vertices]
+		geometry.fConvex = True
+
+		# all faces as loop indices (for the uvs and normals)
+		rgFaceLoops = []
+
+		for polygon in mesh.polygons:
+			rgVertices = tuple(polygon.vertices)
+			rgLoops = tuple(polygon.loop_indices)
+			normal = tuple(polygon.normal)
+			rgPolyCoords = [geometry.rgCoords[iVertex] for iVertex in rgVertices]
+
+			if len(rgVertices) <= 3 or Util.isConvexPolygon(rgPolyCoords, normal):
+				geometry.rgCoordIndex.append(rgVertices)
+				rgFaceLoops.append(rgLoops)
+				continue
+
+			rgTriangles = mathutils.geometry.tessellate_polygon([[mathutils.Vector(co) for co in rgPolyCoords]])
+			for triangle in rgTriangles:
+				triangle = tuple(triangle)
+				# keep the winding of the polygon
+				if Util.dot(Util.triangleNormal(*[rgPolyCoords[i] for i in triangle]), normal) < 0.0:
+					triangle = triangle[::-1]
+				geometry.rgCoordIndex.append(tuple([rgVertices[i] for i in triangle]))
+				rgFaceLoops.append(tuple([rgLoops[i] for i in triangle]))
+
+		if fTexCoords:
+			# texture coordinates are per loop (= face corner)
+			geometry.rgTexCoords = [tuple(uvLoop.uv) for uvLoop in mesh.uv_layers[0].data]
+			geometry.rgTexCoordIndex = rgFaceLoops
+
+		if cNormalDigits is not None:
+			if hasattr(mesh, "calc_normals_split"):
+				# blender's split normals (auto smooth, sharp edges, ...)
+				mesh.calc_normals_split()
+				rgLoopNormals = [tuple(loop.normal) for loop in mesh.loops]
+			else:
+				# smooth polygons use the vertex normals, flat ones the polygon normal
+				rgVertexNormals = [tuple(vertex.normal) for vertex in mesh.vertices]
+				rgLoopNormals = [None] * len(mesh.loops)
+				for polygon in mesh.polygons:
+					for iLoop, iVertex in zip(polygon.loop_indices, polygon.vertices):
+						rgLoopNormals[iLoop] = rgVertexNormals[iVertex] if polygon.use_smooth else tuple(polygon.normal)
+			geometry.indexNormals([[rgLoopNormals[iLoop] for iLoop in face] for face in rgFaceLoops], cNormalDigits)
+
+		return geometry
+
+	def indexNormals(self, rgCornerNormals, cDigits):
+		"""quantizes the normals (a list per face) to cDigits and writes every distinct normal only once"""
+		self.cNormalDigits = cDigits
+		mapNormals = {}
+		for rgFaceNormals in rgCornerNormals:
+			rgFace = []
+			for normal in rgFaceNormals:
+				key = (round(normal[0], cDigits), round(normal[1], cDigits), round(normal[2], cDigits))
+				iNormal = mapNormals.get(key)
+				if iNormal is None:
+					iNormal = mapNormals[key] = len(self.rgNormals)
+					self.rgNormals.append(key)
+				rgFace.append(iNormal)
+			self.rgNormalIndex.append(tuple(rgFace))
+
+	def getBounds(self):
+		"""(min, max) of all coordinates, None if there are none"""
+		if not self.rgCoords:
+			return None
+		rgAxes = list(zip(*self.rgCoords))
+		return tuple([min(axis) for axis in rgAxes]), tuple([max(axis) for axis in rgAxes])
+
+	def flip(self):
+		"""reverses the orientation of all faces"""
+		self.rgCoordIndex = [face[::-1] for face in self.rgCoordIndex]
+		self.rgTexCoordIndex = [face[::-1] for face in self.rgTexCoordIndex]
+		self.rgNormalIndex = [face[::-1] for face in self.rgNormalIndex]
+		self.rgNormals = [(-normal[0], -normal[1], -normal[2]) for normal in self.rgNormals]
+
+	def padTexCoords(self):
+		"""gives all faces (0,0) texture coordinates, e.g. meshes without uvs in a textured batch"""
+		iTexCoord = len(self.rgTexCoords)
+		self.rgTexCoords.append((0.0, 0.0))
+		self.rgTexCoordIndex = [(iTexCoord,) * len(face) for face in self.rgCoordIndex]
+
+	def extend(self, geometry):
+		"""appends the faces (and coordinates) of another geometry"""
+		if not self.rgCoordIndex:
+			self.fConvex = geometry.fConvex
+		elif self.fConvex is not None and geometry.fConvex is not None:
+			self.fConvex = self.fConvex and geometry.fConvex
+		else:
+			self.fConvex = None
+
+		# texture coordinates: all faces or none
+		if self.rgCoordIndex and not self.rgTexCoordIndex and geometry.rgTexCoordIndex:
+			self.padTexCoords()
+		if self.rgTexCoordIndex and not geometry.rgTexCoordIndex:
+			geometry.padTexCoords()
+
+		iCoordOffset = len(self.rgCoords)
+		self.rgCoords.extend(geometry.rgCoords)
+		self.rgCoordIndex.extend([tuple([iCoord + iCoordOffset for iCoord in face]) for face in geometry.rgCoordIndex])
+
+		iTexCoordOffset = len(self.rgTexCoords)
+		self.rgTexCoords.extend(geometry.rgTexCoords)
+		self.rgTexCoordIndex.extend([tuple([iTexCoord + iTexCoordOffset for iTexCoord in face]) for face in geometry.rgTexCoordIndex])
+
+		if self.cNormalDigits is None:
+			self.cNormalDigits = geometry.cNormalDigits
+		iNormalOffset = len(self.rgNormals)
+		self.rgNormals.extend(geometry.rgNormals)
+		self.rgNormalIndex.extend([tuple([iNormal + iNormalOffset for iNormal in face]) for face in geometry.rgNormalIndex])
+
+	def decimate(self, rCellSize):
+		"""returns a coarser geometry by vertex clustering: all coordinates in
+		a cube of rCellSize are merged into their average, faces which collapse
+		(less than three distinct corners) are dropped"""
+		mapCells = {}
+		rgSums = []
+		rgCellOfCoord = []
+		for co in self.rgCoords:
+			key = (int(math.floor(co[0] / rCellSize)), int(math.floor(co[1] / rCellSize)), int(math.floor(co[2] / rCellSize)))
+			iCell = mapCells.get(key)
+			if iCell is None:
+				iCell = mapCells[key] = len(rgSums)
+				rgSums.append([0.0, 0.0, 0.0, 0])
+			sums = rgSums[iCell]
+			sums[0] += co[0]
+			sums[1] += co[1]
+			sums[2] += co[2]
+			sums[3] += 1
+			rgCellOfCoord.append(iCell)
+
+		geometry = Geometry()
+		geometry.fConvex = True
+		geometry.cNormalDigits = self.cNormalDigits
+		setFaces = set()
+		mapCoords, mapTexCoords, mapNormals = {}, {}, {}
+		for iFace, face in enumerate(self.rgCoordIndex):
+			rgCells = [rgCellOfCoord[iCoord] for iCoord in face]
+			# drop corners which fell into the cell of the previous corner
+			rgCorners = [iCorner for iCorner in range(len(face)) if rgCells[iCorner] != rgCells[iCorner-1]]
+			rgFaceCells = [rgCells[iCorner] for iCorner in rgCorners]
+			if len(set(rgFaceCells)) < 3 or len(set(rgFaceCells)) != len(rgFaceCells):
+				continue
+			keyFace = tuple(sorted(rgFaceCells))
+			if keyFace in setFaces:
+				continue
+			setFaces.add(keyFace)
+			if len(rgCorners) > 3:
+				geometry.fConvex = False # (merged corners may have made it concave)
+
+			rgFace = []
+			for iCell in rgFaceCells:
+				if iCell not in mapCoords:
+					x, y, z, c = rgSums[iCell]
+					mapCoords[iCell] = len(geometry.rgCoords)
+					geometry.rgCoords.append((x / c, y / c, z / c))
+				rgFace.append(mapCoords[iCell])
+			geometry.rgCoordIndex.append(tuple(rgFace))
+
+			# the texture coordinates and normals of the remaining corners
+			for rgIndex, rgValues, mapValues, rgIndexOut, rgValuesOut in (
+					(self.rgTexCoordIndex, self.rgTexCoords, mapTexCoords, geometry.rgTexCoordIndex, geometry.rgTexCoords),
+					(self.rgNormalIndex, self.rgNormals, mapNormals, geometry.rgNormalIndex, geometry.rgNormals)):
+				if not rgIndex:
+					continue
+				rgFaceOut = []
+				for iCorner in rgCorners:
+					iValue = rgIndex[iFace][iCorner]
+					if iValue not in mapValues:
+						mapValues[iValue] = len(rgValuesOut)
+						rgValuesOut.append(rgValues[iValue])
+					rgFaceOut.append(mapValues[iValue])
+				rgIndexOut.append(tuple(rgFaceOut))
+
+		return geometry
+
+	def subset(self, rgFaces):
+		"""returns a geometry with only the given faces (and the coordinates
+		they use) and the indices of these coordinates in this geometry"""
+		geometry = Geometry()
+		geometry.fConvex = self.fConvex
+		mapCoord = {}
+		rgCoordMap = []
+		for iFace in rgFaces:
+			rgFace = []
+			for iCoord in self.rgCoordIndex[iFace]:
+				if iCoord not in mapCoord:
+					mapCoord[iCoord] = len(rgCoordMap)
+					rgCoordMap.append(iCoord)
+				rgFace.append(mapCoord[iCoord])
+			geometry.rgCoordIndex.append(tuple(rgFace))
+
+			if self.rgTexCoordIndex:
+				rgTexFace = []
+				for iTexCoord in self.rgTexCoordIndex[iFace]:
+					rgTexFace.append(len(geometry.rgTexCoords))
+					geometry.rgTexCoords.append(self.rgTexCoords[iTexCoord])
+				geometry.rgTexCoordIndex.append(tuple(rgTexFace))
+
+		if self.rgNormalIndex:
+			geometry.indexNormals([[self.rgNormals[iNormal] for iNormal in self.rgNormalIndex[iFace]]
+				for iFace in rgFaces], self.cNormalDigits)
+
+		geometry.rgCoords = [self.rgCoords[iCoord] for iCoord in rgCoordMap]
+		return geometry, rgCoordMap
+
+
+class VertexAnimStream:
+	"""Streams the deformed vertex positions of one object frame by frame
+	into a temporary file (as float32). If rTolerance > 0, frames which are
+	linearly interpolated from the kept frames within rTolerance are dropped."""
+
+	# upper bound of the frames held back while looking for the next key
+	cMaxPendingFrames = 32
+
+	def __init__(self, obj, rTolerance, rTolMoving, fOmitStatic):
+		self.obj = obj
+		self.rTolerance = rTolerance
+		self.rTolMoving = rTolMoving
+		self.fOmitStatic = fOmitStatic
+		self.flTemp = tempfile.TemporaryFile()
+		self.fValid = True
+		self.cValues = None
+		self.rgSamples = [] # the kept samples (in the temporary file)
+		self.anchor = None
+		self.rgPending = []
+		self.coordsMin = None
+		self.coordsMax = None
+		self.coordDEF = None
+		self.rgCoordMap = None
+
+	def emitFrame(self, iSample, coords):
+		coords.tofile(self.flTemp)
+		self.rgSamples.append(iSample)
+		self.anchor = (iSample, coords)
+
+	def fitsLinear(self, iSample, coords):
+		"""whether all pending frames are interpolated from the anchor to coords"""
+		iAnchor, coordsAnchor = self.anchor
+		for iPending, coordsPending in self.rgPending:
+			t = (iPending - iAnchor) / float(iSample - iAnchor)
+			for a, b, v in zip(coordsAnchor, coords, coordsPending):
+				if abs(a + (b-a)*t - v) > self.rTolerance:
+					return False
+		return True
+
+	def addFrame(self, iSample, coords):
+		if not self.fValid:
+			return
+
+		if self.cValues is None:
+			self.cValues = len(coords)
+			self.coordsMin = array('f', coords)
+			self.coordsMax = array('f', coords)
+			self.emitFrame(iSample, coords)
+			return
+
+		if len(coords) != self.cValues:
+			print("   ...topology of '%s' changes, skipping its vertex animation" % self.obj.name)
+			self.fValid = False
+			return
+
+		coordsMin = self.coordsMin
+		coordsMax = self.coordsMax
+		for i, value in enumerate(coords):
+			if value < coordsMin[i]:
+				coordsMin[i] = value
+			elif value > coordsMax[i]:
+				coordsMax[i] = value
+
+		if self.rTolerance <= 0.0:
+			self.emitFrame(iSample, coords)
+			return
+
+		if self.rgPending:
+			if len(self.rgPending) >= self.cMaxPendingFrames or not self.fitsLinear(iSample, coords):
+				# the last pending frame becomes the next key
+				self.emitFrame(*self.rgPending[-1])
+				self.rgPending = []
+		self.rgPending.append((iSample, coords))
+
+	def finish(self):
+		if self.rgPending:
+			self.emitFrame(*self.rgPending[-1])
+			self.rgPending = []
+
+	def splitGeometry(self, geometry, coordDEF):
+		"""splits the geometry into the part which has to be animated (with
+		coordinates coordDEF) and the static rest. returns (geometry, coordDEF)
+		tuples; coordDEF is None for the static part."""
+		if not self.fValid or len(self.rgSamples) < 2 or self.cValues != 3*len(geometry.rgCoords):
+			return [(geometry, None)]
+
+		setMoving = set()
+		for iCoord in range(len(geometry.rgCoords)):
+			for i in range(3*iCoord, 3*iCoord+3):
+				if self.coordsMax[i] - self.coordsMin[i] > self.rTolMoving:
+					setMoving.add(iCoord)
+					break
+
+		if not setMoving:
+			return [(geometry, None)]
+
+		self.coordDEF = coordDEF
+		if not self.fOmitStatic:
+			self.rgCoordMap = list(range(len(geometry.rgCoords)))
+			geometry.rgNormals = []
+			geometry.rgNormalIndex = []
+			return [(geometry, coordDEF)]
+
+		# faces touching a moving vertex are animated, all others are static.
+		rgFacesAnimated = []
+		rgFacesStatic = []
+		for iFace, face in enumerate(geometry.rgCoordIndex):
+			if setMoving.intersection(face):
+				rgFacesAnimated.append(iFace)
+			else:
+				rgFacesStatic.append(iFace)
+
+		geometryAnimated, self.rgCoordMap = geometry.subset(rgFacesAnimated)
+		# normals of deformed faces change -> the client has to compute them
+		geometryAnimated.rgNormals = []
+		geometryAnimated.rgNormalIndex = []
+		rgParts = [(geometryAnimated, coordDEF)]
+		if rgFacesStatic:
+			rgParts.append((geometry.subset(rgFacesStatic)[0], None))
+		return rgParts
+
+	def getBounds(self):
+		"""(min, max) of all vertices over all frames"""
+		return (tuple([min(self.coordsMin[i::3]) for i in range(3)]),
+			tuple([max(self.coordsMax[i::3]) for i in range(3)]))
+
+	def iterFrames(self):
+		"""yields the coordinates (of the animated part) of every kept frame"""
+		self.flTemp.seek(0)
+		for iSample in self.rgSamples:
+			coords = array('f')
+			coords.fromfile(self.flTemp, self.cValues)
+			yield [tuple(coords[3*iCoord:3*iCoord+3]) for iCoord in self.rgCoordMap]
+
+	def close(self):
+		self.flTemp.close()
+
+
+class BVHNode:
+	"""Node of a bounding volume hierarchy: either inner node (rgChildren)
+	or leaf (rgItems), bounds are (min, max) tuples."""
+
+	def __init__(self, bounds):
+		self.bounds = bounds
+		self.rgChildren = []
+		self.rgItems = []
+
+	@staticmethod
+	def build(rgBoundedItems, cMaxLeafItems):
+		"""builds the hierarchy of (bounds, item) tuples by median splits along the longest axis"""
+		bounds = rgBoundedItems[0][0]
+		for boundsItem, item in rgBoundedItems[1:]:
+			bounds = Util.unionBounds(bounds, boundsItem)
+		node = BVHNode(bounds)
+
+		if len(rgBoundedItems) <= cMaxLeafItems:
+			node.rgItems = [item for boundsItem, item in rgBoundedItems]
+			return node
+
+		# split at the median of the centers along the axis where they spread most
+		rgCenters = [[0.5*(boundsItem[0][i] + boundsItem[1][i]) for i in range(3)] for boundsItem, item in rgBoundedItems]
+		rgExtents = [max([center[i] for center in rgCenters]) - min([center[i] for center in rgCenters]) for i in range(3)]
+		iAxis = rgExtents.index(max(rgExtents))
+
+		rgSorted = sorted(zip(rgCenters, rgBoundedItems), key=lambda centerItem: centerItem[0][iAxis])
+		iMedian = len(rgSorted) // 2
+		node.rgChildren = [BVHNode.build([boundedItem for center, boundedItem in rgSorted[:iMedian]], cMaxLeafItems),
+			BVHNode.build([boundedItem for center, boundedItem in rgSorted[iMedian:]], cMaxLeafItems)]
+		return node
+
+
+class AnimSampleStore:
+	"""Sampled transformations (rotation quaternion, translation, scale) of
+	all animated objects, kept in preallocated float32 arrays of the shape
+	objects x frames x 4/3/3 instead of per-frame python tuples."""
+
+	mapComponents = {'rotation' : 4, 'translation' : 3, 'scale' : 3}
+
+	def __init__(self, rgObjNames, cFrames):
+		self.cFrames = cFrames
+		self.mapObjIndex = dict([(objName, iObj) for iObj, objName in enumerate(rgObjNames)])
+		self.mapChannels = {}
+		for sChannel, cComponents in self.mapComponents.items():
+			self.mapChannels[sChannel] = array('f', [0.0]) * (len(rgObjNames) * cFrames * cComponents)
+
+	def __contains__(self, objName):
+		return objName in self.mapObjIndex
+
+	def getRange(self, objName, sChannel):
+		"""first and last+1 index of the samples of objName in the channel array"""
+		cStride = self.cFrames * self.mapComponents[sChannel]
+		iStart = self.mapObjIndex[objName] * cStride
+		return iStart, iStart + cStride
+
+	def setSample(self, objName, iSample, matrix):
+		quat = matrix.to_quaternion()
+		iRot = self.getRange(objName, 'rotation')[0] + 4*iSample
+		rotations = self.mapChannels['rotation']
+		if iSample > 0:
+			# stay on the hemisphere of the previous sample (q and -q are the
+			# same rotation) so that the ranges below stay meaningful.
+			dot = sum([rotations[iRot-4+i] * quat[i] for i in range(4)])
+			if dot < 0.0:
+				quat.negate()
+		rotations[iRot:iRot+4] = array('f', quat)
+
+		iXYZ = self.getRange(objName, 'translation')[0] + 3*iSample
+		self.mapChannels['translation'][iXYZ:iXYZ+3] = array('f', matrix.to_translation())
+		self.mapChannels['scale'][iXYZ:iXYZ+3] = array('f', matrix.to_scale())
+
+	def isAnimated(self, objName, sChannel, rTolerance):
+		"""whether any component changes more than rTolerance (min/max range check)"""
+		cComponents = self.mapComponents[sChannel]
+		iStart, iEnd = self.getRange(objName, sChannel)
+		values = self.mapChannels[sChannel]
+		for i in range(cComponents):
+			component = values[iStart+i:iEnd:cComponents]
+			if max(component) - min(component) > rTolerance:
+				return True
+		return False
+
+	def getValues(self, objName, sChannel):
+		"""all samples of a channel as list of tuples"""
+		cComponents = self.mapComponents[sChannel]
+		iStart, iEnd = self.getRange(objName, sChannel)
+		values = self.mapChannels[sChannel]
+		return list(zip(*[values[iStart+i:iEnd:cComponents] for i in range(cComponents)]))
+
+	def getQuaternions(self, objName):
+		return [mathutils.Quaternion(wxyz) for wxyz in self.getValues(objName, 'rotation')]
+
+	def getAxisAngles(self, objName):
+		"""converts all rotation samples to VRML's (x, y, z, angle) in one pass"""
+		iStart, iEnd = self.getRange(objName, 'rotation')
+		return vrml_format.getAxisAngles(self.mapChannels['rotation'][iStart:iEnd])
+
+
+class Util:
+	# object types which can be converted to meshes
+	rgConvertableTypes = ['MESH', 'FONT', 'SURFACE', 'CURVE', 'META']
+
+	# the selected objects which can be exported (all visible ones if nothing is selected)
+	@staticmethod
+	def getExportObjects(context):
+		rgObjects = context.selected_objects
+		if not rgObjects:
+			rgObjects = [obj for obj in context.scene.objects if obj.is_visible(context.scene)]
+		return [obj for obj in rgObjects if obj.type in Util.rgConvertableTypes]
+
+	# modifiers which move vertices over time (-> vertex animation)
+	rgDeformModifiers = ['ARMATURE', 'CAST', 'CLOTH', 'CURVE', 'DISPLACE',
+		'DYNAMIC_PAINT', 'EXPLODE', 'FLUID_SIMULATION', 'HOOK', 'LATTICE',
+		'MESH_DEFORM', 'OCEAN', 'SHRINKWRAP', 'SIMPLE_DEFORM', 'SMOOTH',
+		'SOFT_BODY', 'WARP', 'WAVE']
+
+	@staticmethod
+	def hasDeformation(obj):
+		for modifier in obj.modifiers:
+			if modifier.show_viewport and modifier.type in Util.rgDeformModifiers:
+				return True
+
+		shapeKeys = getattr(obj.data, "shape_keys", None)
+		if shapeKeys and shapeKeys.animation_data:
+			return True
+
+		return obj.parent is not None and obj.parent_type == 'ARMATURE'
+
+	# the vertex coordinates (flat, in object space) of the evaluated mesh
+	@staticmethod
+	def getDeformedCoords(obj, scene):
+		mesh = obj.to_mesh(scene, True, 'PREVIEW')
+		coords = array('f', [0.0]) * (3*len(mesh.vertices))
+		mesh.vertices.foreach_get("co", coords)
+		bpy.data.meshes.remove(mesh)
+		return coords
+
+	# the chunks of the previous incremental export (hash -> text), read from
+	# the files it wrote as far as they were not changed since (same sha1)
+	@staticmethod
+	def loadChunks(fnVRML):
+		mapChunks = {}
+		if not os.path.exists(fnVRML + ".hashes"):
+			return mapChunks
+		try:
+			with open(fnVRML + ".hashes", "rt") as fl:
+				mapFiles = json.load(fl)['files']
+			for fn, (sHash, mapFileChunks) in mapFiles.items():
+				fn = os.path.join(os.path.dirname(fnVRML), fn)
+				if not os.path.exists(fn):
+					continue
+				with open(fn, "rt") as fl:
+					sContent = fl.read()
+				if Util.getTextHash(sContent) != sHash:
+					continue
+				for sKey, (iOffset, cChars) in mapFileChunks.items():
+					mapChunks[sKey] = sContent[iOffset:iOffset+cChars]
+		except (ValueError, KeyError, TypeError) as e:
+			print("Ignoring '%s.hashes' (%s)" % (fnVRML, e))
+		return mapChunks
+
+	# rgFiles: (file name, hash -> (offset, length)) of the files of this export
+	# (written next to fnVRML), with the sha1 of each file as it is now
+	@staticmethod
+	def saveChunks(fnVRML, rgFiles):
+		mapFiles = {}
+		for fn, mapChunks in rgFiles:
+			with open(os.path.join(os.path.dirname(fnVRML), fn), "rt") as fl:
+				mapFiles[fn] = (Util.getTextHash(fl.read()), mapChunks)
+		# (only written if it changed, like the output files)
+		Util.writeFiles([(fnVRML + ".hashes", json.dumps({ 'version' : 2, 'files' : mapFiles }, sort_keys=True))])
+
+	@staticmethod
+	def getTextHash(s):
+		import hashlib
+		return hashlib.sha1(s.encode("utf-8")).hexdigest()
+
+	# writes (file name, content) pairs with a few threads (the file system does the
+	# work, not python) and leaves files which already have this content untouched,
+	# so re-exports only touch the files that changed. returns the number written.
+	@staticmethod
+	def writeFiles(rgFiles, cMaxThreads=8):
+		def writeFile(fnContent):
+			fn, sContent = fnContent
+			if os.path.exists(fn):
+				with open(fn, "rt") as fl:
+					if fl.read() == sContent:
+						return False
+			with open(fn, "wt") as fl:
+				fl.write(sContent)
+			return True
+
+		if len(rgFiles) < 2:
+			return len([f for f in map(writeFile, rgFiles) if f])
+
+		from concurrent.futures import ThreadPoolExecutor
+		with ThreadPoolExecutor(max_workers=min(cMaxThreads, len(rgFiles))) as executor:
+			return len([f for f in executor.map(writeFile, rgFiles) if f])
+
+	# bounding boxes are (min, max) tuples
+	@staticmethod
+	def unionBounds(a, b):
+		return (tuple([min(a[0][i], b[0][i]) for i in range(3)]),
+			tuple([max(a[1][i], b[1][i]) for i in range(3)]))
+
+	# VRML's bboxCenter and bboxSize
+	@staticmethod
+	def formatBounds(bounds):
+		center = [0.5*(bounds[0][i] + bounds[1][i]) for i in range(3)]
+		size = [bounds[1][i] - bounds[0][i] for i in range(3)]
+		return "%.5f %.5f %.5f" % tuple(center), "%.5f %.5f %.5f" % tuple(size)
+
+	# the (evaluated) bounding box of an object in world space
+	@staticmethod
+	def getWorldBounds(obj):
+		rgCorners = [(obj.matrix_world * mathutils.Vector(corner)).to_tuple() for corner in obj.bound_box]
+		rgAxes = list(zip(*rgCorners))
+		return tuple([min(axis) for axis in rgAxes]), tuple([max(axis) for axis in rgAxes])
+
+	@staticmethod
+	def dot(a, b):
+		return a[0]*b[0] + a[1]*b[1] + a[2]*b[2]
+
+	@staticmethod
+	def cross(a, b):
+		return (a[1]*b[2] - a[2]*b[1], a[2]*b[0] - a[0]*b[2], a[0]*b[1] - a[1]*b[0])
+
+	@staticmethod
+	def triangleNormal(a, b, c):
+		return Util.cross((b[0]-a[0], b[1]-a[1], b[2]-a[2]), (c[0]-a[0], c[1]-a[1], c[2]-a[2]))
+
+	# a polygon is convex if all its corners turn to the same side (around its normal)
+	@staticmethod
+	def isConvexPolygon(rgCoords, normal):
+		cCoords = len(rgCoords)
+		for i in range(cCoords):
+			if Util.dot(Util.triangleNormal(rgCoords[i-1], rgCoords[i], rgCoords[(i+1) % cCoords]), normal) < -1e-12:
+				return False
+		return True
+
+	# data paths which change the object transformation (basis matrix)
+	rgTransformPaths = ['location', 'rotation_euler', 'rotation_quaternion',
+		'rotation_axis_angle', 'scale']
+	rgDeltaTransformPaths = ['delta_location', 'delta_rotation_euler',
+		'delta_rotation_quaternion', 'delta_scale', 'rotation_mode']
+
+	# finds out what drives the transformation of an object:
+	#   'STATIC' - nothing (the transformation never changes)
+	#   'ACTION' - only the fcurves of its own action (can be evaluated directly)
+	#   'SCENE'  - anything else (constraints, drivers, nla, animated parents, ...)
+	# fRelative: the transformation relative to the parent is of interest
+	# (then the animation of the parents does not matter).
+	@staticmethod
+	def getAnimationSource(obj, fRelative=False):
+		if obj.constraints:
+			return 'SCENE'
+
+		if obj.parent:
+			if obj.parent_type != 'OBJECT':
+				return 'SCENE' # bones, vertices, ...
+			objParent = obj.parent if not fRelative else None
+			while objParent:
+				if objParent.animation_data or objParent.constraints:
+					return 'SCENE'
+				objParent = objParent.parent
+
+		animData = obj.animation_data
+		if not animData:
+			return 'STATIC'
+
+		if len(animData.drivers) > 0:
+			return 'SCENE'
+
+		for track in animData.nla_tracks:
+			if not track.mute:
+				return 'SCENE'
+
+		if not animData.action:
+			return 'STATIC'
+
+		fTransformAnimated = False
+		for fcurve in animData.action.fcurves:
+			if fcurve.mute:
+				continue
+			if fcurve.data_path in Util.rgDeltaTransformPaths:
+				return 'SCENE'
+			if fcurve.data_path in Util.rgTransformPaths:
+				fTransformAnimated = True
+
+		if not fTransformAnimated:
+			return 'STATIC'
+
+		# delta transforms are not composed by evaluateActionMatrices
+		if tuple(obj.delta_location) != (0.0, 0.0, 0.0) or \
+				tuple(obj.delta_scale) != (1.0, 1.0, 1.0) or \
+				tuple(obj.delta_rotation_euler) != (0.0, 0.0, 0.0) or \
+				tuple(obj.delta_rotation_quaternion) != (1.0, 0.0, 0.0, 0.0):
+			return 'SCENE'
+
+		return 'ACTION'
+
+	# evaluates matrix_world (fRelative: the matrix relative to the parent)
+	# of an object with animation source 'ACTION' for all the given frames
+	# directly from its fcurves (no frame_set).
+	@staticmethod
+	def evaluateActionMatrices(obj, rgFrames, fRelative=False):
+		mapCurves = {}
+		for fcurve in obj.animation_data.action.fcurves:
+			if not fcurve.mute:
+				mapCurves[(fcurve.data_path, fcurve.array_index)] = fcurve
+
+		# for every channel: fcurve (or None -> constant value of the object)
+		def getChannel(sPath, rgDefault):
+			return [(mapCurves.get((sPath, i)), rgDefault[i]) for i in range(len(rgDefault))]
+
+		def evaluateChannel(rgChannel, frame):
+			return [fcurve.evaluate(frame) if fcurve else value for (fcurve, value) in rgChannel]
+
+		rotationMode = obj.rotation_mode
+		chLocation = getChannel('location', obj.location)
+		chScale = getChannel('scale', obj.scale)
+		if rotationMode == 'QUATERNION':
+			chRotation = getChannel('rotation_quaternion', obj.rotation_quaternion)
+		elif rotationMode == 'AXIS_ANGLE':
+			chRotation = getChannel('rotation_axis_angle', obj.rotation_axis_angle)
+		else:
+			chRotation = getChannel('rotation_euler', obj.rotation_euler)
+
+		matParent = mathutils.Matrix.Identity(4)
+		if obj.parent and fRelative:
+			matParent = obj.matrix_parent_inverse.copy()
+		elif obj.parent:
+			matParent = obj.parent.matrix_world * obj.matrix_parent_inverse
+
+		rgMatrices = []
+		for frame in rgFrames:
+			location = evaluateChannel(chLocation, frame)
+			rotation = evaluateChannel(chRotation, frame)
+			scale = evaluateChannel(chScale, frame)
+
+			if rotationMode == 'QUATERNION':
+				matRotation = mathutils.Quaternion(rotation).normalized().to_matrix().to_4x4()
+			elif rotationMode == 'AXIS_ANGLE':
+				# stored as (angle, x, y, z), a zero axis means no rotation
+				matRotation = mathutils.Matrix.Identity(4)
+				if any(rotation[1:4]):
+					matRotation = mathutils.Quaternion(rotation[1:4], rotation[0]).to_matrix().to_4x4()
+			else:
+				matRotation = mathutils.Euler(rotation, rotationMode).to_matrix().to_4x4()
+
+			matScale = mathutils.Matrix.Identity(4)
+			for i in range(3):
+				matScale[i][i] = scale[i]
+
+			matBasis = mathutils.Matrix.Translation(location) * matRotation * matScale
+			rgMatrices.append(matParent * matBasis)
+
+		return rgMatrices
+
+	# upper bound of the samples between two kept ones in packSamples: every
+	# longer segment is checked again, this keeps the packing linear
+	cMaxPackedSamples = 32
+
+	# greedily removes samples which can be interpolated from their kept
+	# neighbours with an error (fnError) of at most rTolerance (with at most
+	# cMaxPackedSamples in between). returns the indices of the samples to keep.
+	@staticmethod
+	def packSamples(rgValues, fnError, rTolerance):
+		cValues = len(rgValues)
+		if cValues <= 2:
+			return list(range(cValues))
+
+		rgIndices = [0]
+		iAnchor = 0
+		iEnd = iAnchor + 2
+		while iEnd < cValues:
+			# can all samples between anchor and end be interpolated?
+			fFits = iEnd - iAnchor <= Util.cMaxPackedSamples + 1
+			for i in range(iAnchor+1, iEnd):
+				t = (i - iAnchor) / float(iEnd - iAnchor)
+				if fnError(rgValues[iAnchor], rgValues[iEnd], t, rgValues[i]) > rTolerance:
+					fFits = False
+					break
+
+			if fFits:
+				iEnd += 1
+			else:
+				# the sample before end has to be kept
+				iAnchor = iEnd - 1
+				rgIndices.append(iAnchor)
+				iEnd = iAnchor + 2
+
+		rgIndices.append(cValues-1)
+		return rgIndices
+
+	# max. (per component) deviation of a linear interpolation
+	@staticmethod
+	def errorLinear(a, b, t, v):
+		return max([abs(a[i] + (b[i]-a[i])*t - v[i]) for i in range(len(v))])
+
+	# angle between the spherical interpolation of two quaternions and v
+	@staticmethod
+	def errorSlerp(a, b, t, v):
+		angle = a.slerp(b, t).rotation_difference(v).angle
+		return min(angle, 2*pi - angle)
+
+
 def menuCB(self, context):
 	self.layout.operator(Export_VRML.bl_idname, text="Export to VRML (.wrl)...")
  
 def register():
 	bpy.utils.register_module(__name__)
 	bpy.types.INFO_MT_file_export.append(menuCB)
+	export_watch.register()
  
 def unregister():
+	export_watch.unregister()
 	bpy.utils.unregister_module(__name__)
 	bpy.types.INFO_MT_file_export.remove(menuCB)
  
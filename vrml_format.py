@@ -0,0 +1,256 @@
+# ***** BEGIN GPL LICENSE BLOCK *****
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+
+# ***** END GPL LICENCE BLOCK *****
+
+# the text formatting of vrml_export_263.py. this module must not use bpy:
+# it is also imported by the worker processes which format the shapes.
+
+import math
+import multiprocessing
+
+
+def formatShape(appearanceNode, geometryArrays, coordDEF, options):
+	"""returns the Shape node of one IndexedFaceSet as string.
+	geometryArrays: (rgCoords, rgCoordIndex, rgTexCoords, rgTexCoordIndex, rgNormals, rgNormalIndex, fConvex)
+	options: (precisionXYZ, precisionUV, precisionNormal, creaseAngle, fSolidHints)"""
+	rgCoords, rgCoordIndex, rgTexCoords, rgTexCoordIndex, rgNormals, rgNormalIndex, fConvex = geometryArrays
+	precisionXYZ, precisionUV, precisionNormal, creaseAngle, fSolidHints = options
+
+	# closed meshes can be rendered one-sided (back face culling)
+	sOrientation = getOrientation(rgCoords, rgCoordIndex) if fSolidHints else None
+
+	rgOut = []
+	rgOut.append(
+"""	Shape 
+	{
+		%s
+		geometry IndexedFaceSet {
+			solid %s
+			creaseAngle %.3f
+""" % (appearanceNode, "TRUE" if sOrientation else "FALSE", creaseAngle))
+
+	if sOrientation == 'CW':
+		rgOut.append("			ccw FALSE\n")
+
+	if fConvex is not None:
+		rgOut.append("			convex %s\n" % ("TRUE" if fConvex else "FALSE"))
+
+	######### UV COORDS ###########
+	# if we have a texture: write the coords.
+	if rgTexCoords:
+		rgOut.append(" texCoord TextureCoordinate { \n point [ \n")
+
+		sPrecUV = 2*("%%.%if "% precisionUV)+ ", "
+		rgOut.extend([sPrecUV % tuple(uv) for uv in rgTexCoords])
+
+		rgOut.append("] \n } \n")
+
+		# now write the indices
+		rgOut.append(" texCoordIndex [ \n" )
+		for texIndexFace in rgTexCoordIndex:
+			rgOut.append("".join(["%i " % texIndex for texIndex in texIndexFace]))
+			rgOut.append("-1 ")
+		rgOut.append("\n]\n")
+
+	######### XYZ COORDS ###########
+	# ok, now on to the actual coordinates of the mesh etc.
+	rgOut.append("coordIndex [\n ")
+	for face in rgCoordIndex:
+		rgOut.append("".join(["%i, " % iCoord for iCoord in face]))
+		rgOut.append("-1, ")
+
+	if coordDEF:
+		rgOut.append("] \n coord DEF %s Coordinate { point [\n " % coordDEF)
+	else:
+		rgOut.append("] \n coord Coordinate { point [\n ")
+
+	sPrecXYZ = 3*("%%.%if "% precisionXYZ) + ", "
+	rgOut.extend([sPrecXYZ % tuple(co) for co in rgCoords])
+
+	# close the geometry, and off we go!
+	rgOut.append("""]
+				} # end of Coordinate""")
+
+	######### NORMALS ###########
+	if rgNormals:
+		rgOut.append("\n normal Normal { vector [\n ")
+		sPrecNormal = 3*("%%.%if "% precisionNormal) + ", "
+		rgOut.extend([sPrecNormal % tuple(normal) for normal in rgNormals])
+		rgOut.append("] }\n normalIndex [\n ")
+		for normalIndexFace in rgNormalIndex:
+			rgOut.append("".join(["%i, " % iNormal for iNormal in normalIndexFace]))
+			rgOut.append("-1, ")
+		rgOut.append("]\n normalPerVertex TRUE\n")
+
+	rgOut.append("\n  } # end of indexedFaceSet \n} # end of shape \n")
+	return "".join(rgOut)
+
+
+def formatInterpolator(sNodeType, intDEF, rgKeys, rgValues, rgIndices, sPrecValue, sPrecKey, timerDEF, objDEF, sField):
+	"""an interpolator for the samples rgIndices (None: all), routed to objDEF.sField"""
+	if rgIndices is None:
+		rgIndices = range(len(rgValues))
+
+	rgOut = ["""\nDEF %s %s {
+						key [ """ % (intDEF, sNodeType)]
+	rgOut.extend([sPrecKey % rgKeys[iSample] for iSample in rgIndices])
+	rgOut.append("]\n keyValue [ ")
+	rgOut.extend([sPrecValue % tuple(rgValues[iSample]) for iSample in rgIndices])
+	rgOut.append("]\n}\n")
+
+	# and now route the animation.
+	rgOut.append("ROUTE %s.fraction_changed TO %s.set_fraction\n" % (timerDEF, intDEF))
+	rgOut.append("ROUTE %s.value_changed TO %s.%s\n" % (intDEF, objDEF, sField))
+	return "".join(rgOut)
+
+def getAxisAngles(rgWXYZ):
+	"""converts flat quaternion components (w, x, y, z, w, ...) to VRML's (x, y, z, angle)"""
+	rgAxisAngles = []
+	for w, x, y, z in zip(rgWXYZ[0::4], rgWXYZ[1::4], rgWXYZ[2::4], rgWXYZ[3::4]):
+		w = max(-1.0, min(1.0, w))
+		s = math.sqrt(1.0 - w*w)
+		if s < 1e-6:
+			rgAxisAngles.append((0.0, 0.0, 1.0, 0.0)) # no rotation
+		else:
+			rgAxisAngles.append((x/s, y/s, z/s, 2.0*math.acos(w)))
+	return rgAxisAngles
+
+def getOrientation(rgCoords, rgCoordIndex):
+	"""'CCW' if the faces form a closed, consistently wound surface facing
+	outwards, 'CW' if it faces inwards, None if it is not closed (or flat)"""
+	if not rgCoordIndex:
+		return None
+
+	# closed and consistent: every directed edge exists exactly once, and so does its reverse
+	setEdges = set()
+	for face in rgCoordIndex:
+		for i in range(len(face)):
+			edge = (face[i-1], face[i])
+			if edge in setEdges or edge[0] == edge[1]:
+				return None
+			setEdges.add(edge)
+	for a, b in setEdges:
+		if (b, a) not in setEdges:
+			return None
+
+	# the sign of the enclosed volume tells the orientation (faces as fans)
+	rVolume = 0.0
+	for face in rgCoordIndex:
+		ax, ay, az = rgCoords[face[0]]
+		for i in range(1, len(face) - 1):
+			bx, by, bz = rgCoords[face[i]]
+			cx, cy, cz = rgCoords[face[i+1]]
+			rVolume += ax * (by*cz - bz*cy) + ay * (bz*cx - bx*cz) + az * (bx*cy - by*cx)
+	if rVolume > 0.0:
+		return 'CCW'
+	if rVolume < 0.0:
+		return 'CW'
+	return None
+
+
+def createPool(cProcesses, fnExecutable=None):
+	"""a pool of worker processes for the formatting, None if it cannot be
+	started (then everything is formatted in this process).
+	fnExecutable: the python binary for the workers (blender itself cannot
+	be used where the workers are spawned instead of forked)"""
+	if cProcesses < 2:
+		return None
+	try:
+		if fnExecutable:
+			multiprocessing.set_executable(fnExecutable)
+		return multiprocessing.Pool(cProcesses)
+	except Exception as e:
+		print("Could not start %i worker processes (%s), formatting in this process." % (cProcesses, e))
+		return None
+
+
+def getHash(*args):
+	"""hash of (picklable) formatting arguments, see OrderedOutput (incremental)"""
+	import hashlib
+	import pickle
+	return hashlib.sha1(pickle.dumps(args, 2)).hexdigest()
+
+
+class OrderedOutput:
+	"""A file (or io.StringIO) which also takes text that is still being
+	formatted by a worker process: everything ends up in the order it was
+	written, no matter which worker finishes first.
+	Incremental: formatted text whose arguments have the same hash as in
+	mapPrevious (hash -> text of the previous export) is taken from there,
+	mapChunks tells where the formatted text of this export is (hash ->
+	(offset, length) in characters)."""
+
+	def __init__(self, fl, pool=None, mapPrevious=None):
+		self.fl = fl
+		self.pool = pool
+		self.mapPrevious = mapPrevious
+		self.mapChunks = {}
+		self.cWritten = 0
+		# (hash, string or AsyncResult) not yet written (only with a pool)
+		self.rgPending = []
+
+	def writeText(self, s, sKey=None):
+		if sKey is not None:
+			self.mapChunks[sKey] = (self.cWritten, len(s))
+		self.fl.write(s)
+		self.cWritten += len(s)
+
+	def write(self, s, sKey=None):
+		if self.rgPending:
+			self.rgPending.append((sKey, s))
+		else:
+			self.writeText(s, sKey)
+
+	def writeFormatted(self, fnFormat, *args):
+		"""writes fnFormat(*args), which runs in a worker process if there is a pool"""
+		sKey = None
+		if self.mapPrevious is not None:
+			sKey = getHash(fnFormat.__name__, args)
+			if sKey in self.mapPrevious:
+				self.write(self.mapPrevious[sKey], sKey)
+				return
+
+		if not self.pool:
+			self.writeText(fnFormat(*args), sKey)
+			return
+		self.rgPending.append((sKey, self.pool.apply_async(fnFormat, args)))
+		self.flushReady()
+
+	def flushReady(self):
+		"""writes everything up to the first result which is not yet there"""
+		iReady = 0
+		for sKey, pending in self.rgPending:
+			if not isinstance(pending, str) and not pending.ready():
+				break
+			iReady += 1
+		for sKey, pending in self.rgPending[:iReady]:
+			self.writeText(pending if isinstance(pending, str) else pending.get(), sKey)
+		del self.rgPending[:iReady]
+
+	def flush(self):
+		"""waits for all workers and writes everything"""
+		for sKey, pending in self.rgPending:
+			self.writeText(pending if isinstance(pending, str) else pending.get(), sKey)
+		self.rgPending = []
+
+	def getvalue(self):
+		self.flush()
+		return self.fl.getvalue()
+
+	def close(self):
+		self.flush()
+		self.fl.close()